@@ -0,0 +1,359 @@
+# asyncpyboard.py - asyncio interface to a MicroPython board.
+#
+# AsyncPyboard speaks the same raw REPL protocol as pyboard.Pyboard, and sends
+# the same file operation scripts as files.Files, but it runs on an asyncio
+# stream instead of a QSerialPort and does not use Qt at all. This allows
+# deployment scripts to drive many boards concurrently from one event loop:
+#
+#     import asyncio
+#     import asyncpyboard
+#
+#     async def deploy(device):
+#         pyb = await asyncpyboard.AsyncPyboard.open(device)
+#         try:
+#             await pyb.enter_raw_repl()
+#             await pyb.put('main.py')
+#             print(device, await pyb.ls())
+#             await pyb.exit_raw_repl()
+#         finally:
+#             await pyb.close()
+#
+#     async def main():
+#         await asyncio.gather(deploy('/dev/ttyUSB0'), deploy('192.168.4.1'))
+#
+#     asyncio.run(main())
+#
+# Serial devices need the optional pyserial-asyncio package. An IP address
+# connects over TCP, by default to the telnet REPL on port 23.
+#
+import asyncio
+import binascii
+import os
+import struct
+import files
+from rawrepl import (PyboardError, RxBuffer, TelnetFilter, is_ip_address, RAW_REPL_BANNER, SOFT_REBOOT,
+                     HANDSHAKE_TIMEOUT, HANDSHAKE_TRIES)
+
+# seconds enter_raw_repl() spends at most skipping output before the handshake
+FLUSH_TIMEOUT = 0.5
+
+
+class AsyncPyboard:
+    def __init__(self, reader, writer, telnet=False):
+        self._reader = reader
+        self._writer = writer
+        self._filter = TelnetFilter() if telnet else None
+        self.rxbuf = RxBuffer()
+        # raw-paste mode is used unless the firmware has refused it
+        self.use_raw_paste = True
+
+    @classmethod
+    async def open(cls, device, baudrate=115200, user='micro', password='python', port=23):
+        """Connect to a serial device, or to the telnet REPL if device is an IP address."""
+        if is_ip_address(device):
+            reader, writer = await asyncio.open_connection(device, port)
+            pyb = cls(reader, writer, telnet=True)
+            if user is not None:
+                await pyb._telnet_login(user, password)
+            return pyb
+        try:
+            import serial_asyncio
+        except ImportError:
+            raise PyboardError('serial devices need the pyserial-asyncio package')
+        reader, writer = await serial_asyncio.open_serial_connection(url=device, baudrate=int(baudrate))
+        return cls(reader, writer)
+
+    async def _telnet_login(self, user, password, timeout=10):
+        if not (await self.read_until(b'Login as:', timeout)).endswith(b'Login as:'):
+            raise PyboardError('Failed to establish a telnet connection with the board')
+        await self.write(bytes(user, 'ascii') + b'\r\n')
+        if not (await self.read_until(b'Password:', timeout)).endswith(b'Password:'):
+            raise PyboardError('Failed to establish a telnet connection with the board')
+        # needed because of internal implementation details of the telnet server
+        await asyncio.sleep(0.2)
+        await self.write(bytes(password, 'ascii') + b'\r\n')
+        data = await self.read_until(b'Type "help()" for more information.', timeout)
+        if not data.endswith(b'for more information.'):
+            raise PyboardError('Failed to establish a telnet connection with the board')
+
+    async def close(self):
+        self._writer.close()
+        try:
+            await self._writer.wait_closed()
+        except (OSError, ConnectionError):
+            pass
+
+    async def write(self, data):
+        if self._filter is not None:
+            data = self._filter.escape(data)
+        self._writer.write(data)
+        await self._writer.drain()
+
+    # Wait up to timeout (None waits forever) for more data. Returns False on timeout.
+    async def _fill(self, timeout):
+        try:
+            data = await asyncio.wait_for(self._reader.read(65536), timeout)
+        except asyncio.TimeoutError:
+            return False
+        if not data:
+            raise PyboardError('connection to the board was closed')
+        if self._filter is not None:
+            data = self._filter.feed(data)
+        self.rxbuf.feed(data)
+        return True
+
+    async def read_until(self, ending, timeout=1):
+        """Return received data up to and including ending, or all data received
+        if ending has not arrived within timeout seconds (None waits forever).
+        """
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        scan = 0
+        while True:
+            idx = self.rxbuf.find(ending, scan)
+            if idx >= 0:
+                return self.rxbuf.take(idx + len(ending))
+            scan = max(0, len(self.rxbuf) - len(ending) + 1)
+            remaining = None if deadline is None else deadline - loop.time()
+            if remaining is not None and remaining <= 0:
+                return self.rxbuf.take(len(self.rxbuf))
+            await self._fill(remaining)
+
+    async def read_bytes(self, num_bytes, timeout=1):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while len(self.rxbuf) < num_bytes:
+            remaining = deadline - loop.time()
+            if remaining <= 0 or not await self._fill(remaining):
+                break
+        return self.rxbuf.take(num_bytes)
+
+    async def enter_raw_repl(self, soft_reset=True):
+        # ctrl-C: interrupt any running program
+        await self.write(b'\r\x03')
+        # flush input, output of the interrupt that arrives later is skipped
+        # while waiting for the banner. A board that keeps printing is not
+        # waited for longer than FLUSH_TIMEOUT.
+        deadline = asyncio.get_running_loop().time() + FLUSH_TIMEOUT
+        while await self._fill(0.01) and asyncio.get_running_loop().time() < deadline:
+            self.rxbuf.clear()
+        self.rxbuf.clear()
+
+        for retry in range(HANDSHAKE_TRIES):
+            await self.write(b'\r\x01')     # ctrl-A: enter raw REPL
+            data = await self.read_until(RAW_REPL_BANNER, HANDSHAKE_TIMEOUT['enter'])
+            if data.endswith(RAW_REPL_BANNER):
+                if retry:
+                    # the earlier ctrl-A may have been kept for the REPL, skip its banner
+                    await self.read_until(RAW_REPL_BANNER, 0.1)
+                break
+            # the program caught the interrupt, try again
+            await self.write(b'\r\x03')
+        else:
+            raise PyboardError('could not enter raw repl')
+        if not soft_reset:
+            return data
+
+        await self.write(b'\x04')       # ctrl-D: soft reset
+        data = await self.read_until(SOFT_REBOOT, HANDSHAKE_TIMEOUT['reboot'])
+        if not data.endswith(SOFT_REBOOT):
+            raise PyboardError('could not enter raw repl')
+        # interrupt a main program loop that keeps the banner from showing
+        data = b''
+        for retry in range(HANDSHAKE_TRIES):
+            data += await self.read_until(RAW_REPL_BANNER, HANDSHAKE_TIMEOUT['banner'])
+            if data.endswith(RAW_REPL_BANNER):
+                return data
+            await self.write(b'\x03')
+        raise PyboardError('could not enter raw repl')
+
+    async def exit_raw_repl(self):
+        await self.write(b'\r\x02')     # ctrl-B: enter friendly REPL
+
+    async def raw_paste_write(self, command_bytes):
+        data = await self.read_bytes(2)
+        if len(data) != 2:
+            raise PyboardError('could not read raw paste window size')
+        window_size = struct.unpack('<H', data)[0]
+        window_remain = window_size
+
+        i = 0
+        while i < len(command_bytes):
+            # flow control bytes are consumed once the window is used up, or
+            # earlier if they have already arrived
+            while window_remain == 0 or len(self.rxbuf):
+                data = await self.read_bytes(1)
+                if data == b'\x01':
+                    # device can accept another window of data
+                    window_remain += window_size
+                elif data == b'\x04':
+                    # device indicated an abrupt end, acknowledge it and finish
+                    await self.write(b'\x04')
+                    return
+                else:
+                    raise PyboardError('unexpected read during raw paste: {}'.format(data))
+            b = command_bytes[i:min(i + window_remain, len(command_bytes))]
+            await self.write(b)
+            window_remain -= len(b)
+            i += len(b)
+
+        await self.write(b'\x04')       # ctrl-D ends the transmit
+        data = await self.read_until(b'\x04')
+        if not data.endswith(b'\x04'):
+            raise PyboardError('could not complete raw paste: {}'.format(data))
+
+    async def exec_raw_no_follow(self, command):
+        if isinstance(command, bytes):
+            command_bytes = command
+        else:
+            command_bytes = bytes(command, encoding='utf8')
+
+        if self.use_raw_paste:
+            await self.write(b'\x05A\x01')
+            data = await self.read_bytes(2)
+            if data == b'R\x01':
+                return await self.raw_paste_write(command_bytes)
+            elif data == RAW_REPL_BANNER[:2]:
+                # firmware predates raw-paste, the trailing ctrl-A re-enters the raw REPL
+                data = await self.read_until(RAW_REPL_BANNER[2:])
+                if not data.endswith(RAW_REPL_BANNER[2:]):
+                    raise PyboardError('could not enter raw repl')
+            elif data != b'R\x00':
+                raise PyboardError('could not enter raw-paste mode: {}'.format(data))
+            self.use_raw_paste = False
+
+        for i in range(0, len(command_bytes), 256):
+            await self.write(command_bytes[i:min(i + 256, len(command_bytes))])
+        await self.write(b'\x04')
+        data = await self.read_until(b'OK')
+        if not data.endswith(b'OK'):
+            raise PyboardError('could not exec command (response: {})'.format(data))
+
+    async def follow(self, timeout=None, data_consumer=None):
+        """Wait for the output of a command. Normal output is passed to
+        data_consumer(bytes) as it arrives if one is given, otherwise it is
+        returned. Returns (output, error output).
+        """
+        data = bytearray()
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while True:
+            idx = self.rxbuf.find(b'\x04')
+            chunk = self.rxbuf.take(len(self.rxbuf) if idx < 0 else idx + 1)
+            if idx >= 0:
+                chunk = chunk[:-1]
+            if chunk:
+                if data_consumer is not None:
+                    data_consumer(chunk)
+                else:
+                    data += chunk
+            if idx >= 0:
+                break
+            remaining = None if deadline is None else deadline - loop.time()
+            if remaining is not None and remaining <= 0:
+                raise PyboardError('timeout waiting for first EOF reception')
+            await self._fill(remaining)
+
+        data_err = await self.read_until(b'\x04', 1)
+        if not data_err.endswith(b'\x04'):
+            raise PyboardError('timeout waiting for second EOF reception')
+        await self.read_until(b'>', 1)      # raw REPL prompt
+        return bytes(data), data_err[:-1]
+
+    async def exec_raw(self, command, timeout=10, data_consumer=None):
+        await self.exec_raw_no_follow(command)
+        return await self.follow(timeout, data_consumer)
+
+    async def exec_(self, command, timeout=10, data_consumer=None):
+        ret, ret_err = await self.exec_raw(command, timeout, data_consumer)
+        if ret_err:
+            raise PyboardError('exception', ret, ret_err)
+        return ret
+
+    async def eval(self, expression):
+        ret = await self.exec_('print({})'.format(expression))
+        return ret.strip()
+
+    # File operations, mirroring files.Files. They must be called in raw REPL mode.
+
+    async def get(self, filename, dest=None):
+        """Return the contents of a file on the board, or pass them in blocks
+        to dest(bytes) as they arrive if dest is given.
+        """
+        data = bytearray()
+        if dest is None:
+            dest = data.extend
+        await self.exec_raw_no_follow(files.get_command(filename))
+        await self._read_script_line(filename)     # file size
+        while True:
+            line = await self._read_script_line(filename)
+            if not line.strip():
+                break
+            dest(binascii.a2b_base64(line))
+        await self.follow(5)
+        return bytes(data)
+
+    async def _read_script_line(self, filename):
+        line = await self.read_until(b'\n', 5)
+        if b'\x04' in line:
+            line += await self.read_until(b'\x04', 1)
+            await self.read_until(b'>', 0.1)
+            raise PyboardError('exception', b'', line.split(b'\x04')[1])
+        if not line.endswith(b'\n'):
+            raise PyboardError('timeout reading ' + filename)
+        return line
+
+    async def ls(self, directory='/', long_format=True, recursive=False):
+        if not directory.startswith('/'):
+            directory = '/' + directory
+        await self.exec_raw_no_follow(files.ilistdir_command(directory, recursive))
+        entries = []
+        while True:
+            line = await self._read_script_line(directory)
+            if not line.strip():
+                break
+            entries.append(files.parse_ilist_line(line))
+        await self.follow(5)
+        return files.ls_lines(entries, long_format)
+
+    async def mkdir(self, directory):
+        await self.exec_(files.mkdir_command(directory))
+
+    async def put(self, filename, remote_name=None):
+        """Stream a local file to the board, see files.put_command()."""
+        if remote_name is None:
+            remote_name = os.path.basename(filename)
+        await self.exec_raw_no_follow(files.put_command(remote_name))
+        await self._wait_upload_ack(remote_name)
+        with open(filename, 'rb') as infile:
+            for block_size, line in files.upload_blocks(infile):
+                await self.write(line)
+                await self._wait_upload_ack(remote_name)
+        await self.write(b'\n')     # empty line ends the upload
+        out, err = await self.follow(5)
+        if err:
+            raise PyboardError('exception', out, err)
+
+    async def _wait_upload_ack(self, remote_name):
+        data = await self.read_until(files.UPLOAD_ACK, 5)
+        if not data.endswith(files.UPLOAD_ACK):
+            if b'\x04' not in data:
+                await self.write(b'\x03')
+            await self.follow(1)
+            raise PyboardError('failed to write ' + remote_name)
+
+    async def rm(self, filename):
+        await self.exec_(files.rm_command(filename))
+
+    async def rmdir(self, directory):
+        await self.exec_(files.rmdir_command(directory))
+
+    async def run(self, filename, timeout=None, data_consumer=None):
+        """Run a local script on the board and return its output."""
+        with open(filename, 'rb') as infile:
+            return await self.exec_(infile.read(), timeout, data_consumer)
+
+
+# in Python2 exec is a keyword so one must use "exec_"
+# but for Python3 we want to provide the nicer version "exec"
+setattr(AsyncPyboard, "exec", AsyncPyboard.exec_)
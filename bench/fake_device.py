@@ -0,0 +1,553 @@
+# fake_device.py - a stand-in MicroPython board on a Linux pty pair.
+#
+# FakeDevice answers the friendly and raw REPL protocol (including raw-paste)
+# on the slave side of a pty, so Pyboard and Files can open it like a USB
+# serial port. Scripts are run by CPython with small stand-ins for the
+# MicroPython modules they import (os/uos, sys, ubinascii, machine, ...) and
+# the board's filesystem is a local directory. The serial line speed and the
+# board's processing time can be emulated to make benchmarks realistic.
+#
+# serve_telnet() and serve_webrepl() expose a FakeDevice on a loopback TCP
+# port, for TelnetToSerial and WebReplToSerial.
+#
+import binascii
+import hashlib
+import os
+import pty
+import select
+import socket
+import struct
+import termios
+import threading
+import time
+import traceback
+import tty
+import types
+import zlib
+
+RAW_REPL_BANNER = b'raw REPL; CTRL-B to exit\r\n>'
+
+
+class FakeDevice:
+    """Fake board on a pty. port is the device name to open.
+    baud       emulated line speed in both directions, 0 for no limit
+    latency    seconds the board needs to compile and start each script
+    reboot     seconds a soft reboot takes
+    raw_paste  False emulates firmware without raw-paste support
+    window     raw-paste flow control window in bytes
+    max_baud   fastest baud rate of the emulated USB serial bridge. Once a script
+               switches the UART with machine.UART(0, baud), data is garbled
+               while the port is not opened at that baud rate or it is above
+               max_baud.
+    """
+    def __init__(self, root, baud=0, latency=0.0, reboot=0.0, raw_paste=True, window=256, max_baud=921600):
+        self.root = root
+        self.baud = baud
+        self.latency = latency
+        self.reboot = reboot
+        self.raw_paste = raw_paste
+        self.window = window
+        self.max_baud = max_baud
+        self.uart_baud = None       # set by machine.UART(0, baud)
+        self.freq = 160000000
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        tty.setraw(self.master)
+        self.port = os.ttyname(self.slave)
+        self.cwd = '/'
+        self._rx = bytearray()
+        self._executing = False     # a script is running, Ctrl-C interrupts it
+        self._interrupted = False
+        self._stop = False
+        self._globals = {}
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop = True
+
+    # ---- emulated serial line
+
+    def _pace(self, num_bytes):
+        if self.baud:
+            time.sleep(num_bytes * 10.0 / self.baud)     # 8N1, 10 bits per byte
+
+    def set_uart_baud(self, baud):
+        self.uart_baud = baud
+        if self.baud:
+            self.baud = baud
+
+    # bytes sent at one baud rate and received at another are garbage
+    def _line(self, data):
+        if self.uart_baud is None:
+            return data
+        speed = termios.tcgetattr(self.slave)[5]
+        if speed == getattr(termios, 'B{0}'.format(self.uart_baud), None) and self.uart_baud <= self.max_baud:
+            return data
+        return bytes((c ^ 0x55) | 0x80 for c in data)
+
+    def tx(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        data = self._line(data)
+        self._pace(len(data))
+        os.write(self.master, data)
+
+    def _fill(self, timeout=None):
+        r, _, _ = select.select([self.master], [], [], timeout)
+        if r:
+            data = self._line(os.read(self.master, 65536))
+            self._pace(len(data))
+            if self._executing and b'\x03' in data:
+                # like the board's UART interrupt char, Ctrl-C never reaches stdin
+                data = data.replace(b'\x03', b'')
+                self._interrupted = True
+            self._rx += data
+            return True
+        return False
+
+    def _check_interrupt(self):
+        if self._interrupted:
+            self._interrupted = False
+            raise KeyboardInterrupt()
+
+    def rx(self, num_bytes=1):
+        while len(self._rx) < num_bytes:
+            self._check_interrupt()
+            self._fill()
+        data = bytes(self._rx[:num_bytes])
+        del self._rx[:num_bytes]
+        return data
+
+    def rx_line(self):
+        while b'\n' not in self._rx:
+            self._check_interrupt()
+            self._fill()
+        idx = self._rx.index(b'\n') + 1
+        data = bytes(self._rx[:idx])
+        del self._rx[:idx]
+        return data
+
+    # ---- REPL
+
+    def _run(self):
+        raw = False
+        buf = bytearray()
+        while not self._stop:
+            c = self.rx(1)
+            if c == b'\x03':
+                buf = bytearray()
+                if not raw:
+                    self.tx('\r\nKeyboardInterrupt\r\n>>> ')
+            elif c == b'\x01':
+                raw = True
+                buf = bytearray()
+                self.tx(RAW_REPL_BANNER)
+            elif c == b'\x02':
+                raw = False
+                self.tx('\r\nMicroPython v1.19.1 on fake device\r\nType "help()" for more information.\r\n>>> ')
+            elif raw and c == b'\x05':
+                if self.rx(2) == b'A\x01':
+                    if self.raw_paste:
+                        self.tx(b'R\x01' + struct.pack('<H', self.window))
+                        code = self._raw_paste()
+                        self.tx(b'\x04')
+                        self._exec(code)
+                    else:
+                        self.tx(b'R\x00')
+            elif raw and c == b'\x04':
+                if not buf:
+                    self.tx('OK\r\nMPY: soft reboot\r\n')
+                    self._globals = {}
+                    time.sleep(self.reboot)
+                    self.tx(RAW_REPL_BANNER)
+                else:
+                    self.tx('OK')
+                    code = bytes(buf)
+                    buf = bytearray()
+                    self._exec(code)
+            elif raw:
+                buf += c
+            elif c == b'\r':
+                self.tx('\r\n>>> ')
+            else:
+                self.tx(c)      # echo
+
+    def _raw_paste(self):
+        data = bytearray()
+        count = 0
+        while True:
+            c = self.rx(1)
+            if c == b'\x04':
+                return bytes(data)
+            data += c
+            count += 1
+            if count == self.window:
+                count = 0
+                self.tx(b'\x01')
+
+    def _exec(self, code):
+        time.sleep(self.latency)
+        out = _Stdout(self)
+        err = ''
+        modules = _modules(self, out)
+        g = self._globals
+        builtins = dict(vars(__builtins__)) if not isinstance(__builtins__, dict) else dict(__builtins__)
+        builtins['__import__'] = _importer(modules)
+        builtins['print'] = lambda *args, sep=' ', end='\n', **kw: out.write(sep.join(str(a) for a in args) + end)
+        builtins['open'] = lambda path, mode='r': open(self.path(path), mode)
+        g['__builtins__'] = builtins
+        g['__name__'] = '__main__'
+        self._executing = True
+        try:
+            exec(compile(code, '<stdin>', 'exec'), g)
+        except SystemExit:
+            pass
+        except BaseException:
+            err = traceback.format_exc()
+        finally:
+            self._executing = False
+            self._interrupted = False
+        out.flush()
+        self.tx(b'\x04' + err.encode() + b'\x04>')
+
+    def path(self, path):
+        """Local path of a path on the board."""
+        if not path.startswith('/'):
+            path = self.cwd.rstrip('/') + '/' + path
+        return os.path.join(self.root, os.path.normpath(path).lstrip('/'))
+
+
+# sys.stdout of the board. Like on bare-metal ports, text written to it goes
+# out with '\n' turned into '\r\n', sys.stdout.buffer writes bytes unchanged.
+class _Stdout:
+    def __init__(self, dev):
+        self.dev = dev
+        self.buf = bytearray()
+        self.buffer = _StdoutBuffer(self)
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        self.write_bytes(data.replace(b'\n', b'\r\n'))
+        return len(data)
+
+    def write_bytes(self, data):
+        self.buf += data
+        if len(self.buf) > 256 or b'\n' in data:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if self.buf:
+            self.dev.tx(bytes(self.buf))
+            self.buf = bytearray()
+
+
+class _StdoutBuffer:
+    def __init__(self, out):
+        self.out = out
+
+    def write(self, data):
+        return self.out.write_bytes(bytes(data))
+
+    def flush(self):
+        self.out.flush()
+
+
+class _Stdin:
+    def __init__(self, dev, out, binary):
+        self.dev = dev
+        self.out = out
+        self.binary = binary
+        self.buffer = _Stdin(dev, out, True) if not binary else None
+
+    def _result(self, data):
+        return data if self.binary else data.decode('latin-1')
+
+    def read(self, num_bytes):
+        self.out.flush()
+        return self._result(self.dev.rx(num_bytes))
+
+    def readinto(self, buf):
+        self.out.flush()
+        data = self.dev.rx(len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
+    def readline(self):
+        self.out.flush()
+        return self._result(self.dev.rx_line())
+
+
+def _modules(dev, out):
+    uos = types.ModuleType('uos')
+
+    def listdir(path=None):
+        return sorted(os.listdir(dev.path(path or dev.cwd)))
+
+    def ilistdir(path=None):
+        for name in listdir(path):
+            full = os.path.join(dev.path(path or dev.cwd), name)
+            yield (name, 0x4000 if os.path.isdir(full) else 0x8000, 0, os.stat(full).st_size)
+
+    def stat(path):
+        full = dev.path(path)
+        st = os.stat(full)
+        return (0x4000 if os.path.isdir(full) else 0x8000, 0, 0, 0, 0, 0, st.st_size, 0, 0, 0)
+
+    def chdir(path):
+        dev.cwd = path if path.startswith('/') else os.path.normpath(os.path.join(dev.cwd, path))
+
+    uos.listdir = listdir
+    uos.ilistdir = ilistdir
+    uos.stat = stat
+    uos.chdir = chdir
+    uos.getcwd = lambda: dev.cwd
+    uos.remove = lambda path: os.remove(dev.path(path))
+    uos.mkdir = lambda path: os.mkdir(dev.path(path))
+    uos.rmdir = lambda path: os.rmdir(dev.path(path))
+    uos.rename = lambda old, new: os.replace(dev.path(old), dev.path(new))
+    uos.uname = lambda: types.SimpleNamespace(sysname='esp32', machine='fake device with ESP32')
+
+    usys = types.ModuleType('usys')
+    usys.stdout = out
+    usys.stdin = _Stdin(dev, out, False)
+    usys.platform = 'esp32'
+    usys.implementation = types.SimpleNamespace(name='micropython', version=(1, 19, 1), _mpy=0x0a06)
+
+    ubinascii = types.ModuleType('ubinascii')
+    for name in ('hexlify', 'unhexlify', 'a2b_base64', 'b2a_base64', 'crc32'):
+        setattr(ubinascii, name, getattr(binascii, name))
+
+    machine = types.ModuleType('machine')
+    machine.unique_id = lambda: b'\xfa\x4e\x00\x10\x20\x30'
+    def freq(*args):
+        if args:
+            dev.freq = args[0]
+        return dev.freq
+
+    def uart(uart_id, baudrate=None, **kw):
+        if uart_id == 0 and baudrate:
+            out.flush()
+            dev.set_uart_baud(baudrate)
+
+    machine.freq = freq
+    machine.UART = uart
+
+    class Poll:
+        def register(self, obj, mask=1):
+            self.obj = obj
+
+        def poll(self, timeout=-1):
+            out.flush()
+            end = time.monotonic() + timeout / 1000.0
+            while not dev._rx:
+                dev._check_interrupt()
+                left = end - time.monotonic()
+                if timeout >= 0 and left <= 0:
+                    return []
+                dev._fill(left if timeout >= 0 else None)
+            return [(self.obj, 1)]
+
+    uselect = types.ModuleType('uselect')
+    uselect.POLLIN = 1
+    uselect.poll = Poll
+
+    uhashlib = types.ModuleType('uhashlib')
+    uhashlib.sha256 = hashlib.sha256
+
+    uzlib = types.ModuleType('uzlib')
+    uzlib.decompress = zlib.decompress
+
+    def sleep(seconds):
+        # the port is read while the script waits, so Ctrl-C interrupts loops
+        end = time.monotonic() + seconds
+        while True:
+            dev._check_interrupt()
+            left = end - time.monotonic()
+            if left <= 0:
+                return
+            dev._fill(left)
+
+    utime = types.ModuleType('utime')
+    utime.time = time.time
+    utime.ticks_ms = lambda: int(time.monotonic() * 1000)
+    utime.ticks_diff = lambda a, b: a - b
+    utime.sleep = sleep
+    utime.sleep_ms = lambda ms: sleep(ms / 1000.0)
+
+    gc = types.ModuleType('gc')
+    gc.collect = lambda: None
+    gc.mem_free = lambda: 100000
+
+    return {'os': uos, 'uos': uos, 'sys': usys, 'usys': usys, 'binascii': ubinascii, 'ubinascii': ubinascii,
+            'machine': machine, 'hashlib': uhashlib, 'uhashlib': uhashlib, 'zlib': uzlib, 'uzlib': uzlib,
+            'gc': gc, 'select': uselect, 'uselect': uselect, 'time': utime, 'utime': utime, 'struct': struct, 'ustruct': struct}
+
+
+def _importer(modules):
+    def _import(name, *args, **kw):
+        if name in modules:
+            return modules[name]
+        if name == 'micropython':
+            raise ImportError(name)
+        return __import__(name, *args, **kw)
+    return _import
+
+
+# ---- loopback network stand-ins
+
+def _listen():
+    srv = socket.socket()
+    srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    srv.bind(('127.0.0.1', 0))
+    srv.listen(1)
+    return srv
+
+
+# Accept one client on srv and run serve(conn, fd) with the board's pty until the
+# client disconnects.
+def _session(srv, dev, serve):
+    conn, _ = srv.accept()
+    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    fd = os.open(dev.port, os.O_RDWR | os.O_NOCTTY)
+    tty.setraw(fd)
+    try:
+        serve(conn, fd)
+    except (ConnectionResetError, BrokenPipeError):
+        pass        # the client went away
+    finally:
+        conn.close()
+        os.close(fd)
+
+
+def _recv(conn, size):
+    data = conn.recv(size)
+    if not data:
+        raise ConnectionResetError('client closed the connection')
+    return data
+
+
+def serve_telnet(dev):
+    """Serve dev as a telnet REPL on a loopback port, returns 'ip:port' for Pyboard."""
+    srv = _listen()
+
+    def run(conn, fd):
+        conn.sendall(b'\xff\xfb\x01Login as: ')
+        while not _recv(conn, 256).endswith(b'\n'):
+            pass
+        conn.sendall(b'Password: ')
+        while not _recv(conn, 256).endswith(b'\n'):
+            pass
+        conn.sendall(b'\r\nLogin succeeded!\r\nType "help()" for more information.\r\n>>> ')
+        while True:
+            r, _, _ = select.select([conn, fd], [], [])
+            if conn in r:
+                os.write(fd, _recv(conn, 65536).replace(b'\xff\xff', b'\xff'))
+            if fd in r:
+                conn.sendall(os.read(fd, 65536).replace(b'\xff', b'\xff\xff'))
+
+    threading.Thread(target=_session, args=(srv, dev, run), daemon=True).start()
+    return '127.0.0.1:{0}'.format(srv.getsockname()[1])
+
+
+def _ws_send(conn, opcode, payload):
+    if len(payload) < 126:
+        header = struct.pack('>BB', 0x80 | opcode, len(payload))
+    else:
+        header = struct.pack('>BBH', 0x80 | opcode, 126, len(payload))
+    conn.sendall(header + payload)
+
+
+def _ws_recv(conn, buf):
+    while True:
+        if len(buf) >= 2:
+            size = buf[1] & 0x7f
+            pos = 2
+            if size == 126:
+                size = struct.unpack('>H', bytes(buf[2:4]))[0] if len(buf) >= 4 else -1
+                pos = 4
+            elif size == 127:
+                size = struct.unpack('>Q', bytes(buf[2:10]))[0] if len(buf) >= 10 else -1
+                pos = 10
+            mask = None
+            if buf[1] & 0x80:
+                mask = bytes(buf[pos:pos + 4])
+                pos += 4
+            if size >= 0 and len(buf) >= pos + size:
+                opcode = buf[0] & 0x0f
+                payload = bytes(buf[pos:pos + size])
+                del buf[:pos + size]
+                if mask:
+                    key = (mask * (size // 4 + 1))[:size]
+                    payload = (int.from_bytes(payload, 'big') ^ int.from_bytes(key, 'big')).to_bytes(size, 'big')
+                return opcode, payload
+        buf += _recv(conn, 65536)
+
+
+def serve_webrepl(dev, password='python'):
+    """Serve dev as a WebREPL on a loopback port, returns 'ws://ip:port' for Pyboard."""
+    srv = _listen()
+
+    def run(conn, fd):
+        request = b''
+        while b'\r\n\r\n' not in request:
+            request += _recv(conn, 4096)
+        conn.sendall(b'HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n\r\n')
+        buf = bytearray()
+        lock = threading.Lock()
+        _ws_send(conn, 1, b'Password: ')
+        opcode, payload = _ws_recv(conn, buf)
+        if payload.rstrip(b'\r\n') != password.encode():
+            _ws_send(conn, 1, b'\r\nAccess denied\r\n')
+            return
+        _ws_send(conn, 1, b'\r\nWebREPL connected\r\n>>> ')
+
+        def pump():
+            try:
+                while True:
+                    data = os.read(fd, 4096)
+                    with lock:
+                        _ws_send(conn, 1, data)
+            except OSError:
+                pass        # the session ended and closed the socket or the pty
+        threading.Thread(target=pump, daemon=True).start()
+
+        while True:
+            opcode, payload = _ws_recv(conn, buf)
+            if opcode == 1:
+                os.write(fd, payload)
+            elif opcode == 2:
+                _, op, _, _, size, length, name = struct.unpack('<2sBBQLH64s', payload)
+                path = dev.path(name[:length].decode())
+                with lock:
+                    if op == 1:
+                        _ws_send(conn, 2, b'WB\x00\x00')
+                        data = bytearray()
+                        while len(data) < size:
+                            data += _ws_recv(conn, buf)[1]
+                        with open(path, 'wb') as f:
+                            f.write(data)
+                        _ws_send(conn, 2, b'WB\x00\x00')
+                    elif not os.path.isfile(path):
+                        _ws_send(conn, 2, b'WB\x01\x00')
+                    else:
+                        with open(path, 'rb') as f:
+                            data = f.read()
+                        _ws_send(conn, 2, b'WB\x00\x00')
+                        pos = 0
+                        while True:
+                            _ws_recv(conn, buf)         # client asks for the next chunk
+                            chunk = data[pos:pos + 1024]
+                            pos += len(chunk)
+                            _ws_send(conn, 2, struct.pack('<H', len(chunk)) + chunk)
+                            if not chunk:
+                                break
+                        _ws_send(conn, 2, b'WB\x00\x00')
+
+    threading.Thread(target=_session, args=(srv, dev, run), daemon=True).start()
+    return 'ws://127.0.0.1:{0}'.format(srv.getsockname()[1])
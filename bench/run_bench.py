@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# run_bench.py - transport throughput benchmarks, no hardware needed.
+#
+# Times Pyboard and Files against bench/fake_device.FakeDevice on a pty (or the
+# telnet/WebREPL loopback stand-ins) and writes the results as JSON, so every
+# transport change can be measured and regressions caught:
+#
+#     python bench/run_bench.py --baud 115200 --latency 0.002 -o results.json
+#
+# Benchmarks: enter_raw_repl (with and without soft reset) and the time of each
+# handshake phase, exec_ round trip latency, Files.put/get throughput for each
+# file size and ls of a directory with 1000 entries.
+#
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PyQt5.QtCore import QCoreApplication
+import pyboard
+import files
+import fake_device
+
+DEFAULT_SIZES = '1024,10240,102400,1048576'
+
+
+def timed(fn, repeat):
+    """Run fn repeat times, returns the list of run times in seconds."""
+    runs = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        fn()
+        runs.append(time.perf_counter() - start)
+    return runs
+
+
+def result(name, runs, num_bytes=None):
+    res = {
+        'name': name,
+        'median_s': statistics.median(runs),
+        'min_s': min(runs),
+        'max_s': max(runs),
+        'runs': len(runs),
+    }
+    if num_bytes is not None:
+        res['bytes'] = num_bytes
+        res['bytes_per_s'] = num_bytes / statistics.median(runs)
+    return res
+
+
+def size_name(size):
+    if size >= 1024 * 1024 and size % (1024 * 1024) == 0:
+        return '{0}MB'.format(size // (1024 * 1024))
+    if size >= 1024 and size % 1024 == 0:
+        return '{0}KB'.format(size // 1024)
+    return '{0}B'.format(size)
+
+
+def run(args):
+    root = tempfile.mkdtemp(prefix='microPy-bench-')
+    local = tempfile.mkdtemp(prefix='microPy-bench-local-')
+    dev = fake_device.FakeDevice(root, baud=args.baud, latency=args.latency, reboot=args.reboot,
+                                 raw_paste=not args.no_raw_paste).start()
+    if args.transport == 'telnet':
+        device = fake_device.serve_telnet(dev)
+    elif args.transport == 'webrepl':
+        device = fake_device.serve_webrepl(dev, 'python')
+    else:
+        device = dev.port
+
+    board = pyboard.Pyboard(None, device, '115200', shell_write=sys.stderr.write)
+    fs = files.Files(board)
+    # raw REPL calls made here directly must not be read by the shell handler
+    board.ignoreSerial = True
+    results = []
+    try:
+        phases = {}
+
+        def enter(soft_reset):
+            board.enter_raw_repl(soft_reset=soft_reset)
+            board.exit_raw_repl()
+            for phase, seconds in board.handshake_timing.items():
+                if phase != 'total':
+                    phases.setdefault(phase, []).append(seconds)
+        results.append(result('enter_raw_repl', timed(lambda: enter(True), args.repeat)))
+        results.append(result('enter_raw_repl_no_reset', timed(lambda: enter(False), args.repeat)))
+        for phase, runs in phases.items():
+            results.append(result('handshake_' + phase, runs))
+
+        board.enter_raw_repl()
+        results.append(result('exec_latency', timed(lambda: board.exec_('pass'), args.repeat * 10)))
+        board.exit_raw_repl()
+
+        for size in [int(s) for s in args.sizes.split(',')]:
+            name = 'bench_{0}.bin'.format(size)
+            path = os.path.join(local, name)
+            data = os.urandom(size)
+            with open(path, 'wb') as f:
+                f.write(data)
+            results.append(result('put_' + size_name(size), timed(lambda: fs.put(path), args.repeat), size))
+            got = []
+            results.append(result('get_' + size_name(size), timed(lambda: got.append(fs.get(name)), args.repeat),
+                                  size))
+            if any(g != data for g in got):
+                raise RuntimeError('get returned wrong data for ' + name)
+
+        os.mkdir(os.path.join(root, 'many'))
+        for i in range(args.entries):
+            with open(os.path.join(root, 'many', 'f{0:04d}.py'.format(i)), 'w') as f:
+                f.write('x = {0}\n'.format(i))
+        listing = []
+        results.append(result('ls_{0}'.format(args.entries),
+                              timed(lambda: listing.append(fs.ls('/many')), args.repeat)))
+        if len(listing[-1]) != args.entries:
+            raise RuntimeError('ls returned {0} entries'.format(len(listing[-1])))
+    finally:
+        board.serialClose()
+        dev.stop()
+        shutil.rmtree(root, ignore_errors=True)
+        shutil.rmtree(local, ignore_errors=True)
+
+    return {
+        'config': {
+            'transport': args.transport,
+            'baud': args.baud,
+            'latency_s': args.latency,
+            'reboot_s': args.reboot,
+            'raw_paste': not args.no_raw_paste,
+            'repeat': args.repeat,
+        },
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the microPy target transports against a fake device.')
+    parser.add_argument('--transport', choices=['serial', 'telnet', 'webrepl'], default='serial',
+                        help='serial is a pty, telnet and webrepl use a loopback stand-in server')
+    parser.add_argument('--baud', type=int, default=0, help='emulated line speed, 0 for no limit')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds the device takes to start a script')
+    parser.add_argument('--reboot', type=float, default=0.0, help='seconds a soft reboot takes')
+    parser.add_argument('--no-raw-paste', action='store_true', help='emulate firmware without raw-paste mode')
+    parser.add_argument('--sizes', default=DEFAULT_SIZES, help='comma separated file sizes for put/get')
+    parser.add_argument('--entries', type=int, default=1000, help='directory entries for the ls benchmark')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per benchmark')
+    parser.add_argument('-o', '--output', help='write the JSON results to this file instead of stdout')
+    args = parser.parse_args()
+
+    app = QCoreApplication(sys.argv)
+    report = run(args)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+# bundle.py - transfer of many files to the target in one archive.
+#
+# Uploading files one by one costs a script start and a handshake per file,
+# which dominates for projects of many small modules. put_bundle() packs the
+# files into one stream of entries, each a struct header (BUNDLE_HEADER: flags,
+# name length, data length) followed by the target path and the data, and
+# sends it in a single raw REPL script that unpacks the entries as they
+# arrive, creating folders as needed. Small entries are zlib compressed when
+# that makes them smaller and the board can inflate them. Both ends hold at
+# most one line of the stream and one compressed entry in memory.
+#
+import binascii
+import os
+import struct
+import textwrap
+import zlib
+import files
+
+BUNDLE_HEADER = '<BHI'      # flags, name length, data length
+FLAG_ZLIB = 1
+COMPRESS_MAX = 8192         # larger files are sent as they are
+
+
+# board side inflate(data), None if the board has no zlib support
+INFLATE_PRELUDE = """
+        try:
+            import deflate
+            import io
+            def inflate(data):
+                return deflate.DeflateIO(io.BytesIO(data), deflate.ZLIB).read()
+        except ImportError:
+            try:
+                import zlib
+            except ImportError:
+                try:
+                    import uzlib as zlib
+                except ImportError:
+                    zlib = None
+            inflate = zlib.decompress if zlib else None
+"""
+
+
+def inflate_command():
+    """Script that prints 1 if the board can inflate zlib data, otherwise 0."""
+    command = INFLATE_PRELUDE + """
+        print(1 if inflate else 0)
+    """
+    return textwrap.dedent(command)
+
+
+def unpack_command():
+    """Script that reads a bundle from stdin as base64 lines, like put_command(),
+    writes its entries and prints the number of files written. The board sends
+    UPLOAD_ACK when it is ready and after each line.
+    """
+    command = INFLATE_PRELUDE + """
+        import sys
+        import struct
+        import ubinascii
+        try:
+            import os
+        except ImportError:
+            import uos as os
+        try:
+            stdin = sys.stdin.buffer
+        except AttributeError:
+            stdin = sys.stdin
+        def makedirs(path):
+            parts = path.split('/')[1:-1]
+            for i in range(len(parts)):
+                try:
+                    os.mkdir('/' + '/'.join(parts[:i + 1]))
+                except OSError:
+                    pass
+        pending = b''
+        out = None
+        flags = left = count = 0
+        sys.stdout.write('\\x06')
+        while True:
+            line = stdin.readline()
+            if len(line) <= 1:
+                break
+            pending += ubinascii.a2b_base64(line)
+            while True:
+                if out is None:
+                    if len(pending) < {0}:
+                        break
+                    flags, name_len, left = struct.unpack('{1}', pending[:{0}])
+                    if len(pending) < {0} + name_len:
+                        break
+                    name = pending[{0}:{0} + name_len].decode()
+                    pending = pending[{0} + name_len:]
+                    makedirs(name)
+                    out = open(name, 'wb')
+                    count += 1
+                if flags & {2}:
+                    if len(pending) < left:
+                        break
+                    out.write(inflate(pending[:left]))
+                else:
+                    out.write(pending[:left])
+                n = min(left, len(pending))
+                pending = pending[n:]
+                left -= n
+                if left:
+                    break
+                out.close()
+                out = None
+            sys.stdout.write('\\x06')
+        print(count)
+    """.format(
+        struct.calcsize(BUNDLE_HEADER), BUNDLE_HEADER, FLAG_ZLIB
+    )
+    return textwrap.dedent(command)
+
+
+def bundle_chunks(entries, compress=True, block_size=files.UPLOAD_BLOCK_SIZE):
+    """Yield the bundle of entries, (local path, target path) pairs, in pieces
+    of at most block_size bytes of file data.
+    """
+    for path, target in entries:
+        size = os.path.getsize(path)
+        flags = 0
+        data = None
+        if compress and size <= COMPRESS_MAX:
+            with open(path, 'rb') as f:
+                packed = zlib.compress(f.read(), 9)
+            if len(packed) < size:
+                flags, data, size = FLAG_ZLIB, packed, len(packed)
+        name = target.encode('utf-8')
+        yield struct.pack(BUNDLE_HEADER, flags, len(name), size) + name
+        if data is not None:
+            yield data
+            continue
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                yield block
+
+
+def bundle_lines(chunks, block_size=files.UPLOAD_BLOCK_SIZE):
+    """Regroup the pieces of a bundle into base64 lines of block_size bytes.
+    Yields (bytes in the line, line).
+    """
+    buf = bytearray()
+    for chunk in chunks:
+        buf += chunk
+        while len(buf) >= block_size:
+            yield block_size, binascii.b2a_base64(buf[:block_size])
+            del buf[:block_size]
+    if buf:
+        yield len(buf), binascii.b2a_base64(buf)
+
+
+def put_bundle(fs, entries, compress=None):
+    """Write all entries, (local path, target path) pairs, to the board in one
+    script. compress None means compress if the board can inflate. Returns the
+    number of files written.
+    """
+    total = sum(os.path.getsize(path) for path, target in entries)
+    with fs.session():
+        if compress is None:
+            compress = fs.exec_command(inflate_command()).strip() == b'1'
+
+        def lines():
+            done = 0
+            chunks = bundle_chunks(entries, compress, fs.upload_block_size)
+            for size, line in bundle_lines(chunks, fs.upload_block_size):
+                yield line
+                done += size
+                if fs.progress is not None:
+                    fs.progress(min(done, total), total)
+
+        out = fs.stream_command(unpack_command(), lines(), 'bundle')
+    return int(out.strip() or 0)
@@ -0,0 +1,402 @@
+# devworker.py - target device I/O on a dedicated worker thread.
+#
+# The Pyboard, and with it the QSerialPort or telnet connection, is created and
+# used only on the worker thread. The GUI queues jobs through a DeviceLink and
+# is told about their progress and completion by signals, so the editor, shell
+# and file viewers stay responsive during transfers and soft reboots.
+#
+# Jobs wait in a JobQueue ordered by priority, so REPL keystrokes run before
+# queued transfers and file viewer refreshes run last. Only one job talks to the
+# board at a time, keystrokes typed during a transfer are sent when it is done
+# and never end up in the middle of the raw REPL protocol. A job can be
+# cancelled, a running transfer stops between two blocks, and Ctrl-C in the
+# shell cancels the running job that way.
+#
+import heapq
+import os
+import threading
+from PyQt5.QtCore import QObject, QThread, pyqtSignal, pyqtSlot
+import pyboard
+import files
+import linktune
+import precompile
+import targetcache
+import turbo
+
+# job priorities, lower runs first
+PRIORITY_INTERACTIVE = 0    # REPL keystrokes
+PRIORITY_NORMAL = 1         # user actions
+PRIORITY_BACKGROUND = 2     # file viewer refreshes
+
+
+# Job functions for DeviceLink.submit() that need more than a single call.
+def send_keys(board, fs, data, block_cr, block_echo, block_backspace):
+    # set the echo flags in the same step as the write
+    if block_cr:
+        board.block_cr = True
+    if block_echo:
+        board.block_echo = True
+    if block_backspace:
+        board.block_backspace = True
+    board.serialWrite(data)
+
+
+def hard_reset(board, fs):
+    board.serialOpen()
+    return board.hardReset()
+
+
+def reopen_port(board, fs):
+    if not board.isSerialOpen():
+        board.serialOpen()
+
+
+# Download a local file to target, compiled to .mpy first if precompiler is given
+# and the file is a module. The source of a compiled module is removed from the
+# target if remove_source is True. Returns (target path written, size written).
+def deploy_file(board, fs, path, target, precompiler=None, remove_source=False):
+    name = target.lstrip('/')
+    if precompiler is None or not precompile.wants_compile(name):
+        fs.put(path, target)
+        return target, os.path.getsize(path)
+    with fs.session():
+        precompiler.check_target(int(fs.exec_command(precompile.mpy_version_command())))
+        compiled = precompiler.compile(path, name)
+        fs.put(compiled, '/' + precompile.compiled_name(name))
+        if remove_source:
+            fs.rm(target)
+    return '/' + precompile.compiled_name(name), os.path.getsize(compiled)
+
+
+# Wrap the job function job(board, fs, *args) to run in turbo mode for the MCU type
+# mcu, see turbo.py. mcu None leaves the job as it is.
+def turbo_job(job, mcu):
+    if mcu is None:
+        return job
+
+    def run(board, fs, *args):
+        with turbo.turbo(board, fs, mcu):
+            return job(board, fs, *args)
+    return run
+
+
+# Tune the transfer parameters of the link, see linktune.py. Returns (unique id of
+# the board, parameters).
+def tune_link(board, fs):
+    with fs.session():
+        device_id = fs.exec_command(targetcache.unique_id_command()).decode('utf-8').strip()
+        return device_id, linktune.tune(board, fs)
+
+
+# List a target folder, in the same raw REPL session read the board's unique id
+# first if with_id is True. Returns (unique id or None, listing for targetcache).
+# The number of entries read so far is reported as progress without a total.
+def list_target(board, fs, directory, with_id):
+    with fs.session():
+        device_id = None
+        if with_id:
+            device_id = fs.exec_command(targetcache.unique_id_command()).decode('utf-8').strip()
+        records = []
+        for record in fs.ilist(directory):
+            records.append(record)
+            if fs.progress is not None:
+                fs.progress(len(records), 0)
+        return device_id, targetcache.entries_from_ilist(records)
+
+
+class Job:
+    """A device operation waiting in, or taken from, a JobQueue."""
+
+    def __init__(self, job_id, name, fn, args, priority, key, takes_input=False):
+        self.id = job_id
+        self.name = name
+        self.fn = fn
+        self.args = args
+        self.priority = priority
+        self.key = key              # jobs with the same key are redundant
+        self.takes_input = takes_input      # REPL input goes to the job while it runs
+        self.cancelled = False
+        self.running = False
+        self.done = 0               # last progress report
+        self.total = 0
+
+
+class JobQueue:
+    """Pending jobs ordered by priority, then by submission. Shared by the GUI
+    thread, which adds and cancels jobs, and the worker thread, which takes them.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._heap = []
+        self.current = None         # the job the worker is running
+
+    def push(self, job):
+        with self._lock:
+            heapq.heappush(self._heap, (job.priority, job.id, job))
+
+    def pop(self):
+        """Take the next job that is not cancelled and make it current, or return None."""
+        with self._lock:
+            self.current = None
+            while self._heap:
+                job = heapq.heappop(self._heap)[2]
+                if not job.cancelled:
+                    job.running = True
+                    self.current = job
+                    return job
+            return None
+
+    def cancel(self, job):
+        """Mark job cancelled. Returns True if it was still waiting, pop() then
+        drops it, False if it is already running.
+        """
+        with self._lock:
+            job.cancelled = True
+            return not job.running
+
+    def pop_interactive(self):
+        """Take the next REPL input job, or return None. The current job stays current."""
+        with self._lock:
+            if self._heap and self._heap[0][0] == PRIORITY_INTERACTIVE:
+                return heapq.heappop(self._heap)[2]
+            return None
+
+    def find(self, key):
+        """Return the pending job with key, None if there is none."""
+        with self._lock:
+            for priority, job_id, job in self._heap:
+                if job.key == key and not job.cancelled:
+                    return job
+            return None
+
+    def jobs(self):
+        """The current job, if any, followed by the pending jobs in run order."""
+        with self._lock:
+            pending = [job for priority, job_id, job in sorted(self._heap) if not job.cancelled]
+            current = self.current
+        return ([current] if current is not None else []) + pending
+
+
+class DeviceWorker(QObject):
+    """Owns the Pyboard and Files objects and runs jobs on the worker thread."""
+    shellOutput = pyqtSignal(str)
+    jobStarted = pyqtSignal(int, str)
+    jobProgress = pyqtSignal(int, int, int)      # job id, bytes done, bytes total
+    jobFinished = pyqtSignal(int, object)        # job id, job result
+    jobFailed = pyqtSignal(int, str)             # job id, error message
+    jobCancelled = pyqtSignal(int)
+
+    def __init__(self, queue):
+        super().__init__()
+        self.queue = queue
+        self.board = None
+        self.files = None
+
+    @pyqtSlot(str, str, str)
+    def openBoard(self, device, baud, password):
+        try:
+            self.board = pyboard.Pyboard(None, device, baud, password=password, shell_write=self.shellOutput.emit)
+        except (OSError, pyboard.PyboardError) as ex:
+            # unreachable network board, jobs fail until the link is opened again
+            self.board = self.files = None
+            self.shellOutput.emit('Error: Cannot connect to ' + device + ': ' + str(ex) + '\n')
+            return
+        self.files = files.Files(self.board)
+
+    # run queued jobs until the queue is empty
+    @pyqtSlot()
+    def runPending(self):
+        while True:
+            job = self.queue.pop()
+            if job is None:
+                return
+            self.runJob(job)
+
+    def runJob(self, job):
+        if self.board is None or self.files is None:
+            if job.priority != PRIORITY_INTERACTIVE:
+                self.jobFailed.emit(job.id, '{0} failed: no connection to the target'.format(job.name))
+            return
+        if job.priority != PRIORITY_INTERACTIVE:
+            self.jobStarted.emit(job.id, job.name)
+        self.files.progress = lambda done, total: self.jobProgress.emit(job.id, done, total)
+        self.files.checkpoint = lambda: self._checkpoint(job)
+        try:
+            result = job.fn(self.board, self.files, *job.args)
+        except files.OperationCancelled:
+            self.jobCancelled.emit(job.id)
+        except Exception as ex:
+            self.jobFailed.emit(job.id, '{0} failed: {1}'.format(job.name, ex))
+        else:
+            self.jobFinished.emit(job.id, result)
+        finally:
+            self.files.progress = None
+            self.files.checkpoint = None
+
+    # called by Files between blocks and while following script output
+    def _checkpoint(self, job):
+        if job.cancelled:
+            raise files.OperationCancelled(job.name)
+        if job.takes_input and self.files.script_running:
+            # pass keystrokes through to the running script, not into the
+            # protocol of a transfer the job makes first
+            while True:
+                keys = self.queue.pop_interactive()
+                if keys is None:
+                    break
+                # send_keys() data only: the raw REPL does not echo, echo flags
+                # set now would drop the next output of the friendly REPL
+                self.board.serialWrite(keys.args[0])
+
+    @pyqtSlot()
+    def closeBoard(self):
+        if self.board is not None and self.board.isSerialOpen():
+            self.board.serialClose()
+
+
+class DeviceLink(QObject):
+    """GUI side of the device worker. Jobs are callables fn(board, files, *args)
+    that run on the worker thread by priority, then in submission order, they
+    must not touch any widgets. Their result is passed to done(result) on the
+    GUI thread.
+    """
+    shellOutput = pyqtSignal(str)
+    jobStarted = pyqtSignal(int, str)
+    jobProgress = pyqtSignal(int, int, int)
+    busyChanged = pyqtSignal(bool)
+    queueChanged = pyqtSignal()
+
+    # internal requests, queued across to the worker thread
+    _openRequested = pyqtSignal(str, str, str)
+    _runRequested = pyqtSignal()
+    _closeRequested = pyqtSignal()
+
+    def __init__(self, device, baud, password='python', parent=None):
+        super().__init__(parent)
+        self._next_id = 0
+        self._pending = {}      # job id -> (done, failed) callbacks
+        self._jobs = {}         # job id -> Job, for the jobs in _pending
+        self._queue = JobQueue()
+
+        self._thread = QThread()
+        self._worker = DeviceWorker(self._queue)
+        self._worker.moveToThread(self._thread)
+        self._thread.finished.connect(self._worker.deleteLater)
+
+        self._openRequested.connect(self._worker.openBoard)
+        self._runRequested.connect(self._worker.runPending)
+        self._closeRequested.connect(self._worker.closeBoard)
+        self._worker.shellOutput.connect(self.shellOutput)
+        self._worker.jobStarted.connect(self._jobStarted)
+        self._worker.jobProgress.connect(self._jobProgress)
+        self._worker.jobFinished.connect(self._jobFinished)
+        self._worker.jobFailed.connect(self._jobFailed)
+        self._worker.jobCancelled.connect(self._jobCancelled)
+
+        self._thread.start()
+        self._openRequested.emit(device, str(baud), password)
+
+    def submit(self, name, fn, *args, done=None, failed=None, priority=PRIORITY_NORMAL, key=None,
+               takes_input=False):
+        """Queue fn(board, files, *args) on the worker thread and return its job id.
+        If failed is None a failure is reported in the shell. If a job with the
+        same key is still waiting, no new job is queued: the waiting job's id is
+        returned and its result goes to these callbacks instead. REPL input typed
+        while a job with takes_input runs a script through Files.run_command() is
+        sent to the board right away, for scripts that read it.
+        """
+        if key is not None:
+            job = self._queue.find(key)
+            if job is not None and job.id in self._pending:
+                self._pending[job.id] = (done, failed)
+                return job.id
+        self._next_id += 1
+        job = Job(self._next_id, name, fn, args, priority, key, takes_input)
+        if priority != PRIORITY_INTERACTIVE:
+            self._pending[job.id] = (done, failed)
+            self._jobs[job.id] = job
+            if len(self._pending) == 1:
+                self.busyChanged.emit(True)
+        self._queue.push(job)
+        self._runRequested.emit()
+        self.queueChanged.emit()
+        return job.id
+
+    def write(self, data, block_cr=False, block_echo=False, block_backspace=False):
+        """Queue REPL keystrokes for the target, ahead of any waiting job. Ctrl-C
+        also cancels the running job.
+        """
+        if b'\x03' in data:
+            current = self._queue.current
+            if current is not None and current.priority != PRIORITY_INTERACTIVE:
+                self.cancel(current.id)
+        self.submit('REPL input', send_keys, data, block_cr, block_echo, block_backspace,
+                    priority=PRIORITY_INTERACTIVE)
+
+    def cancel(self, job_id):
+        """Cancel a job. A waiting job is dropped and its callbacks are not called.
+        A running transfer stops at the next block, other running jobs cannot be
+        stopped and finish normally.
+        """
+        job = self._jobs.get(job_id)
+        if job is None or job.cancelled:
+            return
+        if self._queue.cancel(job):
+            self._popJob(job_id)
+            self.shellOutput.emit('\n{0} cancelled\n'.format(job.name))
+
+    def jobs(self):
+        """The running and waiting jobs, see JobQueue.jobs()."""
+        return [job for job in self._queue.jobs() if job.id in self._jobs]
+
+    def isBusy(self):
+        return len(self._pending) > 0
+
+    def shutdown(self):
+        """Cancel all jobs, close the serial port and stop the worker thread. A
+        running script is interrupted, it would keep the worker busy forever.
+        """
+        for job_id in list(self._jobs):
+            self.cancel(job_id)
+        self._closeRequested.emit()
+        self._thread.quit()
+        self._thread.wait()
+
+    def _jobStarted(self, job_id, name):
+        self.jobStarted.emit(job_id, name)
+        self.queueChanged.emit()
+
+    def _jobProgress(self, job_id, done, total):
+        job = self._jobs.get(job_id)
+        if job is not None:
+            job.done, job.total = done, total
+        self.jobProgress.emit(job_id, done, total)
+
+    def _jobFinished(self, job_id, result):
+        if job_id not in self._pending:
+            return
+        done, failed = self._popJob(job_id)
+        if done is not None:
+            done(result)
+
+    def _jobFailed(self, job_id, message):
+        done, failed = self._popJob(job_id)
+        if failed is not None:
+            failed(message)
+        else:
+            self.shellOutput.emit('\n' + message + '\n')
+
+    def _jobCancelled(self, job_id):
+        job = self._jobs.get(job_id)
+        self._popJob(job_id)
+        if job is not None:
+            self.shellOutput.emit('\n{0} cancelled\n'.format(job.name))
+
+    def _popJob(self, job_id):
+        callbacks = self._pending.pop(job_id, (None, None))
+        self._jobs.pop(job_id, None)
+        if not self._pending:
+            self.busyChanged.emit(False)
+        self.queueChanged.emit()
+        return callbacks
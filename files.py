@@ -19,23 +19,206 @@
 # LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
-import ast
+import contextlib
 import textwrap
 import binascii
-#from pyboard import PyboardError
-import pyboard
 import os
+from rawrepl import PyboardError
 
 
-BUFFER_SIZE = 32  # Amount of data to read or write to the serial port at a time.
-# This is kept small because small chips and USB to serial
-# bridges usually have very small buffers.
+DOWNLOAD_BLOCK_SIZE = 4096  # file bytes per line of a streamed download, see get_command()
+UPLOAD_BLOCK_SIZE = 4096    # file bytes per block of a streamed upload, see put_command()
+UPLOAD_ACK = b'\x06'        # sent by the board when it is ready for the next block
 
 
 class DirectoryExistsError(Exception):
     pass
 
 
+class OperationCancelled(Exception):
+    """Raised by Files.checkpoint to stop a transfer between blocks."""
+    pass
+
+
+# The scripts below run on the board in raw REPL mode. They are built by module
+# level functions so that any board interface (Files here, or the asyncio based
+# asyncpyboard.AsyncPyboard) sends exactly the same commands.
+
+def get_command(filename, block_size=DOWNLOAD_BLOCK_SIZE):
+    """Script that writes the size of filename and then its contents to stdout,
+    as base64 lines of block_size bytes and an empty line at the end.
+    """
+    command = """
+        import sys
+        import ubinascii
+        try:
+            import os
+        except ImportError:
+            import uos as os
+        sys.stdout.write('%d\\n' % os.stat('{0}')[6])
+        with open('{0}', 'rb') as infile:
+            while True:
+                result = infile.read({1})
+                if result == b'':
+                    break
+                sys.stdout.write(ubinascii.b2a_base64(result))
+        sys.stdout.write('\\n')
+    """.format(
+        filename, block_size
+    )
+    return textwrap.dedent(command)
+
+
+def ilistdir_command(directory="/", recursive=False):
+    """Script that prints one line '<d or f> <size> <path>' for every entry in
+    directory, and in all folders below it if recursive, and an empty line at
+    the end. Type and size come from os.ilistdir() where the board has it, the
+    folders are walked with a stack so deep trees do not recurse on the board.
+    """
+    command = """
+        try:
+            import os
+        except ImportError:
+            import uos as os
+        def ilistdir(directory, prefix):
+            if hasattr(os, 'ilistdir'):
+                for entry in os.ilistdir(directory):
+                    yield entry
+            else:
+                for name in os.listdir(directory):
+                    st = os.stat(prefix + name)
+                    yield name, st[0], 0, st[6]
+        stack = ['{0}']
+        while stack:
+            directory = stack.pop()
+            prefix = directory.rstrip('/') + '/'
+            for entry in ilistdir(directory, prefix):
+                path = prefix + entry[0]
+                if entry[1] & 0x4000:
+                    print('d 0', path)
+                    if {1}:
+                        stack.append(path)
+                else:
+                    print('f', entry[3] if len(entry) > 3 else os.stat(path)[6], path)
+        print()
+    """.format(
+        directory, recursive
+    )
+    return textwrap.dedent(command)
+
+
+def parse_ilist_line(line):
+    """Parse a line of ilistdir_command() output into (path, is folder, size).
+    Bare-metal ports end the lines with '\r\n'.
+    """
+    kind, size, path = line.decode('utf-8').rstrip('\r\n').split(' ', 2)
+    return path, kind == 'd', int(size)
+
+
+def ls_lines(entries, long_format=True):
+    """Format (path, is folder, size) entries the way Files.ls() returns them."""
+    if long_format:
+        return sorted('{0};{1} bytes'.format(path, size) for path, is_dir, size in entries)
+    return sorted(path for path, is_dir, size in entries)
+
+
+def mkdir_command(directory):
+    command = """
+        try:
+            import os
+        except ImportError:
+            import uos as os
+        os.mkdir('{0}')
+    """.format(
+        directory
+    )
+    return textwrap.dedent(command)
+
+
+def put_command(filename):
+    """Script that receives a file on stdin and writes it to filename. The host
+    sends the file as base64 lines of at most UPLOAD_BLOCK_SIZE decoded bytes
+    and an empty line at the end. The board sends UPLOAD_ACK once the file is
+    open and again after each block has been written, so the host never sends
+    more than one block ahead of the board.
+    """
+    command = """
+        import sys
+        import ubinascii
+        try:
+            stdin = sys.stdin.buffer
+        except AttributeError:
+            stdin = sys.stdin
+        with open('{0}', 'wb') as outfile:
+            sys.stdout.write('\\x06')
+            while True:
+                line = stdin.readline()
+                if len(line) <= 1:
+                    break
+                outfile.write(ubinascii.a2b_base64(line))
+                sys.stdout.write('\\x06')
+    """.format(
+        filename
+    )
+    return textwrap.dedent(command)
+
+
+def upload_blocks(infile, block_size=UPLOAD_BLOCK_SIZE):
+    """Read infile in blocks, yields (block size, base64 line) for put_command()."""
+    while True:
+        block = infile.read(block_size)
+        if not block:
+            break
+        yield len(block), binascii.b2a_base64(block)
+
+
+def rm_command(filename):
+    command = """
+        try:
+            import os
+        except ImportError:
+            import uos as os
+        os.remove('{0}')
+    """.format(
+        filename
+    )
+    return textwrap.dedent(command)
+
+
+def rmdir_command(directory):
+    """Script that forcefully removes directory and all its children."""
+    # Build a script to walk an entire directory structure and delete every
+    # file and subfolder.  This is tricky because MicroPython has no os.walk
+    # or similar function to walk folders, so this code does it manually
+    # with recursion and changing directories.  For each directory it lists
+    # the files and deletes everything it can, i.e. all the files.  Then
+    # it lists the files again and assumes they are directories (since they
+    # couldn't be deleted in the first pass) and recursively clears those
+    # subdirectories.  Finally when finished clearing all the children the
+    # parent directory is deleted.
+    command = """
+        try:
+            import os
+        except ImportError:
+            import uos as os
+        def rmdir(directory):
+            os.chdir(directory)
+            for f in os.listdir():
+                try:
+                    os.remove(f)
+                except OSError:
+                    pass
+            for f in os.listdir():
+                rmdir(f)
+            os.chdir('..')
+            os.rmdir(directory)
+        rmdir('{0}')
+    """.format(
+        directory
+    )
+    return textwrap.dedent(command)
+
+
 class Files(object):
     """Class to interact with a MicroPython board files over a serial connection.
     Provides functions for listing, uploading, and downloading files from the
@@ -49,269 +232,323 @@ class Files(object):
         it in, but you can pass in other objects for testing, etc.
         """
         self._mpboard = mpboard
+        # optional progress(done, total) callback for long transfers
+        self.progress = None
+        # optional checkpoint() callback, called between blocks of a transfer,
+        # that raises OperationCancelled to stop it
+        self.checkpoint = None
+        # True while run_command() follows a running script, which may read stdin
+        self.script_running = False
+        # bytes per block of a streamed upload and download
+        self.upload_block_size = UPLOAD_BLOCK_SIZE
+        self.download_block_size = DOWNLOAD_BLOCK_SIZE
+        self._session_depth = 0
+        self._session_data = b''
 
-    def get(self, filename):
-        """Retrieve the contents of the specified file and return its contents
-        as a byte string.
+    @contextlib.contextmanager
+    def session(self, soft_reset=False):
+        """Context manager that enters the raw REPL once for any number of
+        operations, instead of once per operation:
+
+            with files.session():
+                files.put('main.py')
+                listing = files.ls()
+
+        The board is soft reset on entry only if soft_reset is True. Sessions
+        may be nested, only the outermost one enters and exits the raw REPL.
         """
-        # Open the file and read it a few bytes at a time and print out the
-        # raw bytes.  Be careful not to overload the UART buffer so only write
-        # a few bytes at a time, and don't use print since it adds newlines and
-        # expects string data.
+        if self._session_depth == 0:
+            self._mpboard.ignoreSerial = True
+            self._session_data = self._mpboard.enter_raw_repl(soft_reset=soft_reset)
+        self._session_depth += 1
+        try:
+            yield self
+        finally:
+            self._session_depth -= 1
+            if self._session_depth == 0:
+                self._mpboard.exit_raw_repl()
+                self._mpboard.ignoreSerial = False
+
+    # Enter the raw REPL for one operation, unless a session is already open.
+    # Returns the enter_raw_repl() data, which starts with b'Failed' on error.
+    def _enter(self):
+        if self._session_depth:
+            return self._session_data
         self._mpboard.ignoreSerial = True
-        command = """
-            import sys
-            import ubinascii
-            with open('{0}', 'rb') as infile:
-                while True:
-                    result = infile.read({1})
-                    if result == b'':
-                        break
-                    len = sys.stdout.write(ubinascii.hexlify(result))
-        """.format(
-            filename, BUFFER_SIZE
-        )
-        self._mpboard.enter_raw_repl()
-        #try:
-        out = self._mpboard.exec_(textwrap.dedent(command))
-        # except self._mpboard.PyboardError as ex:
-        #     # Check if this is an OSError #2, i.e. file doesn't exist and
-        #     # rethrow it as something more descriptive.
-        #     try:
-        #         message = ex.args[2].decode("utf-8")
-        #         if message.find("OSError") != -1 and message.find("2") != -1:
-        #             raise RuntimeError("No such file: {0}".format(filename))
-        #         else:
-        #             raise ex
-        #     except UnicodeDecodeError:
-        #         raise ex
-        self._mpboard.exit_raw_repl()
-        self._mpboard.ignoreSerial = False
-        return binascii.unhexlify(out)
+        return self._mpboard.enter_raw_repl()
+
+    def _exit(self):
+        if not self._session_depth:
+            self._mpboard.exit_raw_repl()
+            self._mpboard.ignoreSerial = False
+
+    def get(self, filename, dest=None):
+        """Retrieve the contents of the specified file and return its contents
+        as a byte string. If dest is given the contents are not returned but
+        streamed in blocks to dest, either the name of a local file or a
+        callable that is passed each block of bytes.
+        """
+        if dest is None:
+            data = bytearray()
+            self.get(filename, data.extend)
+            return bytes(data)
+        if isinstance(dest, str):
+            with open(dest, 'wb') as outfile:
+                return self.get(filename, outfile.write)
+
+        webrepl = getattr(self._mpboard, 'webrepl', None)
+        if webrepl is not None:
+            # binary WebREPL transfer, no need for the raw REPL
+            self._webrepl_transfer(webrepl.get_file, filename, dest, self.progress)
+            return
+        self._enter()
+        try:
+            self._start(get_command(filename, self.download_block_size))
+            line = self._read_script_line(filename)
+            size = int(line)
+            done = 0
+            while True:
+                self._checkpoint(True)
+                line = self._read_script_line(filename)
+                if not line.strip():
+                    break
+                block = binascii.a2b_base64(line)
+                dest(block)
+                done += len(block)
+                if self.progress is not None:
+                    self.progress(done, size)
+            self._mpboard.follow(5)
+        finally:
+            self._exit()
+
+    # Give the scheduler a chance to stop the operation between two blocks. If
+    # interrupt is True a running board script is interrupted before raising.
+    def _checkpoint(self, interrupt=False):
+        if self.checkpoint is None:
+            return
+        try:
+            self.checkpoint()
+        except OperationCancelled:
+            if interrupt:
+                self._interrupt()
+            raise
+
+    # stop the script running in the raw REPL and read its output up to the prompt
+    def _interrupt(self):
+        self._mpboard.serialWrite(b'\x03')
+        self._mpboard.follow(1)
+
+    # start a script the caller then reads from or writes to
+    def _start(self, command):
+        if not self._mpboard.exec_raw_no_follow(command):
+            raise RuntimeError('The target did not accept the script')
+
+    # read a line of the output of a get or listing script
+    def _read_script_line(self, filename):
+        line = self._mpboard.read_until(1, b'\n', timeout=5)
+        if b'\x04' in line:
+            # the script failed, its error output follows the first EOF
+            line += self._mpboard.read_until(1, b'\x04', timeout=1)
+            self._mpboard.read_until(1, b'>', timeout=0.1)
+            err = line.split(b'\x04')[1].decode('utf-8', 'replace')
+            raise RuntimeError('Failed to read {0}: {1}'.format(filename, err))
+        if not line.endswith(b'\n'):
+            raise RuntimeError('Timeout reading {0} from the target'.format(filename))
+        return line
 
     def ls(self, directory="/", long_format=True, recursive=False):
         """List the contents of the specified directory (or root if none is
-        specified).  Returns a list of strings with the names of files in the
-        specified directory.  If long_format is True then a list of 2-tuples
-        with the name and size (in bytes) of the item is returned.  Note that
-        it appears the size of directories is not supported by MicroPython and
-        will always return 0 (i.e. no recursive size computation).
+        specified).  Returns a sorted list of strings with the paths of the
+        entries in the specified directory, and in all directories below it if
+        recursive is True.  If long_format is True each string is
+        'path;size bytes', directories have size 0.  If the board can't be
+        reached the list holds the error message, starting with 'Failed'.
         """
+        try:
+            return ls_lines(self.ilist(directory, recursive), long_format)
+        except RuntimeError as ex:
+            msg = str(ex)
+            return [msg if msg.startswith('Failed') else 'Failed - ' + msg]
 
-        # Disabling for now, see https://github.com/adafruit/ampy/issues/55.
-        # # Make sure directory ends in a slash.
-        # if not directory.endswith("/"):
-        #     directory += "/"
-
+    def ilist(self, directory="/", recursive=False):
+        """Generator of (path, is folder, size) for the entries of directory,
+        and of all directories below it if recursive is True, in the order the
+        board lists them. Entries are yielded as they arrive so large trees can
+        be shown while they are listed.
+        """
         # Make sure directory starts with slash, for consistency.
         if not directory.startswith("/"):
             directory = "/" + directory
-
-        self._mpboard.ignoreSerial = True
-
-        command = """\
-                try:        
-                    import os
-                except ImportError:
-                    import uos as os\n"""
-
-        if recursive:
-            command += """\
-                def listdir(directory):
-                    result = set()
-
-                    def _listdir(dir_or_file):
-                        try:
-                            # if its a directory, then it should provide some children.
-                            children = os.listdir(dir_or_file)
-                        except OSError:                        
-                            # probably a file. run stat() to confirm.
-                            os.stat(dir_or_file)
-                            result.add(dir_or_file) 
-                        else:
-                            # probably a directory, add to result if empty.
-                            if children:
-                                # queue the children to be dealt with in next iteration.
-                                for child in children:
-                                    # create the full path.
-                                    if dir_or_file == '/':
-                                        next = dir_or_file + child
-                                    else:
-                                        next = dir_or_file + '/' + child
-                                    
-                                    _listdir(next)
-                            else:
-                                result.add(dir_or_file)                     
-
-                    _listdir(directory)
-                    return sorted(result)\n"""
-        else:
-            command += """\
-                def listdir(directory):
-                    if directory == '/':                
-                        return sorted([directory + f for f in os.listdir(directory)])
-                    else:
-                        return sorted([directory + '/' + f for f in os.listdir(directory)])\n"""
-
-        # Execute os.listdir() command on the board.
-        if long_format:
-            command += """
-                r = []
-                for f in listdir('{0}'):
-                    size = os.stat(f)[6]                    
-                    r.append('{{0}};{{1}} bytes'.format(f, size))
-                print(r)
-            """.format(
-                directory
-            )
-        else:
-            command += """
-                print(listdir('{0}'))
-            """.format(
-                directory
-            )
-        errbytes = self._mpboard.enter_raw_repl()
-        if not errbytes.startswith(b'Failed'):
-            # remove indenting as micropython will auto-indent script
-            out = self._mpboard.exec_(textwrap.dedent(command))
-            self._mpboard.exit_raw_repl()
-            # Parse the result list and return it.
-            self._mpboard.ignoreSerial = False
-            return ast.literal_eval(out.decode("utf-8"))
-        else:
-            self._mpboard.ignoreSerial = False
-            errstr = errbytes.decode('utf-8')       # convert byte array to string
-            return [errstr]
+        errbytes = self._enter()
+        try:
+            if errbytes.startswith(b'Failed'):
+                raise RuntimeError(errbytes.decode('utf-8'))
+            self._start(ilistdir_command(directory, recursive))
+            while True:
+                self._checkpoint(True)
+                line = self._read_script_line(directory)
+                if not line.strip():
+                    break
+                yield parse_ilist_line(line)
+            self._mpboard.follow(5)
+        finally:
+            self._exit()
 
     def mkdir(self, directory, exists_okay=False):
         """Create the specified directory.  Note this cannot create a recursive
         hierarchy of directories, instead each one should be created separately.
+        Raises RuntimeError if the board cannot create it.
         """
         # Execute os.mkdir command on the board.
-        self._mpboard.ignoreSerial = True
-        command = """
+        command = mkdir_command(directory)
+        try:
+            self.exec_command(command)
+        except RuntimeError as ex:
+            if not (exists_okay and '[Errno 17]' in str(ex)):
+                raise
+
+    def put(self, filename, remote_name=None):
+        """ Create or update the specified file, named remote_name on the board
+        if given, otherwise the local name without path in the current folder.
+        """
+        fn = remote_name or os.path.basename(filename)
+        webrepl = getattr(self._mpboard, 'webrepl', None)
+        if webrepl is not None:
+            with open(filename, "rb") as infile:
+                data = infile.read()
+            self._webrepl_transfer(webrepl.put_file, data, fn, self.progress)
+            return
+        # Run a receive loop on the board and stream the file to its stdin from
+        # disk, one block per acknowledge.
+        size = os.path.getsize(filename)
+
+        def lines():
+            done = 0
+            with open(filename, "rb") as infile:
+                for block_size, line in upload_blocks(infile, self.upload_block_size):
+                    yield line
+                    done += block_size
+                    if self.progress is not None:
+                        self.progress(done, size)
+
+        self.stream_command(put_command(fn), lines(), fn)
+
+    def stream_command(self, command, lines, fn):
+        """ Run command, a script that reads stdin line by line and answers each
+        line with UPLOAD_ACK, and send it lines one at a time. An empty line ends
+        the input. Returns the output of the script, errors about the remote file
+        fn raise RuntimeError.
+        """
+        self._enter()
+        try:
+            self._start(command)
+            self._wait_upload_ack(fn)
             try:
-                import os
-            except ImportError:
-                import uos as os
-            os.mkdir('{0}')
-        """.format(
-            directory
-        )
-        self._mpboard.enter_raw_repl()
-        out = self._mpboard.exec_(textwrap.dedent(command))
-
-        self._mpboard.exit_raw_repl()
-        self._mpboard.ignoreSerial = False
-
-    def put(self, filename):
-        """ Create or update the specified file """
-        with open(filename, "rb") as infile:
-            data = infile.read()
-        fn = os.path.basename(filename)     # filename without full path
-        # Open the file for writing on the board and write chunks of data.
+                for line in lines:
+                    self._checkpoint()
+                    self._mpboard.serialWrite(line)
+                    self._wait_upload_ack(fn)
+            except OperationCancelled:
+                self._interrupt()
+                raise
+            self._mpboard.serialWrite(b'\n')     # empty line ends the input
+            out, err = self._mpboard.follow(5)
+            if err:
+                raise RuntimeError('Failed to write {0}: {1}'.format(fn, err.decode('utf-8', 'replace')))
+            return out.decode('utf-8')
+        finally:
+            self._exit()
+
+    def _wait_upload_ack(self, fn):
+        data = self._mpboard.read_until(1, UPLOAD_ACK, timeout=5)
+        if data.endswith(UPLOAD_ACK):
+            return
+        if data.count(b'\x04') >= 2:
+            # the receive loop failed, the error output follows the first EOF
+            err = data.split(b'\x04')[1].decode('utf-8', 'replace')
+            raise RuntimeError('Failed to write {0}: {1}'.format(fn, err))
+        # the board is still waiting for data, interrupt the receive loop
+        self._interrupt()
+        raise RuntimeError('Failed to write {0} on the target'.format(fn))
+
+    def exec_command(self, command):
+        """Run a script on the board and return its output. Raises RuntimeError
+        with the board's error output if the script fails.
+        """
+        self._enter()
+        try:
+            out, err = self._mpboard.exec_raw(command, timeout=10)
+        finally:
+            self._exit()
+        if err:
+            raise RuntimeError(err.decode('utf-8', 'replace'))
+        return out
+
+    def _webrepl_transfer(self, transfer, *args):
         self._mpboard.ignoreSerial = True
-        self._mpboard.enter_raw_repl()
-        self._mpboard.exec_("f = open('{0}', 'wb')".format(fn))
-        size = len(data)
-        # Loop through and write a buffer size chunk of data at a time.
-        for i in range(0, size, BUFFER_SIZE):
-            chunk_size = min(BUFFER_SIZE, size - i)
-            chunk = repr(data[i:i + chunk_size])
-            # Make sure to send explicit byte strings (handles python 2 compatibility).
-            if not chunk.startswith("b"):
-                chunk = "b" + chunk
-            self._mpboard.exec_("f.write({0})".format(chunk))
-        self._mpboard.exec_("f.close()")
-        self._mpboard.exit_raw_repl()
-        self._mpboard.ignoreSerial = False
+        try:
+            return transfer(*args)
+        except PyboardError as ex:
+            raise RuntimeError(str(ex))
+        finally:
+            self._mpboard.ignoreSerial = self._session_depth > 0
 
     def rm(self, filename):
-        self._mpboard.ignoreSerial = True
-        """Remove the specified file or directory."""
-        command = """
-            try:
-                import os
-            except ImportError:
-                import uos as os
-            os.remove('{0}')
-        """.format(
-            filename
-        )
-        self._mpboard.enter_raw_repl()
-        #try:
-        out = self._mpboard.exec_(textwrap.dedent(command))
-        # except self._mpboard.PyboardError as ex:
-        #     message = ex.args[2].decode("utf-8")
-        #     # Check if this is an OSError #2, i.e. file/directory doesn't exist
-        #     # and rethrow it as something more descriptive.
-        #     if message.find("OSError") != -1 and message.find("2") != 1:
-        #         raise RuntimeError("No such file/directory: {0}".format(filename))
-        #     # Check for OSError #13, the directory isn't empty.
-        #     if message.find("OSError") != -1 and message.find("13") != 1:
-        #         raise RuntimeError("Directory is not empty: {0}".format(filename))
-        #     else:
-        #         raise ex
-        self._mpboard.exit_raw_repl()
-        self._mpboard.ignoreSerial = False
+        """Remove the specified file or directory. Raises RuntimeError if the
+        board cannot remove it.
+        """
+        command = rm_command(filename)
+        self.exec_command(command)
 
     def rmdir(self, directory, missing_okay=False):
-        """Forcefully remove the specified directory and all its children."""
-        # Build a script to walk an entire directory structure and delete every
-        # file and subfolder.  This is tricky because MicroPython has no os.walk
-        # or similar function to walk folders, so this code does it manually
-        # with recursion and changing directories.  For each directory it lists
-        # the files and deletes everything it can, i.e. all the files.  Then
-        # it lists the files again and assumes they are directories (since they
-        # couldn't be deleted in the first pass) and recursively clears those
-        # subdirectories.  Finally when finished clearing all the children the
-        # parent directory is deleted.
-        self._mpboard.ignoreSerial = True
-        command = """
-            try:
-                import os
-            except ImportError:
-                import uos as os
-            def rmdir(directory):
-                os.chdir(directory)
-                for f in os.listdir():
-                    try:
-                        os.remove(f)
-                    except OSError:
-                        pass
-                for f in os.listdir():
-                    rmdir(f)
-                os.chdir('..')
-                os.rmdir(directory)
-            rmdir('{0}')
-        """.format(
-            directory
-        )
-        self._mpboard.enter_raw_repl()
-        out = self._mpboard.exec_(textwrap.dedent(command))
-        self._mpboard.exit_raw_repl()
-        self._mpboard.ignoreSerial = False
+        """Forcefully remove the specified directory and all its children.
+        Raises RuntimeError if the board cannot remove it.
+        """
+        command = rmdir_command(directory)
+        try:
+            self.exec_command(command)
+        except RuntimeError as ex:
+            if not (missing_okay and '[Errno 2]' in str(ex)):
+                raise
 
     def run(self, filename, wait_output=True, stream_output=True):
         """Run the provided script and return its output.  If wait_output is True
         (default) then wait for the script to finish and then return its output,
         otherwise just run the script and don't wait for any output.
-        If stream_output is True(default) then return None and print outputs to
-        stdout without buffering.
+        If stream_output is True(default) then return None and pass the output
+        to the shell as it arrives, for as long as the script runs.  The script
+        is interrupted if checkpoint raises OperationCancelled.
         """
-        self._mpboard.ignoreSerial = True
-        self._mpboard.enter_raw_repl()
+        self._enter()
         out = None
-        if stream_output:
-            self._mpboard.execfile(filename, stream_output=True)
-        elif wait_output:
-            # Run the file and wait for output to return.
-            out = self._mpboard.execfile(filename)
-        else:
-            # Read the file and run it using lower level pyboard functions that
-            # won't wait for it to finish or return output.
-            with open(filename, "rb") as infile:
-                self._mpboard.exec_raw_no_follow(infile.read())
-        self._mpboard.exit_raw_repl()
-        self._mpboard.ignoreSerial = False
+        try:
+            if stream_output:
+                with open(filename, "rb") as infile:
+                    self.run_command(infile.read())
+            elif wait_output:
+                # Run the file and wait for output to return.
+                out = self._mpboard.execfile(filename)
+            else:
+                # Read the file and run it using lower level pyboard functions that
+                # won't wait for it to finish or return output.
+                with open(filename, "rb") as infile:
+                    self._mpboard.exec_raw_no_follow(infile.read())
+        finally:
+            self._exit()
         return out
+
+    def run_command(self, command):
+        """Run command, passing its output to the shell as it arrives, for as
+        long as it runs.  The script is interrupted if checkpoint raises
+        OperationCancelled.
+        """
+        self._enter()
+        self.script_running = True
+        try:
+            self._mpboard.exec_(command, stream_output=True, checkpoint=self._checkpoint)
+        except OperationCancelled:
+            self._interrupt()
+            raise
+        finally:
+            self.script_running = False
+            self._exit()
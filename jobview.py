@@ -0,0 +1,76 @@
+# jobview.py - view of the target device job queue.
+#
+# Lists the running and waiting jobs of a devworker.DeviceLink with their
+# progress, and cancels the selected job. The view follows the queue through
+# the link's signals, it never touches the worker thread itself.
+#
+from PyQt5.QtCore import Qt
+from PyQt5.QtWidgets import QDialog, QHBoxLayout, QPushButton, QTreeWidget, QTreeWidgetItem, QVBoxLayout
+import devworker
+
+PRIORITY_NAMES = {devworker.PRIORITY_INTERACTIVE: 'REPL',
+                  devworker.PRIORITY_NORMAL: 'Normal',
+                  devworker.PRIORITY_BACKGROUND: 'Background'}
+
+
+class JobQueueView(QDialog):
+    def __init__(self, link, parent=None):
+        super().__init__(parent)
+        self.link = link
+        self.setWindowTitle('Target Jobs')
+        self.setMinimumWidth(450)
+
+        self.jobTree = QTreeWidget()
+        self.jobTree.setColumnCount(3)
+        self.jobTree.setHeaderItem(QTreeWidgetItem(['Job', 'Priority', 'Status']))
+        self.jobTree.setColumnWidth(0, 220)
+        self.jobTree.setRootIsDecorated(False)
+
+        self.cancelButton = QPushButton('Cancel Job')
+        self.cancelButton.setToolTip('Cancel the selected job')
+        self.cancelButton.clicked.connect(self.cancelJob)
+        closeButton = QPushButton('Close')
+        closeButton.clicked.connect(self.close)
+
+        hLayout = QHBoxLayout()
+        hLayout.addStretch()
+        hLayout.addWidget(self.cancelButton)
+        hLayout.addWidget(closeButton)
+        vLayout = QVBoxLayout()
+        vLayout.addWidget(self.jobTree)
+        vLayout.addLayout(hLayout)
+        self.setLayout(vLayout)
+
+        link.queueChanged.connect(self.refresh)
+        link.jobProgress.connect(self.refresh)
+        self.refresh()
+
+    # rebuild the list from the link, keeping the selected job selected
+    def refresh(self, *args):
+        current = self.jobTree.currentItem()
+        selected = current.data(0, Qt.UserRole) if current is not None else None
+        self.jobTree.clear()
+        for job in self.link.jobs():
+            if not job.running:
+                status = 'waiting'
+            elif job.cancelled:
+                status = 'cancelling'
+            elif job.total > 0:
+                status = '{0}%'.format(job.done * 100 // job.total)
+            elif job.done > 0:
+                status = 'running, {0}'.format(job.done)
+            else:
+                status = 'running'
+            item = QTreeWidgetItem([job.name, PRIORITY_NAMES.get(job.priority, ''), status])
+            item.setData(0, Qt.UserRole, job.id)
+            self.jobTree.addTopLevelItem(item)
+            if job.id == selected:
+                self.jobTree.setCurrentItem(item)
+        self.cancelButton.setEnabled(self.jobTree.topLevelItemCount() > 0)
+
+    def cancelJob(self):
+        item = self.jobTree.currentItem()
+        if item is None and self.jobTree.topLevelItemCount() > 0:
+            item = self.jobTree.topLevelItem(0)
+        if item is not None:
+            self.link.cancel(item.data(0, Qt.UserRole))
@@ -0,0 +1,147 @@
+# linktune.py - transfer parameters tuned to the link to a board.
+#
+# The block sizes of streamed uploads and downloads and the pacing of script
+# writes to firmware without raw-paste mode are chosen for the slowest links.
+# tune() probes the link with increasing block sizes and faster pacing, each
+# setting PROBE_RUNS times with a PROBE_SIZE file whose copy is checked, and
+# stops at the first setting that fails or is not clearly faster. It returns the
+# fastest setting that worked. The GUI keeps the result per port, USB VID:PID
+# and board id in the settings and applies it whenever it finds that board on
+# that port again.
+#
+import os
+import tempfile
+import textwrap
+import time
+import files
+import sync
+
+UPLOAD_BLOCK_SIZES = (1024, 2048, 4096, 8192, 16384)
+DOWNLOAD_BLOCK_SIZES = (1024, 2048, 4096, 8192, 16384)
+# (write_chunk_size, write_pause) for firmware without raw-paste mode
+PACING = ((256, 0.01), (512, 0.005), (1024, 0.002), (4096, 0.0))
+PROBE_SIZE = 8192
+PROBE_RUNS = 2
+MIN_GAIN = 0.05     # a setting must be this much faster than the last to be taken
+PROBE_FILE = '/.linktune.bin'
+
+DEFAULTS = {
+    'upload_block_size': files.UPLOAD_BLOCK_SIZE,
+    'download_block_size': files.DOWNLOAD_BLOCK_SIZE,
+    'write_chunk_size': 256,
+    'write_pause': 0.01,
+}
+
+
+def link_key(port, vid_pid, device_id):
+    """Settings key of the link to board device_id on port, through a USB
+    device vid_pid ('1a86:7523', '' if unknown).
+    """
+    return '{0}|{1}|{2}'.format(port, vid_pid, device_id)
+
+
+def digest_command(path):
+    """Script that prints the hash algorithm of the board and the hash of path."""
+    command = sync.HASH_PRELUDE + """
+        print('sha256' if hashlib else 'crc32', digest('{0}'))
+    """.format(
+        path
+    )
+    return textwrap.dedent(command)
+
+
+def apply(board, fs, params=None):
+    """Set the transfer parameters params, DEFAULTS for those not given. Also a
+    job function for devworker.DeviceLink.submit().
+    """
+    params = dict(DEFAULTS, **(params or {}))
+    fs.upload_block_size = params['upload_block_size']
+    fs.download_block_size = params['download_block_size']
+    board.write_chunk_size = params['write_chunk_size']
+    board.write_pause = params['write_pause']
+
+
+def current(board, fs):
+    """The transfer parameters in use, as a dict for apply()."""
+    return {
+        'upload_block_size': fs.upload_block_size,
+        'download_block_size': fs.download_block_size,
+        'write_chunk_size': board.write_chunk_size,
+        'write_pause': board.write_pause,
+    }
+
+
+# Run probe(candidate) PROBE_RUNS times for each candidate in turn. Returns the
+# fastest candidate, or None if the first one fails. probe returns True if the
+# data arrived intact, RuntimeError counts as a failure.
+def _fastest(candidates, probe, step):
+    best = best_time = None
+    for candidate in candidates:
+        elapsed = None
+        for run in range(PROBE_RUNS):
+            start = time.time()
+            try:
+                ok = probe(candidate)
+            except RuntimeError:
+                ok = False
+            if not ok:
+                return best
+            elapsed = min(elapsed or 1e9, time.time() - start)
+        step()
+        if best_time is not None and elapsed > best_time * (1 - MIN_GAIN):
+            break
+        best, best_time = candidate, elapsed
+    return best
+
+
+def tune(board, fs):
+    """Probe the link and return the fastest transfer parameters that work, as
+    a dict for apply(). They are left applied. Also a job function for
+    devworker.DeviceLink.submit(), fs.progress is told the probes done.
+    """
+    progress, fs.progress = fs.progress, None
+    steps = [0, len(UPLOAD_BLOCK_SIZES) + len(DOWNLOAD_BLOCK_SIZES)]
+
+    def step():
+        steps[0] += 1
+        if progress is not None:
+            progress(*steps)
+
+    data = os.urandom(PROBE_SIZE)
+    fd, local = tempfile.mkstemp(suffix='.bin')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    params = current(board, fs)
+    try:
+        with fs.session():
+            def upload(block_size):
+                fs.upload_block_size = block_size
+                fs.put(local, PROBE_FILE)
+                algo, digest = fs.exec_command(digest_command(PROBE_FILE)).decode('utf-8').split()
+                return digest == sync.local_digest(local, algo)
+            params['upload_block_size'] = _fastest(UPLOAD_BLOCK_SIZES, upload, step) or params['upload_block_size']
+            apply(board, fs, params)
+            fs.put(local, PROBE_FILE)       # the last probe may have left a broken copy
+
+            def download(block_size):
+                fs.download_block_size = block_size
+                return fs.get(PROBE_FILE) == data
+            params['download_block_size'] = _fastest(DOWNLOAD_BLOCK_SIZES, download, step) or params['download_block_size']
+
+            if not board.use_raw_paste:
+                steps[1] += len(PACING)
+                script = "s = '{0}'\nprint(len(s))\n".format('u' * (PROBE_SIZE // 4))
+
+                def pacing(candidate):
+                    board.write_chunk_size, board.write_pause = candidate
+                    return fs.exec_command(script).strip() == str(PROBE_SIZE // 4).encode()
+                best = _fastest(PACING, pacing, step)
+                if best is not None:
+                    params['write_chunk_size'], params['write_pause'] = best
+            apply(board, fs, params)
+            fs.rm(PROBE_FILE)
+    finally:
+        apply(board, fs, params)
+        fs.progress = progress
+        os.remove(local)
+    return params
@@ -31,8 +31,14 @@ import codecs
 import mpconfig
 import ntpath
 import settings
-import pyboard
-import files
+import devworker
+import shellbuffer
+import jobview
+import sync
+import precompile
+import targetcache
+import runcache
+import linktune
 import asyncio
 
 
@@ -271,12 +277,27 @@ class pyEditor(QMainWindow):
 
         # Instantiate settings class
         self.setx = settings.Settings()
+        # target output is batched into frames and the scrollback is limited
+        self.shellBuffer = shellbuffer.ShellBuffer(self.shellText, self.setx.getShellScrollback(), self)
+        self.setx.shellScrollbackChanged.connect(self.shellBuffer.setMaximumBlockCount)
         _device = self.setx.getSerialPort()
         _baud = self.setx.getBaudRate()
-        self.mpBoard = pyboard.Pyboard(self.shellText, _device, _baud)
-        self.mpCmds = files.Files(self.mpBoard)
+        # all target I/O runs on the device worker thread
+        self.device = devworker.DeviceLink(_device, _baud, self.setx.getWebReplPassword())
+        self.device.shellOutput.connect(self.shellTextWrite)
+        self.device.jobStarted.connect(self.deviceJobStarted)
+        self.device.jobProgress.connect(self.deviceJobProgress)
+        self.device.busyChanged.connect(self.deviceBusyChanged)
+        self.deviceJobName = ''
+        self.jobQueueView = None
+        self.runJobId = None
 
         self.TargetFileList = []
+        # cached target file tree, shown right away and listed again when stale
+        self.targetCache = targetcache.TargetCache(os.path.join(self.setx.getAppPath(), '.cache'))
+        self.targetCache.load(self.targetCache.last_device(self.setx.getSerialPort()))
+        self.targetIdentified = False
+        self.targetExpanded = set()     # target folders open in the viewer
 
         # create tabbed editor list
         self.tabsList = QTabWidget()
@@ -329,6 +350,8 @@ class pyEditor(QMainWindow):
         self.targetFileViewer.addTopLevelItem(targ1)
         self.targetFileViewer.expandAll()
         self.targetFileViewer.itemDoubleClicked.connect(self.targetFileViewerDblClicked)
+        self.targetFileViewer.itemExpanded.connect(self.targetFolderExpanded)
+        self.targetFileViewer.itemCollapsed.connect(self.targetFolderCollapsed)
         self.targetFileViewer.setContextMenuPolicy(Qt.PreventContextMenu)   #Qt.CustomContextMenu)
         # self.targetFileViewer.customContextMenuRequested.connect(self.targetViewerContextMenu)
 
@@ -423,6 +446,12 @@ class pyEditor(QMainWindow):
         self.downloadScriptAct = QAction("&Download File to Target", self, shortcut='', triggered=self.downloadScript)
         self.downloadScriptAct.setIcon(QIcon.fromTheme(self.setx.getAppPath() + "/icons/download"))
 
+        self.syncProjectAct = QAction("&Sync Project to Target", self, shortcut='', triggered=self.syncProject)
+        self.syncProjectAct.setIcon(QIcon.fromTheme(self.setx.getAppPath() + "/icons/restart"))
+
+        self.jobQueueAct = QAction("Target &Jobs", self, shortcut='', triggered=self.showJobQueue)
+        self.jobQueueAct.setIcon(QIcon.fromTheme(self.setx.getAppPath() + "/icons/info"))
+
         self.uploadScriptAct = QAction("&Upload File from Target", self, shortcut='', triggered=self.uploadScript)
         self.uploadScriptAct.setIcon(QIcon.fromTheme(self.setx.getAppPath() + "/icons/upload"))
 
@@ -693,6 +722,8 @@ class pyEditor(QMainWindow):
         self.settings_menu = menu_bar.addMenu("Settings")
         self.settings_menu.setStyleSheet(stylesheet2(self))
         self.settings_menu.addAction(QIcon.fromTheme(self.setx.getAppPath() + "/icons/settings"), "&Settings Menu", self.settingsmenu)
+        self.settings_menu.addAction(QIcon.fromTheme(self.setx.getAppPath() + "/icons/connect"), "&Tune Target Link",
+                                     self.tuneTargetLink)
         self.settings_menu.addSeparator()
 
         ### Top level menu bar 'Help'
@@ -770,6 +801,11 @@ class pyEditor(QMainWindow):
         mptb.addSeparator()
         mptb.addAction(self.downloadScriptAct)
 
+        ### Sync Project to Target Button
+        mptb.addSeparator()
+        mptb.addAction(self.syncProjectAct)
+        mptb.addAction(self.jobQueueAct)
+
         ### Upload File from Target Button
         mptb.addSeparator()
         mptb.addAction(self.uploadScriptAct)
@@ -894,7 +930,7 @@ class pyEditor(QMainWindow):
         if baud:
             indx = self.baudrates.findText(baud)
             self.baudrates.setCurrentIndex(indx)
-            self.mpBoard.setSerialPortBaudrate(baud)
+            self.device.submit('Set baudrate', lambda board, fs: board.setSerialPortBaudrate(baud))
 
         comport = self.setx.getSerialPort()
         if comport:
@@ -903,7 +939,7 @@ class pyEditor(QMainWindow):
                 self.comportfield.addItem(comport)
                 indx = self.comportfield.count() -1
             self.comportfield.setCurrentIndex(indx)
-            self.mpBoard.setSerialPortName(comport)
+            self.device.submit('Set serial port', lambda board, fs: board.setSerialPortName(comport))
 
     def textSelectAll(self):
         mpconfig.editorList[mpconfig.currentTabIndex].selectAll()
@@ -1265,16 +1301,14 @@ class pyEditor(QMainWindow):
         if event.type() == QEvent.KeyPress and obj is self.shellText:
             if self.shellText.hasFocus():
                 if event.key() == Qt.Key_Return:
-                    self.mpBoard.block_cr = True
-                    self.mpBoard.serialWrite(b'\x0D')
+                    self.device.write(b'\x0D', block_cr=True)
                 elif event.key() == Qt.Key_Backspace:
-                    self.mpBoard.serialWrite(b'\x08')
+                    self.device.write(b'\x08', block_backspace=True)
                 elif event.key() == Qt.Key_Up:
                     print(event.key())
-                    self.mpBoard.serialWrite(b'\x2191')
+                    self.device.write(b'\x2191')
                 else:
-                    self.mpBoard.block_echo = True
-                    self.mpBoard.serialWrite(bytes(event.text(), 'utf-8'))
+                    self.device.write(bytes(event.text(), 'utf-8'), block_echo=True)
         return super().eventFilter(obj, event)
 
     # Project File Viewer was double clicked
@@ -1286,68 +1320,203 @@ class pyEditor(QMainWindow):
             mpconfig.editorList[mpconfig.currentTabIndex].textHasChanged = False
 
     def targetFileViewerDblClicked(self, index):
-        titem = self.targetFileViewer.currentItem().text(0)
-        # ignore dbl click on serial port name
-        if titem != self.setx.getSerialPort():
-            self.uploadScript(titem)
+        item = self.targetFileViewer.currentItem()
+        path = item.data(0, Qt.UserRole)
+        # dbl click on serial port name lists the target files again, folders just expand
+        if item.parent() is None:
+            self.viewTargetFiles(True)
+        elif path and not item.data(1, Qt.UserRole):
+            self.uploadScript(path.lstrip('/'))
 
     # Reset ESP32 target device by asserting DTR
     def resetTargetDevice(self):
         self.shellTextAppend('\n<Reset Target>\n', False)
-        self.mpBoard.serialOpen()
-        data = self.mpBoard.hardReset()
+        self.device.submit('Reset target', devworker.hard_reset, done=self.resetTargetDone)
+
+    def resetTargetDone(self, data):
         if data == b'':
             return
         datastr = str(data, 'utf-8')
         self.shellTextAppend(datastr, True)     # show target response after reset
-        time.sleep(0.1)
         self.shellTextAppend('\n<Display Target Files>\n', True)  # show target response after reset
+        self.targetCache.invalidate()
         self.viewTargetFiles()
 
     def shellTextAppend(self, text='', focus=False):
+        self.shellBuffer.flush()        # keep target output that came before in order
         self.shellText.moveCursor(self.cursor.End)
         self.shellText.insertPlainText(text)
         self.shellText.moveCursor(self.cursor.End)
         if focus:
             self.shellText.setFocus()
 
-
-    def viewTargetFiles(self):
+    # target output from the device worker, rendered in batches by the shell buffer
+    def shellTextWrite(self, text):
+        self.shellBuffer.write(text)
+
+    def deviceJobStarted(self, job_id, name):
+        self.deviceJobName = name
+        self.statusBar().showMessage('Target: ' + name + '...')
+
+    def deviceJobProgress(self, job_id, done, total):
+        if total > 0:
+            self.statusBar().showMessage('Target: {0}... {1}%'.format(self.deviceJobName, done * 100 // total))
+        elif done > 0:
+            self.statusBar().showMessage('Target: {0}... {1}'.format(self.deviceJobName, done))
+
+    # show the running and waiting target jobs
+    def showJobQueue(self):
+        if self.jobQueueView is None:
+            self.jobQueueView = jobview.JobQueueView(self.device, self)
+        self.jobQueueView.show()
+        self.jobQueueView.raise_()
+
+    def deviceBusyChanged(self, busy):
+        if not busy:
+            self.statusBar().showMessage('Target: ready', 3000)
+
+    # show the cached target files, then list the target root if the cache is stale or force is True
+    def viewTargetFiles(self, force=False):
+        self.showTargetFiles()
+        if force or not self.targetIdentified or self.targetCache.is_stale('/'):
+            self.device.submit('List target files', devworker.list_target, '/', not self.targetIdentified,
+                               done=self.targetFilesListed, failed=self.targetListFailed,
+                               priority=devworker.PRIORITY_BACKGROUND, key='list /')
+
+    def targetFilesListed(self, result):
+        device_id, entries = result
+        if device_id is not None:
+            self.targetIdentified = True
+            device_id = self.targetDeviceId(device_id)
+            if device_id != self.targetCache.device_id:
+                self.targetCache.load(device_id)
+                self.targetCache.set_last_device(self.setx.getSerialPort(), device_id)
+            # use the transfer parameters tuned for this board on this port, if any
+            self.device.submit('Apply link settings', linktune.apply, self.setx.getLinkParams(self.targetLinkKey()))
+        self.targetCache.set_listing('/', entries)
+        self.targetCache.save()
+        self.showTargetFiles()
+
+    # cache id of the target from its unique id, '-' for boards that have none
+    def targetDeviceId(self, unique_id):
+        if unique_id == '-':
+            return 'port-' + re.sub(r'\W', '_', self.setx.getSerialPort())
+        return unique_id
+
+    # settings key of the link to the target with cache id device_id, see linktune.link_key()
+    def targetLinkKey(self, device_id=None):
+        port = self.setx.getSerialPort()
+        info = QSerialPortInfo(port)
+        vid_pid = ''
+        if info.hasVendorIdentifier() and info.hasProductIdentifier():
+            vid_pid = '{0:04x}:{1:04x}'.format(info.vendorIdentifier(), info.productIdentifier())
+        return linktune.link_key(port, vid_pid, device_id or self.targetCache.device_id)
+
+    # probe the link to the target for the fastest transfer parameters that work
+    def tuneTargetLink(self):
+        self.shellTextAppend('\nTuning the target link, this takes a while...\n', False)
+        self.device.submit('Tune target link', devworker.tune_link, done=self.targetLinkTuned)
+
+    def targetLinkTuned(self, result):
+        device_id, params = result
+        self.setx.setLinkParams(self.targetLinkKey(self.targetDeviceId(device_id)), params)
+        self.shellTextAppend('\nTarget link: {0} byte upload blocks, {1} byte download blocks\n'.format(
+            params['upload_block_size'], params['download_block_size']), False)
+
+    def targetListFailed(self, message):
+        self.shellTextAppend('\nFailed to upload target files!\n' + message + '\n', False)
+
+    # a download, remove or new folder finished, update the cached tree in place
+    def targetFilesChanged(self, update, *args):
+        getattr(self.targetCache, update)(*args)
+        self.targetCache.save()
+        self.showTargetFiles()
+
+    # rebuild the target viewer from the cache, reopening the folders that were open
+    def showTargetFiles(self):
         self.targetFileViewer.clear()
-        self.TargetFileList.clear()
-        QApplication.setOverrideCursor(Qt.WaitCursor)
-        self.TargetFileList = self.mpCmds.ls('/', True, False)
-        if self.TargetFileList:
-            if self.TargetFileList[0].startswith('Failed'):
-                self.shellTextAppend('\nFailed to upload target files!\n', False)
-                QApplication.restoreOverrideCursor()
-                return
+        entries = self.targetCache.listing('/') or {}
+        self.TargetFileList = ['/{0};{1} bytes'.format(name, entries[name][1]) for name in sorted(entries)]
 
         targ1 = QTreeWidgetItem([self.setx.getSerialPort()])
         targ1.setIcon(0, QIcon(self.setx.getAppPath() + "/icons/connect"))
-        # show files in target root directory
-        for i in range(len(self.TargetFileList)):
-            if self.TargetFileList[i] == '':        # exit if bogus file
-                break
-
-            fn = self.TargetFileList[i].split(';', 1)   # split filename & file size
-            # if the target name starts with '/' it's assumed to be a folder
-            if fn[0].startswith('/', 0, 1) and fn[0].find('.') == -1:
-                targ1_child = QTreeWidgetItem([fn[0], ''])
-                targ1_child.setIcon(0, QIcon(self.setx.getAppPath() + "/icons/folder"))
-            else:
-                fn[0] = fn[0].replace('/', '', 1)
-                if len(fn) > 1:
-                    targ1_child = QTreeWidgetItem([fn[0], fn[1]])
-                else:
-                    targ1_child = QTreeWidgetItem([fn[0], ''])
-                targ1_child.setIcon(0, QIcon(self.setx.getAppPath() + "/icons/file"))
-            targ1.addChild(targ1_child)
-
         self.targetFileViewer.addTopLevelItem(targ1)
+        self.fillTargetFolder(targ1, '/')
         self.targetFileViewer.setColumnWidth(0, 170)  # set col 0 size so file names aren't cropped
-        self.targetFileViewer.expandAll()
-        QApplication.restoreOverrideCursor()
+        targ1.setExpanded(True)
+
+        expanded = self.targetExpanded
+        self.targetExpanded = set()
+        for path in sorted(expanded, key=len):      # parents before their subfolders
+            item = self.findTargetItem(path)
+            if item is not None:
+                item.setExpanded(True)
+
+    # replace the children of a folder item with the cached listing of directory.
+    # Subfolders get a placeholder child, they are listed when they are expanded.
+    def fillTargetFolder(self, parent, directory):
+        parent.takeChildren()
+        entries = self.targetCache.listing(directory)
+        if entries is None:
+            parent.addChild(QTreeWidgetItem(['Loading...', '']))
+            return
+        for name in sorted(entries):
+            kind, size, digest = entries[name]
+            path = targetcache.join_path(directory, name)
+            if kind == targetcache.DIR:
+                child = QTreeWidgetItem(['/' + name, ''])
+                child.setIcon(0, QIcon(self.setx.getAppPath() + "/icons/folder"))
+                child.setData(1, Qt.UserRole, True)
+                child.addChild(QTreeWidgetItem(['Loading...', '']))
+            else:
+                child = QTreeWidgetItem([name, '{0} bytes'.format(size)])
+                child.setIcon(0, QIcon(self.setx.getAppPath() + "/icons/file"))
+            child.setData(0, Qt.UserRole, path)
+            parent.addChild(child)
+
+    def findTargetItem(self, path):
+        if self.targetFileViewer.topLevelItemCount() == 0:
+            return None
+        item = self.targetFileViewer.topLevelItem(0)
+        for name in path.strip('/').split('/'):
+            for i in range(item.childCount()):
+                if item.child(i).data(0, Qt.UserRole) == targetcache.join_path(item.data(0, Qt.UserRole) or '/', name):
+                    item = item.child(i)
+                    break
+            else:
+                return None
+        return item
+
+    # show the cached children of an opened folder, list it on the target if it is stale
+    def targetFolderExpanded(self, item):
+        path = item.data(0, Qt.UserRole)
+        if not path or not item.data(1, Qt.UserRole):
+            return
+        self.targetExpanded.add(path)
+        self.fillTargetFolder(item, path)
+        if self.targetCache.is_stale(path):
+            self.device.submit('List ' + path, devworker.list_target, path, False,
+                               done=lambda result: self.targetFolderListed(path, result),
+                               failed=lambda message: self.targetFolderListed(path, None, message),
+                               priority=devworker.PRIORITY_BACKGROUND, key='list ' + path)
+
+    def targetFolderCollapsed(self, item):
+        self.targetExpanded.discard(item.data(0, Qt.UserRole))
+
+    def targetFolderListed(self, path, result, message=None):
+        if result is None:
+            self.targetListFailed(message)
+            item = self.findTargetItem(path)
+            if item is not None and self.targetCache.listing(path) is None:
+                # replace the placeholder, the folder is listed again when it is reopened
+                item.takeChildren()
+                item.addChild(QTreeWidgetItem(['List failed', '']))
+            return
+        self.targetCache.set_listing(path, result[1])
+        self.targetCache.save()
+        item = self.findTargetItem(path)
+        if item is not None and item.isExpanded():
+            self.fillTargetFolder(item, path)
 
     # Run current script on target device (file not downloaded)
     def runTargetScript(self):
@@ -1371,17 +1540,21 @@ class pyEditor(QMainWindow):
         if len(fname) == 0:
             return
 
-        QApplication.setOverrideCursor(Qt.WaitCursor)
         self.setx.setCurTargetScript(fname)
 
         self.shellTextAppend('\nStarting script: ' + fname + '\n', False)
-        self.mpCmds.run(fname, False, False)
-        QApplication.restoreOverrideCursor()
-
+        # the output is shown as it arrives and REPL input goes to the script until it ends.
+        # The board keeps a copy of the script, so it is only sent again after an edit.
+        self.runJobId = self.device.submit('Run ' + os.path.basename(fname),
+                                           lambda board, fs: runcache.run_cached(fs, fname), takes_input=True)
+        self.targetCache.invalidate()       # the script may change the target files
 
     def stopTargetScript(self):
         self.shellTextAppend("Stopping current script " + self.setx.getCurTargetScript() + "\n", False)
-        self.mpBoard.stopScript()
+        if self.runJobId in [job.id for job in self.device.jobs()]:
+            self.device.cancel(self.runJobId)
+        else:
+            self.device.submit('Stop script', lambda board, fs: board.stopScript())
 
     def downloadScript(self):
         hl_file = ''
@@ -1401,11 +1574,69 @@ class pyEditor(QMainWindow):
         filename = dialog.selectedFiles()
         fname = str(filename[0])
 
-        QApplication.setOverrideCursor(Qt.WaitCursor)
         if len(fname) > 0:
-            self.mpCmds.put(fname)
-            self.viewTargetFiles()
-        QApplication.restoreOverrideCursor()
+            target = '/' + os.path.basename(fname)
+            precompiler = self.targetPrecompiler()
+            entries = self.targetCache.listing('/') or {}
+            remove_source = os.path.basename(fname) in entries
+            self.device.submit('Download ' + os.path.basename(fname),
+                               devworker.turbo_job(lambda board, fs: devworker.deploy_file(
+                                   board, fs, fname, target, precompiler(), remove_source), self.targetTurbo()),
+                               done=lambda result: self.downloadScriptDone(target, result))
+
+    def downloadScriptDone(self, target, result):
+        deployed, size = result
+        if deployed != target and self.targetCache.listing('/') is not None:
+            self.targetCache.remove(target)     # the source of a precompiled module was removed
+        self.targetFilesChanged('update_file', deployed, size)
+
+    # Returns a function that makes the Precompiler for the target MCU, or None if
+    # modules are not precompiled. It is called in the device job, so a missing
+    # mpy-cross is reported as a job failure.
+    def targetPrecompiler(self):
+        if not self.setx.getPrecompile():
+            return lambda: None
+        cache_dir = os.path.join(self.setx.getAppPath(), '.cache')
+        mcu = self.setx.getMCU()
+        return lambda: precompile.Precompiler(cache_dir, mcu)
+
+    # MCU type for devworker.turbo_job(), None if turbo transfers are off
+    def targetTurbo(self):
+        if not self.setx.getTurbo():
+            return None
+        return self.setx.getMCU() or None
+
+    # upload new and changed project files to the target
+    def syncProject(self):
+        proj_path = self.setx.getProjectPath() + '/' + self.setx.getCurProjectName()
+        if not self.setx.getCurProjectName() or not os.path.isdir(proj_path):
+            QMessageBox.warning(self, 'Sync Project', 'No project is open.', QMessageBox.Ok, QMessageBox.Ok)
+            return
+        answer = QMessageBox.question(self, 'Sync Project',
+                                      'Also remove target files that are not in the project?',
+                                      QMessageBox.Yes | QMessageBox.No | QMessageBox.Cancel, QMessageBox.No)
+        if answer == QMessageBox.Cancel:
+            return
+        delete = answer == QMessageBox.Yes
+        cache_dir = os.path.join(self.setx.getAppPath(), '.cache')
+        precompiler = self.targetPrecompiler()
+        self.device.submit('Sync project',
+                           devworker.turbo_job(lambda board, fs: sync.ProjectSync(fs, cache_dir, precompiler(), True).sync(
+                               proj_path, '/', delete), self.targetTurbo()),
+                           done=self.syncProjectDone)
+
+    def syncProjectDone(self, result):
+        msg = '\nSync project: {0} uploaded, {1} unchanged'.format(len(result['uploaded']), result['unchanged'])
+        if result['deleted']:
+            msg += ', {0} removed'.format(len(result['deleted']))
+        self.shellTextAppend(msg + '\n')
+        for target in result['uploaded']:
+            self.shellTextAppend('  ' + target + '\n')
+            self.targetCache.update_file(target, *result['files'][target])
+        for target in result['deleted']:
+            self.targetCache.remove(target)
+        self.targetCache.save()
+        self.showTargetFiles()
 
     def uploadScript(self, filename):
         if not self.TargetFileList:
@@ -1483,15 +1714,21 @@ class pyEditor(QMainWindow):
                 if reply == QMessageBox.No:
                     return
 
-        QApplication.setOverrideCursor(Qt.WaitCursor)
-        data = self.mpCmds.get(filename)
+        editor = mpconfig.editorList[mpconfig.currentTabIndex]
+        self.device.submit('Upload ' + filename, devworker.turbo_job(lambda board, fs: fs.get(filename),
+                                                                     self.targetTurbo()),
+                           done=lambda data: self.showUploadedFile(editor, filename, data))
+
+    # uploaded file data has arrived from the target
+    def showUploadedFile(self, editor, filename, data):
+        if editor not in mpconfig.editorList:     # tab was closed during the upload
+            return
         data = str(data, 'utf-8')  # convert bytes to string
-        mpconfig.editorList[mpconfig.currentTabIndex].setPlainText(data.replace(tab, "    "))
+        editor.setPlainText(data.replace(tab, "    "))
         # uploaded file shown as modified.
-        mpconfig.editorList[mpconfig.currentTabIndex].textHasChanged = True
+        editor.textHasChanged = True
         filename += '*'
-        self.tabsList.tabBar().setTabText(self.tabsList.currentIndex(), filename)  # update editor tab text
-        QApplication.restoreOverrideCursor()
+        self.tabsList.tabBar().setTabText(mpconfig.editorList.index(editor), filename)  # update editor tab text
 
     def upldDialogCancel(self):
         self.upldDialog.reject()  #  .setResult(0)
@@ -1571,10 +1808,9 @@ class pyEditor(QMainWindow):
 
         # dialog has closed - check if the entry was accepted or rejected
         if self.rmScriptDialog.result() == QDialog.Accepted:
-            QApplication.setOverrideCursor(Qt.WaitCursor)
-            self.mpCmds.rm(self.rmTree.currentItem().text(0))
-            self.viewTargetFiles()
-            QApplication.restoreOverrideCursor()
+            rm_file = self.rmTree.currentItem().text(0)
+            self.device.submit('Remove ' + rm_file, lambda board, fs: fs.rm(rm_file),
+                               done=lambda result: self.targetFilesChanged('remove', rm_file))
 
     def rm_dialog_cancel(self):
         self.rmScriptDialog.reject()  #  .setResult(0)
@@ -1602,10 +1838,9 @@ class pyEditor(QMainWindow):
         self.ntarg_dialog.setFixedWidth(400)
         self.ntarg_dialog.exec()
         if self.newdir:
-            QApplication.setOverrideCursor(Qt.WaitCursor)
-            self.mpCmds.mkdir(self.newdir)
-            self.viewTargetFiles()
-            QApplication.restoreOverrideCursor()
+            newdir = '/' + self.newdir.strip('/')
+            self.device.submit('Create folder ' + newdir, lambda board, fs: fs.mkdir(newdir),
+                               done=lambda result: self.targetFilesChanged('add_folder', newdir))
 
     def ntarg_accept(self):
         self.newdir = self.ntarg_edit.text()
@@ -1630,12 +1865,10 @@ class pyEditor(QMainWindow):
         self.rm_dir_tree.setHeaderItem(QTreeWidgetItem(['Target Folders']))
 
         items = []
-        for i in range(len(self.TargetFileList)):
-            l1 = QTreeWidgetItem([self.TargetFileList[i]])
-            tmp = l1.text(0).split(';')  # remove the file size string from filename
-            l1.setText(0, tmp[0])
-            if tmp[0].startswith('/') and tmp[0].find('.') == -1:    # file or folder?
-                items.append(l1)
+        entries = self.targetCache.listing('/') or {}
+        for name in sorted(entries):
+            if entries[name][0] == targetcache.DIR:
+                items.append(QTreeWidgetItem(['/' + name]))
 
         self.rm_dir_tree.addTopLevelItems(items)
         if len(items) > 0:
@@ -1648,10 +1881,9 @@ class pyEditor(QMainWindow):
         self.rm_dir_dialog.setFixedWidth(400)
         self.rm_dir_dialog.exec()
         if self.rm_dir:
-            QApplication.setOverrideCursor(Qt.WaitCursor)
-            self.mpCmds.rmdir(self.rm_dir)
-            self.viewTargetFiles()
-            QApplication.restoreOverrideCursor()
+            rm_dir = self.rm_dir
+            self.device.submit('Remove folder ' + rm_dir, lambda board, fs: fs.rmdir(rm_dir),
+                               done=lambda result: self.targetFilesChanged('remove', rm_dir))
 
     def rm_dir_accept(self):
         self.rm_dir = self.rm_dir_tree.currentItem().text(0)
@@ -1678,8 +1910,9 @@ class pyEditor(QMainWindow):
                 procCmdStr = 'esptool.py --chip esp32s2 --port ' + self.setx.getSerialPort() + ' erase_flash'
             elif self.setx.getMCU() == 'ESP32S3':
                 procCmdStr = 'esptool.py --chip esp32s3beta2 --port ' + self.setx.getSerialPort() + ' erase_flash'
-            self.mpBoard.serialClose()
-            self.startProcess(procCmdStr)
+            # the serial port must be closed before esptool can use it
+            self.device.submit('Close serial port', lambda board, fs: board.serialClose(),
+                               done=lambda result: self.startProcess(procCmdStr))
         return
 
     # Program target memory with (presumably) microPython
@@ -1714,8 +1947,8 @@ class pyEditor(QMainWindow):
             procCmdStr = 'esptool.py --chip esp32s3beta2 --port ' + self.setx.getSerialPort() + \
                          ' write_flash -z 0 ' + self.pgmf_name
         if procCmdStr:
-            self.mpBoard.serialClose()
-            self.startProcess(procCmdStr)
+            self.device.submit('Close serial port', lambda board, fs: board.serialClose(),
+                               done=lambda result: self.startProcess(procCmdStr))
         else:
             self.shellTextAppend('Chip ' + chip + ' not currently supported!\n', False)
 
@@ -1768,16 +2001,16 @@ class pyEditor(QMainWindow):
 
     def procFinished(self):
         self.shellTextAppend('\nExternal process has Completed!\n', False)
-        if not self.mpBoard.isSerialOpen():
-            self.mpBoard.serialOpen()
+        self.device.submit('Open serial port', devworker.reopen_port)
 
     def setBaudrate(self, baud):
         self.setx.setBaudRate(baud)
-        self.mpBoard.setSerialPortBaudrate(baud)
+        self.device.submit('Set baudrate', lambda board, fs: board.setSerialPortBaudrate(baud))
 
     def saveComPort(self, comport):
         self.setx.setSerialPort(comport)
-        self.mpBoard.setSerialPortName(comport)
+        self.targetIdentified = False       # identify the board on the next listing
+        self.device.submit('Set serial port', lambda board, fs: board.setSerialPortName(comport))
 
     def keyPressEvent(self, event):
         if mpconfig.currentTabIndex >= 0:
@@ -2114,6 +2347,7 @@ class pyEditor(QMainWindow):
         self.statusBar().showMessage("bookmarks changed")
 
     def clearShellTerminal(self):
+        self.shellBuffer.clear()
         self.shellText.setText("")
         self.shellText.moveCursor(self.cursor.End)
         self.shellText.setFocus()
@@ -2388,6 +2622,7 @@ class pyEditor(QMainWindow):
         self.writeSettings()
         self.setx.setWinClose()
         if self.maybeSave():
+            self.device.shutdown()
             e.accept()
         else:
             e.ignore()
@@ -2544,6 +2779,7 @@ class pyEditor(QMainWindow):
     def handleQuit(self):
         if self.maybeSave():
             # print("Goodbye ...")
+            self.device.shutdown()
             app.quit()
 
     def match_left(self, block, character, start, found):
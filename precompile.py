@@ -0,0 +1,107 @@
+# precompile.py - cached mpy-cross compilation of project modules.
+#
+# A board compiles every imported .py file on import, which costs start up time
+# and heap on small parts like the ESP8266. Precompiler runs mpy-cross on the
+# host instead, with the -march flag of the TARGET_MCU setting, and keeps the
+# .mpy output in a cache folder keyed by the source hash and the compiler
+# version, so a module is compiled again only when it or the compiler changes.
+# boot.py and main.py are always deployed as source, the board only runs them
+# under those names.
+#
+import hashlib
+import os
+import re
+import shutil
+import subprocess
+import sys
+import textwrap
+
+# mpy-cross -march flag per TARGET_MCU setting
+MARCH = {
+    'ESP8266': 'xtensa',
+    'ESP32': 'xtensawin',
+    'ESP32S2': 'xtensawin',
+    'ESP32S3': 'xtensawin',
+    'ESP32C3': 'rv32imc',
+}
+
+# files that must stay source on the board
+SOURCE_ONLY = ('boot.py', 'main.py')
+
+
+def mpy_version_command():
+    """Script that prints the .mpy version the board loads, 0 if it does not tell."""
+    command = """
+        import sys
+        print(getattr(sys.implementation, '_mpy', 0) & 0xff)
+    """
+    return textwrap.dedent(command)
+
+
+def find_mpy_cross():
+    """Return the mpy-cross command as a list, from the PATH or the mpy_cross
+    package, or None if there is none.
+    """
+    exe = shutil.which('mpy-cross')
+    if exe:
+        return [exe]
+    try:
+        import mpy_cross
+    except ImportError:
+        return None
+    return [sys.executable, '-m', 'mpy_cross']
+
+
+def compiled_name(rel):
+    """Target name of a precompiled module, rel with .mpy instead of .py."""
+    return rel[:-3] + '.mpy'
+
+
+def wants_compile(rel):
+    """True if the project file rel ('/' separated) is deployed as .mpy."""
+    return rel.endswith('.py') and rel not in SOURCE_ONLY
+
+
+class Precompiler:
+    """Compiles project modules for one MCU type into cache_dir."""
+
+    def __init__(self, cache_dir, mcu, command=None):
+        self.cache_dir = cache_dir
+        self.march = MARCH.get(mcu)
+        self.command = command or find_mpy_cross()
+        if self.command is None:
+            raise RuntimeError('mpy-cross not found, install it or turn off precompiling')
+        self.version = self._run('--version').strip()
+        match = re.search(r'mpy v(\d+)', self.version)
+        self.mpy_version = int(match.group(1)) if match else 0
+
+    def check_target(self, target_version):
+        """Raise RuntimeError if the board cannot load what this compiler emits."""
+        if target_version and self.mpy_version and target_version != self.mpy_version:
+            raise RuntimeError('mpy-cross emits .mpy v{0}, the target loads v{1}: {2}'.format(
+                self.mpy_version, target_version, self.version))
+
+    def compile(self, path, rel):
+        """Return the path of the compiled local file path, named rel on the
+        board, compiling it only if it is not cached yet.
+        """
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            h.update(f.read())
+        h.update('\0'.join((self.version, self.march or '', rel)).encode('utf-8'))
+        out = os.path.join(self.cache_dir, 'mpy', h.hexdigest() + '.mpy')
+        if os.path.exists(out):
+            return out
+        os.makedirs(os.path.dirname(out), exist_ok=True)
+        args = ['-o', out + '.tmp', '-s', rel]
+        if self.march:
+            args.append('-march=' + self.march)
+        self._run(*(args + [path]))
+        os.replace(out + '.tmp', out)
+        return out
+
+    def _run(self, *args):
+        proc = subprocess.run(self.command + list(args), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        if proc.returncode != 0:
+            raise RuntimeError('mpy-cross failed: ' + proc.stdout.decode('utf-8', 'replace').strip())
+        return proc.stdout.decode('utf-8', 'replace')
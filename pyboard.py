@@ -63,102 +63,437 @@ Modifications include:
 J. Hoeppner@Abbykus 2022
 
 """
+import os
+import re
 import sys
+import codecs
 import time
+import base64
+import struct
+import socket
+import selectors
 from PyQt5.QtSerialPort import QSerialPort, QSerialPortInfo
-from PyQt5.QtCore import QIODevice, QBuffer, QByteArray
+from PyQt5.QtCore import QIODevice, QBuffer, QByteArray, QSocketNotifier
 from PyQt5.QtGui import QTextCursor
 import serial
 import binascii
+from rawrepl import (PyboardError, RxBuffer, TelnetFilter, is_ip_address, RAW_REPL_BANNER, SOFT_REBOOT,
+                     FRIENDLY_PROMPT, HANDSHAKE_TIMEOUT, HANDSHAKE_TRIES)
 # import settings
 # import mpconfig
 # from threading import Thread
 # stdout = sys.stdout.buffer
 
 
-class PyboardError(BaseException):
-    pass
+# control bytes that serialReadyRead() does not show in the shell: all but tab,
+# lf, cr and backspace, which the shell widget applies
+SHELL_DELETE = bytes(c for c in range(32) if c not in b'\t\n\r\x08') + b'\x7f'
+# VT100 escape sequences, e.g. erase to end of line or cursor moves
+ANSI_ESCAPE = re.compile(rb'\x1b\[[0-9;?]*[ -/]*[@-~]')
+# echo of a backspace: cursor back, then erase to end of line or overwrite with spaces
+BACKSPACE_ECHO = re.compile(rb'^\x08(?:\x1b\[K| +\x08+)?')
+# seconds follow() waits for more error output once stdout has ended
+FOLLOW_ERR_TIMEOUT = 1
+
 
 class TelnetToSerial:
-    def __init__(self, ip, user, password, read_timeout=None):
-        import telnetlib
-        self.tn = telnetlib.Telnet(ip, timeout=15)
+    """Socket transport for the telnet REPL of network attached boards. Received
+    data is drained from the socket in bulk into a receive buffer and waits use
+    select, so reads return as soon as the data is there. Besides read(size),
+    write() and inWaiting() it provides the subset of the QSerialPort interface
+    that Pyboard uses, so it can stand in for the serial port.
+    Pass user=None to skip the login, e.g. for a local loopback test server.
+    """
+    def __init__(self, ip, user, password, read_timeout=None, port=23):
+        # an explicit port may also be given as 'ip:port'
+        if ':' in ip:
+            ip, port = ip.split(':')
+        self.ip = ip
+        self.port = int(port)
+        self.user = user
+        self.password = password
         self.read_timeout = read_timeout
-        if b'Login as:' in self.tn.read_until(b'Login as:', timeout=read_timeout):
-            self.tn.write(bytes(user, 'ascii') + b"\r\n")
+        self.sock = None
+        self.selector = None
+        self._connect()
+
+    def _connect(self):
+        self.rxbuf = RxBuffer()
+        self.filter = TelnetFilter()
+        self.sock = socket.create_connection((self.ip, self.port), timeout=15)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.sock, selectors.EVENT_READ)
+        self._login()
+
+    def _login(self):
+        if self.user is None:
+            return
+        if self._read_until(b'Login as:').endswith(b'Login as:'):
+            self.write(bytes(self.user, 'ascii') + b"\r\n")
 
-            if b'Password:' in self.tn.read_until(b'Password:', timeout=read_timeout):
+            if self._read_until(b'Password:').endswith(b'Password:'):
                 # needed because of internal implementation details of the telnet server
                 time.sleep(0.2)
-                self.tn.write(bytes(password, 'ascii') + b"\r\n")
+                self.write(bytes(self.password, 'ascii') + b"\r\n")
 
-                if b'for more information.' in self.tn.read_until(b'Type "help()" for more information.', timeout=read_timeout):
+                if self._read_until(b'Type "help()" for more information.').endswith(b'for more information.'):
                     # login succesful
-                    from collections import deque
-                    self.fifo = deque()
                     return
 
+        self.close()
         raise PyboardError('Failed to establish a telnet connection with the board')
 
     def __del__(self):
         self.close()
 
     def close(self):
-        try:
-            self.tn.close()
-        except:
-            # the telnet object might not exist yet, so ignore this one
-            pass
+        if self.selector is not None:
+            self.selector.close()
+            self.selector = None
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    # Wait up to timeout seconds (None waits forever) for the socket to become
+    # readable, then move everything it holds into the receive buffer.
+    # Returns the number of bytes added.
+    def _recv(self, timeout):
+        if self.sock is None or not self.selector.select(timeout):
+            return 0
+        count = 0
+        while True:
+            data = self.sock.recv(65536)
+            if not data:
+                # the board closed the connection
+                self.close()
+                break
+            count += self._received(data)
+            if self.sock is None or not self.selector.select(0):
+                break
+        return count
 
-    def read(self, size=1):
-        while len(self.fifo) < size:
-            timeout_count = 0
-            data = self.tn.read_eager()
-            if len(data):
-                self.fifo.extend(data)
-                timeout_count = 0
-            else:
-                time.sleep(0.25)
-                if self.read_timeout is not None and timeout_count > 4 * self.read_timeout:
-                    break
-                timeout_count += 1
+    # Add data read from the socket to the receive buffer, returns the number of REPL bytes
+    def _received(self, data):
+        data = self.filter.feed(data)
+        self.rxbuf.feed(data)
+        return len(data)
 
-        data = b''
-        while len(data) < size and len(self.fifo) > 0:
-            data += bytes([self.fifo.popleft()])
-        return data
+    def _read_until(self, ending):
+        deadline = None if self.read_timeout is None else time.time() + self.read_timeout
+        scan = 0
+        while True:
+            idx = self.rxbuf.find(ending, scan)
+            if idx >= 0:
+                return self.rxbuf.take(idx + len(ending))
+            scan = max(0, len(self.rxbuf) - len(ending) + 1)
+            remaining = None if deadline is None else deadline - time.time()
+            if self.sock is None or (remaining is not None and remaining <= 0):
+                return self.rxbuf.take(len(self.rxbuf))
+            self._recv(remaining)
+
+    # Read size bytes, or fewer if read_timeout expires first.
+    def read(self, size=1):
+        deadline = None if self.read_timeout is None else time.time() + self.read_timeout
+        while len(self.rxbuf) < size and self.sock is not None:
+            remaining = None if deadline is None else deadline - time.time()
+            if remaining is not None and remaining <= 0:
+                break
+            self._recv(remaining)
+        return self.rxbuf.take(size)
 
     def write(self, data):
-        self.tn.write(data)
+        if self.sock is None:
+            return -1
+        self.sock.sendall(self.filter.escape(bytes(data)))
         return len(data)
 
     def inWaiting(self):
-        n_waiting = len(self.fifo)
-        if not n_waiting:
-            data = self.tn.read_eager()
-            self.fifo.extend(data)
-            return len(data)
+        self._recv(0)
+        return len(self.rxbuf)
+
+    # QSerialPort compatible interface used by Pyboard
+
+    def isOpen(self):
+        return self.sock is not None
+
+    def open(self, mode=None):
+        self.close()
+        try:
+            self._connect()
+        except (OSError, PyboardError):
+            return False
+        return True
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def bytesAvailable(self):
+        return self.inWaiting()
+
+    def waitForReadyRead(self, msecs):
+        return len(self.rxbuf) > 0 or self._recv(msecs / 1000) > 0
+
+    def readAll(self):
+        self._recv(0)
+        return self.rxbuf.take(len(self.rxbuf))
+
+    def flush(self):
+        return True
+
+    def waitForBytesWritten(self, msecs):
+        return True
+
+    def setPortName(self, name):
+        pass
+
+    def setBaudRate(self, baud):
+        pass
+
+    def isDataTerminalReady(self):
+        return False
+
+
+class WebReplToSerial(TelnetToSerial):
+    """WebREPL transport for network attached boards, device names have the form
+    'ws://ip' or 'ws://ip:port'. REPL traffic travels in websocket text frames and
+    like TelnetToSerial this class stands in for the serial port. Binary frames
+    carry the WebREPL file transfer protocol, get_file() and put_file() use it to
+    move file contents without any REPL text encoding.
+    Pass password=None to skip the login, e.g. for a local websocket stand-in.
+    """
+    DEFAULT_PORT = 8266
+    # file transfer request ops, see webrepl_cli.py in the MicroPython repository
+    PUT_FILE = 1
+    GET_FILE = 2
+    CHUNK_SIZE = 1024
+
+    # websocket frame opcodes
+    OP_CONT = 0x0
+    OP_TEXT = 0x1
+    OP_BINARY = 0x2
+    OP_CLOSE = 0x8
+    OP_PING = 0x9
+    OP_PONG = 0xa
+
+    def __init__(self, url, password, read_timeout=None):
+        address = url[len('ws://'):].rstrip('/')
+        super().__init__(address, None, password, read_timeout, port=self.DEFAULT_PORT)
+
+    def _connect(self):
+        self._frames = bytearray()      # received data not yet parsed into frames
+        self._opcode = self.OP_TEXT     # opcode of the frame a continuation belongs to
+        self.binbuf = RxBuffer()        # payload of binary frames
+        super()._connect()
+
+    def _login(self):
+        # upgrade the HTTP connection to a websocket
+        key = base64.b64encode(os.urandom(16))
+        self.sock.sendall(b'GET / HTTP/1.1\r\nHost: ' + self.ip.encode() +
+                          b'\r\nConnection: Upgrade\r\nUpgrade: websocket\r\nSec-WebSocket-Key: ' + key +
+                          b'\r\nSec-WebSocket-Version: 13\r\n\r\n')
+        response = b''
+        while b'\r\n\r\n' not in response:
+            data = self.sock.recv(4096)
+            if not data:
+                break
+            response += data
+        header, _, data = response.partition(b'\r\n\r\n')
+        if not header.startswith(b'HTTP/1.1 101'):
+            self.close()
+            raise PyboardError('Failed to establish a WebREPL connection with the board')
+        self._received(data)
+
+        if self.password is None:
+            return
+        if self._read_until(b'Password: ').endswith(b'Password: '):
+            self.write(bytes(self.password, 'utf-8') + b'\r')
+            if b'WebREPL connected' in self._read_until(b'\r\n>>> '):
+                # login succesful
+                return
+
+        self.close()
+        raise PyboardError('WebREPL login failed, check the password')
+
+    # Parse complete frames, text goes to the receive buffer and binary to binbuf
+    def _received(self, data):
+        self._frames += data
+        buf = self._frames
+        count = 0
+        pos = 0
+        while len(buf) - pos >= 2:
+            opcode = buf[pos] & 0x0f
+            size = buf[pos + 1] & 0x7f
+            start = pos + 2
+            if size == 126:
+                if len(buf) - pos < 4:
+                    break
+                size = struct.unpack_from('>H', buf, pos + 2)[0]
+                start = pos + 4
+            elif size == 127:
+                if len(buf) - pos < 10:
+                    break
+                size = struct.unpack_from('>Q', buf, pos + 2)[0]
+                start = pos + 10
+            if len(buf) - start < size:
+                break
+            payload = bytes(buf[start:start + size])
+            pos = start + size
+
+            if opcode == self.OP_CONT:
+                opcode = self._opcode
+            if opcode == self.OP_TEXT:
+                self.rxbuf.feed(payload)
+                count += size
+            elif opcode == self.OP_BINARY:
+                self.binbuf.feed(payload)
+            elif opcode == self.OP_PING:
+                self._send_frame(self.OP_PONG, payload)
+            elif opcode == self.OP_CLOSE:
+                self.close()
+                break
+            if opcode in (self.OP_TEXT, self.OP_BINARY):
+                self._opcode = opcode
+        del buf[:pos]
+        return count
+
+    # Send one masked frame, as RFC 6455 requires of clients
+    def _send_frame(self, opcode, payload):
+        size = len(payload)
+        if size < 126:
+            header = struct.pack('>BB', 0x80 | opcode, 0x80 | size)
+        elif size < 0x10000:
+            header = struct.pack('>BBH', 0x80 | opcode, 0x80 | 126, size)
         else:
-            return n_waiting
+            header = struct.pack('>BBQ', 0x80 | opcode, 0x80 | 127, size)
+        mask = os.urandom(4)
+        if size:
+            key = (mask * (size // 4 + 1))[:size]
+            payload = (int.from_bytes(payload, 'big') ^ int.from_bytes(key, 'big')).to_bytes(size, 'big')
+        self.sock.sendall(header + mask + payload)
+
+    def write(self, data):
+        if self.sock is None:
+            return -1
+        self._send_frame(self.OP_TEXT, bytes(data))
+        return len(data)
+
+    def _read_binary(self, num_bytes):
+        deadline = None if self.read_timeout is None else time.time() + self.read_timeout
+        while len(self.binbuf) < num_bytes and self.sock is not None:
+            remaining = None if deadline is None else deadline - time.time()
+            if remaining is not None and remaining <= 0:
+                break
+            self._recv(remaining)
+        if len(self.binbuf) < num_bytes:
+            raise PyboardError('WebREPL file transfer timed out')
+        return self.binbuf.take(num_bytes)
+
+    def _read_response(self):
+        sig, code = struct.unpack('<2sH', self._read_binary(4))
+        if sig != b'WB':
+            raise PyboardError('Unexpected WebREPL file transfer response')
+        return code
+
+    def _file_request(self, op, size, filename):
+        name = filename.encode('utf-8')
+        if len(name) > 64:
+            raise PyboardError('WebREPL file names are limited to 64 bytes: ' + filename)
+        self._send_frame(self.OP_BINARY, struct.pack('<2sBBQLH64s', b'WA', op, 0, 0, size, len(name), name))
+        if self._read_response() != 0:
+            raise PyboardError('WebREPL could not open ' + filename)
+
+    def put_file(self, data, filename, progress=None):
+        """Write data to filename on the board, calling progress(done, total) per chunk."""
+        self._file_request(self.PUT_FILE, len(data), filename)
+        for i in range(0, len(data), self.CHUNK_SIZE):
+            self._send_frame(self.OP_BINARY, data[i:i + self.CHUNK_SIZE])
+            if progress is not None:
+                progress(min(i + self.CHUNK_SIZE, len(data)), len(data))
+        if self._read_response() != 0:
+            raise PyboardError('WebREPL failed to write ' + filename)
+
+    def get_file(self, filename, dest=None, progress=None):
+        """Return the contents of filename on the board. If dest is given they
+        are not returned but passed to dest(chunk) as they arrive, and
+        progress(done, 0) is called per chunk, the size is not known in advance.
+        """
+        if dest is None:
+            data = bytearray()
+            self.get_file(filename, data.extend, progress)
+            return bytes(data)
+        self._file_request(self.GET_FILE, 0, filename)
+        done = 0
+        while True:
+            # each zero byte asks the board for the next chunk
+            self._send_frame(self.OP_BINARY, b'\x00')
+            size = struct.unpack('<H', self._read_binary(2))[0]
+            if size == 0:
+                break
+            dest(self._read_binary(size))
+            done += size
+            if progress is not None:
+                progress(done, 0)
+        if self._read_response() != 0:
+            raise PyboardError('WebREPL failed to read ' + filename)
+
 
 class Pyboard:
-    def __init__(self, shelltext, device, baud, user='micro', password='python', wait=0):
+    def __init__(self, shelltext, device, baud, user='micro', password='python', wait=0, shell_write=None):
 
         self._device = device
         self._baudrate = baud
         self.shelltext = shelltext
         self.cursor = QTextCursor()
 
+        # target output is passed to shell_write(str). It defaults to the shelltext
+        # widget, or stdout if there is none. Pyboards owned by a worker thread
+        # must pass a thread-safe writer (e.g. a signal emit) instead.
+        if shell_write is not None:
+            self.shell_write = shell_write
+        elif shelltext is not None:
+            self.shell_write = self.shelltext_write
+        else:
+            self.shell_write = sys.stdout.write
+
         # text flags
         self.ignoreSerial = False
         self.block_cr = False
         self.block_echo = False
+        self.block_backspace = False
+        # shell output decoding state, see serialReadyRead()
+        self.decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        self.escape_pending = b''
+
+        # raw-paste mode is used unless the firmware has refused it
+        self.use_raw_paste = True
+        # without raw-paste a script is written in chunks of write_chunk_size
+        # bytes with a pause of write_pause seconds after each, see linktune.py
+        self.write_chunk_size = 256
+        self.write_pause = 0.01
+
+        # bytes received while waiting on the raw REPL protocol
+        self.rxbuf = RxBuffer()
+        # seconds per phase of the last enter_raw_repl(), see HANDSHAKE_TIMEOUT
+        self.handshake_timing = {}
+        # baud rate turbo mode found working on this port, 0 if none, None until
+        # tried, see turbo.py
+        self.turbo_baud = None
 
         # device = '192.168.4.1'
 
-        if device and device[0].isdigit() and device[-1].isdigit() and device.count('.') == 3:
+        # network transports set webrepl or notifier below
+        self.webrepl = None
+        self.notifier = None
+
+        if device and device.startswith('ws://'):
+            self.serialport = WebReplToSerial(device, password, read_timeout=10)
+            self.webrepl = self.serialport
+            self.watchSocket()
+        elif is_ip_address(device):
             # device looks like an IP address
             self.serialport = TelnetToSerial(device, user, password, read_timeout=10)
+            self.watchSocket()
         else:
             self.serialport = QSerialPort()
             self.setSerialPortName(device)
@@ -166,14 +501,28 @@ class Pyboard:
             self.serialport.setFlowControl(QSerialPort.HardwareControl)
             self.serialport.readyRead.connect(self.serialReadyRead)
             if self.serialport.open(QIODevice.ReadWrite):
-                self.shelltext.append('Serial port ' + device + ' is open.')
+                self.shell_write('Serial port ' + device + ' is open.\n')
             else:
-                self.shelltext.append('Error: Cannot open serial port ' + device)
-
-
+                self.shell_write('Error: Cannot open serial port ' + device + '\n')
+
+    # write target output to the end of the shelltext widget, a backspace deletes
+    # the previous character
+    def shelltext_write(self, text):
+        cursor = self.shelltext.textCursor()
+        cursor.movePosition(QTextCursor.End)
+        parts = text.split('\b')
+        cursor.insertText(parts[0])
+        for part in parts[1:]:
+            cursor.deletePreviousChar()
+            cursor.insertText(part)
+        self.shelltext.setTextCursor(cursor)
+        self.shelltext.ensureCursorVisible()
+
+    # write script output to the shell, a multi-byte character may be split across calls
     def stdout_write_bytes(self, b):
-        b = b.replace(b"\x04", b"")
-        self.shelltext.insertPlainText(b.decode('utf-8'))
+        text = self.decoder.decode(ANSI_ESCAPE.sub(b'', b).translate(None, SHELL_DELETE))
+        if text:
+            self.shell_write(text)
 
     def serialWrite(self, databytes):
         self.serialport.write(databytes)
@@ -209,13 +558,21 @@ class Pyboard:
         self.ignoreSerial = False
         return data
 
+    # Interrupt the running program and show its output up to the REPL prompt.
+    # ctrl-C is sent again only if the prompt does not show.
     def stopScript(self):
         if self.serialport.isOpen():
-            # ctrl-C twice: interrupt any running program
-            self.serialport.write(b'\r\x03')
-            time.sleep(0.1)
-            self.serialport.write(b'\x03')
-            time.sleep(0.1)
+            # keep serialReadyRead() from taking the prompt away from read_until()
+            ignore, self.ignoreSerial = self.ignoreSerial, True
+            try:
+                for retry in range(HANDSHAKE_TRIES):
+                    self.serialport.write(b'\r\x03')
+                    data = self.read_until(1, FRIENDLY_PROMPT, HANDSHAKE_TIMEOUT['stop'])
+                    self.stdout_write_bytes(data)
+                    if data.endswith(FRIENDLY_PROMPT):
+                        break
+            finally:
+                self.ignoreSerial = ignore
 
     def isSerialOpen(self):
         return self.serialport.isOpen()
@@ -228,7 +585,14 @@ class Pyboard:
         self._baudrate = baud
         self.serialport.setBaudRate(int(baud))  # must convert baudrate str to int
 
+    # network sockets have no readyRead signal, watch them for REPL output instead
+    def watchSocket(self):
+        self.notifier = QSocketNotifier(self.serialport.fileno(), QSocketNotifier.Read)
+        self.notifier.activated.connect(self.serialReadyRead)
+
     def serialClose(self):
+        if self.notifier is not None:
+            self.notifier.setEnabled(False)
         self.serialport.close()
 
     def serialOpen(self):
@@ -236,55 +600,46 @@ class Pyboard:
             self.serialport.close()
         self.setSerialPortName(self._device)
         self.setSerialPortBaudrate(self._baudrate)
+        self.use_raw_paste = True
+        self.turbo_baud = None
+        self.decoder.reset()
+        self.escape_pending = b''
+        if self.notifier is not None:
+            self.notifier.setEnabled(False)
+            if not self.serialport.open(QIODevice.ReadWrite):
+                return False
+            self.watchSocket()
+            return True
         return self.serialport.open(QIODevice.ReadWrite)    # return true on open success
 
     def serialReadyRead(self):
         if self.ignoreSerial:
             return
-        backspc = False
-        serialBytes = bytes(self.serialport.readAll())
-        outstr = ''
-        i = 0
-        # strip non-ascii bytes from serial data
-        while i < len(serialBytes):
-            # print(hex(serialBytes[i]), end=',')
+        data = self.escape_pending + bytes(self.serialport.readAll())
+        self.escape_pending = b''
+
+        if self.block_backspace:
+            # the shell has already deleted the character, drop the target's echo of it
+            self.block_backspace = False
+            data = BACKSPACE_ECHO.sub(b'', data, 1)
+        if self.block_cr:
             # filter out leading cr/lf that echo user input
-            if (serialBytes[i] == 10 or serialBytes[i] == 13) and not self.block_cr:
-                outstr = outstr + chr(serialBytes[i])
-                # print(hex(serialBytes[i]), end=',')
-
-            if 31 < serialBytes[i] < 128:
-                outstr = outstr + chr(serialBytes[i])
-                self.block_cr = False
-                # print(hex(serialBytes[i]), end=',')
-            # special action for backspace
-            else:
-                if serialBytes[i] == 8:
-                    backspc = True
-            # print(binascii.hexlify(bytearray(serialBytes[i])))
-            # print(hex(serialBytes[i]))
-            i += 1
-
-        # print('')
-
-        if backspc:
-            # new_content = self.shelltext.toPlainText()
-            # prompt = new_content[-5:]
-            # prev_cursor = self.shelltext.textCursor()
-            # self.shelltext.moveCursor(QTextCursor.End)
-            # # Use any backspaces that were left in input to delete text
-            # self.shelltext.textCursor().deletePreviousChar()
-            # self.shelltext.insertPlainText(new_content[1:])
-            # self.shelltext.setTextCursor(prev_cursor)
-            return
-
-        self.block_cr = False
-
-        if not self.block_echo:
-            self.shelltext.moveCursor(self.cursor.End)
-            self.shelltext.insertPlainText(outstr)
-            self.shelltext.moveCursor(self.cursor.End)
-            self.shelltext.ensureCursorVisible()
+            data = data.lstrip(b'\r\n')
+        if b'\x1b' in data:
+            # hold back an escape sequence split across chunks, drop complete ones
+            idx = data.rfind(b'\x1b')
+            if len(data) - idx < 16 and not ANSI_ESCAPE.match(data, idx):
+                self.escape_pending = data[idx:]
+                data = data[:idx]
+            data = ANSI_ESCAPE.sub(b'', data)
+        # drop control bytes in one pass, multi-byte UTF-8 sequences are kept and
+        # may be split across chunks, so they are decoded incrementally
+        outstr = self.decoder.decode(data.translate(None, SHELL_DELETE))
+        if outstr:
+            self.block_cr = False
+
+        if not self.block_echo and outstr:
+            self.shell_write(outstr)
 
         self.block_echo = False
 
@@ -293,129 +648,271 @@ class Pyboard:
         print('serial ignore')
         # self.serialport.waitForReadyRead(50)
 
-    # Read serialport until ending pattern is found or until timeout
-    # If ending is None, any pattern is matched
-    def read_until(self, min_num_bytes, ending, timeout=1):
-        data = b''
-        pattern_fnd = False
-        if self.serialport.isOpen():
-            start_timeout = time.time()
-            while True:
-                if time.time() - start_timeout > timeout or pattern_fnd:
-                    break
-                if self.serialport.waitForReadyRead(10):
-                    while self.serialport.bytesAvailable() > 0:
-                        data += self.serialport.read(min_num_bytes)
-                        if data.endswith(ending) or time.time() - start_timeout > timeout:
-                            pattern_fnd = True
-                            break
-        return data
+    # Move everything the serialport has received into the receive buffer. If nothing
+    # is pending wait up to wait_ms for more. Returns the number of bytes added.
+    def fill_rxbuf(self, wait_ms=10):
+        n = self.serialport.bytesAvailable()
+        if n <= 0:
+            if not self.serialport.waitForReadyRead(wait_ms):
+                return 0
+            n = self.serialport.bytesAvailable()
+        if n > 0:
+            self.rxbuf.feed(self.serialport.read(n))
+        return max(n, 0)
 
-    # Enter the microPython raw REPL mode to run a script on the target
-    def enter_raw_repl(self):
+    # Read serialport until ending pattern is found or until timeout (None waits forever).
+    # Returns the data up to and including the ending, or all data received on timeout.
+    # min_num_bytes is no longer used, the port is drained in bulk into the rx buffer.
+    def read_until(self, min_num_bytes, ending, timeout=1):
+        if not self.serialport.isOpen():
+            return b''
+        start_timeout = time.time()
+        scan = 0
+        while True:
+            idx = self.rxbuf.find(ending, scan)
+            if idx >= 0:
+                return self.rxbuf.take(idx + len(ending))
+            # only the tail that could hold a partial ending needs to be searched again
+            scan = max(0, len(self.rxbuf) - len(ending) + 1)
+            if timeout is not None and time.time() - start_timeout > timeout:
+                return self.rxbuf.take(len(self.rxbuf))
+            self.fill_rxbuf(10)
+
+    # Enter the microPython raw REPL mode to run a script on the target. A soft reset
+    # gives the script a clean heap, skip it to keep the state of the board.
+    # Each phase of the handshake goes on as soon as the board's answer arrives,
+    # the seconds each phase took are left in handshake_timing.
+    def enter_raw_repl(self, soft_reset=True):
         if not self.serialport.isOpen():
             return b'Failed - serialport not open'
-        # ctrl-C twice: interrupt any running program
+        self.handshake_timing = {}
+        start = time.time()
+        try:
+            return self._raw_repl_handshake(soft_reset)
+        finally:
+            self.handshake_timing['total'] = time.time() - start
+
+    def _raw_repl_handshake(self, soft_reset):
+        # ctrl-C: interrupt any running program
         self.serialport.write(b'\r\x03')
-        time.sleep(0.1)
-        self.serialport.write(b'\x03')
-        time.sleep(0.1)
 
-        # flush input (without relying on serial.flushInput())
+        # flush input (without relying on serial.flushInput()), output of the
+        # interrupt that arrives later is skipped while waiting for the banner
         n = self.serialport.bytesAvailable()
         while n > 0:
             self.serialport.read(n)
             n = self.serialport.bytesAvailable()
+        self.rxbuf.clear()
 
-        for retry in range(0, 1):
+        for retry in range(HANDSHAKE_TRIES):
             self.serialport.write(b'\r\x01')    # ctrl-A: enter raw REPL
-            time.sleep(0.1)
-            data = self.read_until(1, b'raw REPL; CTRL-B to exit\r\n>', 1)
-            if data.endswith(b'raw REPL; CTRL-B to exit\r\n>'):
+            data = self._handshake_phase('enter', RAW_REPL_BANNER)
+            if data.endswith(RAW_REPL_BANNER):
+                if retry:
+                    # the earlier ctrl-A may have been kept for the REPL, skip its banner
+                    self.read_until(1, RAW_REPL_BANNER, 0.1)
                 break
+            # the program caught the interrupt, try again
+            self.serialport.write(b'\r\x03')
         else:
-            data = b'Failed to enter raw REPL'
+            return b'Failed to enter raw REPL'
+        if not soft_reset:
             return data
 
         self.serialport.write(b'\x04')  # ctrl-D: soft reset
-        data = self.read_until(1, b'soft reboot\r\n')
-        if not data.endswith(b'soft reboot\r\n'):
-            data = b'Failed to soft reboot'
-        else:
-            # By splitting this into 2 reads, it allows boot.py to print stuff,
-            # which will show up after the soft reboot and before the raw REPL.
-            # Modification from original pyboard.py below:
-            #   Add a small delay and send Ctrl-C twice after soft reboot to ensure
-            #   any main program loop in main.py is interrupted.
-            time.sleep(0.1)
-            self.serialport.write(b'\x03')
-            time.sleep(0.1)           # (slight delay before second interrupt
+        data = self._handshake_phase('reboot', SOFT_REBOOT)
+        if not data.endswith(SOFT_REBOOT):
+            return b'Failed to soft reboot'
+        # boot.py may print stuff after the soft reboot and before the banner.
+        # Firmware that also runs main.py after a soft reboot in the raw REPL
+        # does not show the banner in time, interrupt its main program loop.
+        data = b''
+        for retry in range(HANDSHAKE_TRIES):
+            data += self._handshake_phase('banner', RAW_REPL_BANNER)
+            if data.endswith(RAW_REPL_BANNER):
+                return data
             self.serialport.write(b'\x03')
-            # End modification above.
-            data = self.read_until(1, b'raw REPL; CTRL-B to exit\r\n>')
-            if not data.endswith(b'raw REPL; CTRL-B to exit\r\n>'):
-                data = b'Failed to complete raw REPL'
-
+        return b'Failed to complete raw REPL'
+
+    # Wait for the board's answer in one phase of the raw REPL handshake and add
+    # the time it took to handshake_timing.
+    def _handshake_phase(self, phase, ending):
+        start = time.time()
+        data = self.read_until(1, ending, HANDSHAKE_TIMEOUT[phase])
+        self.handshake_timing[phase] = self.handshake_timing.get(phase, 0) + time.time() - start
         return data
 
     def exit_raw_repl(self):
         if self.serialport.isOpen():
             self.serialport.write(b'\r\x02')    # ctrl-B: enter friendly REPL
 
-    def follow(self, timeout, data_consumer=None):
-        # wait for normal output
-        data = self.read_until(1, b'\x04', timeout=timeout)
-        if not data.endswith(b'\x04'):
-            print('Failed: Timeout in first command EOF!')
-            data_err = b'Failed: Timeout in first command EOF!\n'
-            data = b''
-        else:
-            data = data[:-1]    # remove trailing '\x04'
-            # wait to see if any error output
-            data_err = self.read_until(1, b'\x04', 0.1)
-            if data_err and data_err.endswith(b'\x04'):
-                data_err = data_err[:-1]
+    # Follow the output of a script started with exec_raw_no_follow(). The raw REPL
+    # sends stdout, \x04, stderr, \x04 and the '>' prompt, which are parsed as they
+    # arrive. With a data_consumer stdout is passed to it in chunks and not kept,
+    # so long running scripts show their output live in bounded memory. timeout
+    # limits the wait for the end of stdout, None waits as long as the script runs.
+    # checkpoint() is called while waiting and may raise to stop following.
+    def follow(self, timeout, data_consumer=None, checkpoint=None):
+        data = bytearray()
+        data_err = bytearray()
+        in_stdout = True
+        start_timeout = last_data = time.time()
+        while True:
+            idx = self.rxbuf.find(b'\x04')
+            if idx >= 0 or len(self.rxbuf):
+                chunk = self.rxbuf.take(idx + 1 if idx >= 0 else len(self.rxbuf))
+                if idx >= 0:
+                    chunk = chunk[:-1]
+                last_data = time.time()
+                if not in_stdout:
+                    data_err += chunk
+                elif data_consumer is None:
+                    data += chunk
+                elif chunk:
+                    data_consumer(chunk)
+                if idx >= 0:
+                    if not in_stdout:
+                        break
+                    in_stdout = False
+                continue
+            if in_stdout:
+                if timeout is not None and time.time() - start_timeout > timeout:
+                    print('Failed: Timeout in first command EOF!')
+                    return b'', b'Failed: Timeout in first command EOF!\n'
+            elif time.time() - last_data > FOLLOW_ERR_TIMEOUT:
+                # no end of the error output, return what has arrived
+                return bytes(data), bytes(data_err)
+            if checkpoint is not None:
+                checkpoint()
+            self.fill_rxbuf(10)
+        # consume the raw REPL prompt so the next exec starts on a clean stream
+        self.read_until(1, b'>', 0.1)
         # return normal and error output
-        return data, data_err
+        return bytes(data), bytes(data_err)
 
+    # Read exactly num_bytes from the serialport or fewer on timeout
+    def read_bytes(self, num_bytes, timeout=1):
+        start_timeout = time.time()
+        while len(self.rxbuf) < num_bytes:
+            if not self.fill_rxbuf(10) and time.time() - start_timeout > timeout:
+                break
+        return self.rxbuf.take(num_bytes)
+
+    # Write command bytes using the raw-paste protocol. The device grants a window of
+    # bytes it can buffer and sends \x01 each time another window may be sent.
+    def raw_paste_write(self, command_bytes):
+        data = self.read_bytes(2)
+        if len(data) != 2:
+            print('could not read raw paste window size')
+            return False
+        window_size = struct.unpack('<H', data)[0]
+        window_remain = window_size
+
+        i = 0
+        while i < len(command_bytes):
+            while window_remain == 0 or len(self.rxbuf) or self.serialport.bytesAvailable() > 0:
+                data = self.read_bytes(1)
+                if data == b'\x01':
+                    # device can accept another window of data
+                    window_remain += window_size
+                elif data == b'\x04':
+                    # device indicated an abrupt end, acknowledge it and finish,
+                    # the error output follows as for any other script
+                    self.serialport.write(b'\x04')
+                    return True
+                else:
+                    print('unexpected read during raw paste: {}'.format(data))
+                    return False
+            # send as much data as fits within the window granted by the device
+            b = command_bytes[i:min(i + window_remain, len(command_bytes))]
+            self.serialport.write(b)
+            self.serialport.waitForBytesWritten(100)
+            window_remain -= len(b)
+            i += len(b)
+
+        self.serialport.write(b'\x04')     # Ctrl-D ends the transmit
+
+        # wait for device to acknowledge end of data
+        data = self.read_until(1, b'\x04')
+        if not data.endswith(b'\x04'):
+            print('could not complete raw paste')
+            return False
+        return True
+
+    # Start a script without waiting for its output. Returns True if the board took
+    # it, False if it did not answer.
     def exec_raw_no_follow(self, command):
         if not self.serialport.isOpen():
-            return b''
+            return False
         if isinstance(command, bytes):
             command_bytes = command
         else:
             command_bytes = bytes(command, encoding='utf8')
 
+        if self.use_raw_paste:
+            # try to enter raw-paste mode: ctrl-E, 'A', ctrl-A
+            self.serialport.write(b'\x05A\x01')
+            data = self.read_bytes(2)
+            if data == b'R\x01':
+                # device supports raw-paste, write the command with flow control
+                if not self.raw_paste_write(command_bytes):
+                    print('could not exec command')
+                    return False
+                return True
+            if data == RAW_REPL_BANNER[:2]:
+                # firmware predates raw-paste, the trailing ctrl-A re-entered the raw
+                # REPL so wait for the remainder of its banner
+                data = self.read_until(1, RAW_REPL_BANNER[2:])
+                if not data.endswith(RAW_REPL_BANNER[2:]):
+                    print('could not enter raw repl')
+                    return False
+            elif data != b'R\x00':
+                # no answer, the board is busy or gone, not a reason to give up raw-paste
+                print('could not enter raw-paste mode: {}'.format(data))
+                return False
+            # don't try raw-paste again on this connection
+            self.use_raw_paste = False
+
         # write command script to target
-        for i in range(0, len(command_bytes), 256):
-            self.serialport.write(command_bytes[i:min(i + 256, len(command_bytes))])
-            time.sleep(0.01)
+        for i in range(0, len(command_bytes), self.write_chunk_size):
+            self.serialport.write(command_bytes[i:i + self.write_chunk_size])
+            # QSerialPort only buffers the write, send the chunk before pausing
+            self.serialport.waitForBytesWritten(100)
+            if self.write_pause:
+                time.sleep(self.write_pause)
         self.serialport.write(b'\x04')      # Ctrl-D ends the transmit
 
         # check if command was accepted
         data = self.read_until(1, b'OK')
         if not data.endswith(b'OK'):
             print('could not exec command')
+            return False
+        return True
 
-    def exec_raw(self, command, timeout=1, data_consumer=None):
-        self.exec_raw_no_follow(command)
-        return self.follow(timeout, data_consumer)
+    def exec_raw(self, command, timeout=1, data_consumer=None, checkpoint=None):
+        if not self.exec_raw_no_follow(command):
+            return b'', b'Failed: could not exec command\n'
+        return self.follow(timeout, data_consumer, checkpoint)
 
-    def exec_(self, command, stream_output=False):
+    # Run a script and return its output. With stream_output the output goes to the
+    # shell as it arrives instead, and there is no timeout.
+    def exec_(self, command, stream_output=False, checkpoint=None):
         if not self.serialport.isOpen():
             return b'Failed - serialport not open'
         data_consumer = None
+        timeout = 1
         if stream_output:
             data_consumer = self.stdout_write_bytes
-        ret, ret_err = self.exec_raw(command, data_consumer=data_consumer)
+            timeout = None
+        ret, ret_err = self.exec_raw(command, timeout, data_consumer, checkpoint)
         if ret_err:
-            self.shelltext.insertPlainText(ret_err.decode('utf-8'))
+            self.shell_write(ret_err.decode('utf-8'))
         return ret
 
-    def execfile(self, filename, stream_output=False):
+    def execfile(self, filename, stream_output=False, checkpoint=None):
         with open(filename, 'rb') as f:
             pyfile = f.read()
-        return self.exec_(pyfile, stream_output=stream_output)
+        return self.exec_(pyfile, stream_output=stream_output, checkpoint=checkpoint)
 
     def eval(self, expression):
         ret = self.exec_('print({})'.format(expression))
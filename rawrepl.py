@@ -0,0 +1,125 @@
+# rawrepl.py - pieces of the MicroPython raw REPL protocol that do not depend
+# on Qt. They are shared by pyboard.Pyboard, pyboard.TelnetToSerial and
+# asyncpyboard.AsyncPyboard.
+#
+
+# raw REPL banner, printed on entry and after every soft reboot
+RAW_REPL_BANNER = b'raw REPL; CTRL-B to exit\r\n>'
+SOFT_REBOOT = b'soft reboot\r\n'
+FRIENDLY_PROMPT = b'>>> '
+
+# seconds each phase of the raw REPL handshake waits for the board before it
+# interrupts again or gives up:
+#   enter   ctrl-A until the raw REPL banner
+#   reboot  ctrl-D until the soft reboot message
+#   banner  soft reboot message until the banner, boot.py runs in between
+#   stop    ctrl-C until the friendly REPL prompt
+HANDSHAKE_TIMEOUT = {'enter': 1.0, 'reboot': 1.0, 'banner': 1.0, 'stop': 0.5}
+# tries per phase, a program may catch the first KeyboardInterrupt
+HANDSHAKE_TRIES = 2
+
+
+class PyboardError(BaseException):
+    pass
+
+
+class RxBuffer:
+    """Growable receive buffer for the raw REPL protocol. Received data is appended
+    in bulk and consumed from the front, so searching for a terminator only scans
+    bytes that have not been scanned before and parsing a response is linear in
+    its size.
+    """
+
+    # consumed bytes are only discarded once at least this many have built up
+    COMPACT_SIZE = 4096
+
+    def __init__(self):
+        self._buf = bytearray()
+        self._start = 0         # offset of the first unconsumed byte
+
+    def __len__(self):
+        return len(self._buf) - self._start
+
+    def feed(self, data):
+        self._buf += data
+
+    def clear(self):
+        self._buf = bytearray()
+        self._start = 0
+
+    def find(self, ending, offset=0):
+        """Return the offset of ending in the unconsumed data, searching from offset,
+        or -1 if it is not (yet) in the buffer.
+        """
+        idx = self._buf.find(ending, self._start + offset)
+        if idx < 0:
+            return -1
+        return idx - self._start
+
+    def take(self, num_bytes):
+        """Remove and return up to num_bytes from the front of the buffer."""
+        end = min(self._start + num_bytes, len(self._buf))
+        with memoryview(self._buf) as view:
+            data = view[self._start:end].tobytes()
+        self._start = end
+        if self._start == len(self._buf):
+            self.clear()
+        elif self._start >= self.COMPACT_SIZE and self._start * 2 >= len(self._buf):
+            del self._buf[:self._start]
+            self._start = 0
+        return data
+
+
+def is_ip_address(device):
+    return bool(device) and device[0].isdigit() and device[-1].isdigit() and device.count('.') == 3
+
+
+class TelnetFilter:
+    """Removes telnet option negotiation (IAC sequences) from a byte stream."""
+    IAC = 0xff
+    SB = 0xfa
+    SE = 0xf0
+
+    def __init__(self):
+        self._pending = b''     # incomplete IAC sequence held back from the last chunk
+
+    @staticmethod
+    def escape(data):
+        """Double any 0xff data bytes so they are not read as IAC by the server."""
+        return data.replace(b'\xff', b'\xff\xff')
+
+    def feed(self, data):
+        data = self._pending + data
+        self._pending = b''
+        if b'\xff' not in data:
+            return data
+        out = bytearray()
+        i = 0
+        while i < len(data):
+            idx = data.find(b'\xff', i)
+            if idx < 0:
+                out += data[i:]
+                break
+            out += data[i:idx]
+            i = idx
+            if i + 1 >= len(data):
+                self._pending = data[i:]
+                break
+            cmd = data[i + 1]
+            if cmd == self.IAC:                 # escaped 0xff data byte
+                out.append(self.IAC)
+                i += 2
+            elif cmd == self.SB:                # sub-negotiation, runs to IAC SE
+                end = data.find(b'\xff\xf0', i + 2)
+                if end < 0:
+                    self._pending = data[i:]
+                    break
+                i = end + 2
+            elif 251 <= cmd <= 254:             # WILL, WONT, DO, DONT + option
+                if i + 2 >= len(data):
+                    self._pending = data[i:]
+                    break
+                i += 3
+            else:
+                i += 2
+        return bytes(out)
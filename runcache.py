@@ -0,0 +1,87 @@
+# runcache.py - cached copies of run scripts on the target.
+#
+# Running a script sends its whole source through the raw REPL every time,
+# which takes seconds for a large script on a 115200 baud link. run_cached()
+# keeps a copy of each run script on the board in RUN_CACHE_DIR, named after
+# the hash of the local path and of its content, so the source is sent only the
+# first time and after it was edited. Later runs execute the cached copy. Only
+# the newest copy of a script is kept, older ones are removed. Like Files.run(),
+# each run starts with a soft reset on a clean heap.
+#
+import hashlib
+import os
+import textwrap
+
+RUN_CACHE_DIR = '/.runcache'
+
+
+def cache_name(path, data):
+    """Target path of the cached copy of the local script path with content data."""
+    key = hashlib.sha256(os.path.abspath(path).encode('utf-8')).hexdigest()[:8]
+    return '{0}/{1}-{2}.py'.format(RUN_CACHE_DIR, key, hashlib.sha256(data).hexdigest()[:16])
+
+
+def check_command(name):
+    """Script that prints the size of the cached copy name, or -1 if there is
+    none, and removes older copies of the same script.
+    """
+    command = """
+        try:
+            import os
+        except ImportError:
+            import uos as os
+        try:
+            os.mkdir('{0}')
+        except OSError:
+            pass
+        size = -1
+        for entry in os.listdir('{0}'):
+            path = '{0}/' + entry
+            if path == '{1}':
+                size = os.stat(path)[6]
+            elif entry.startswith('{2}'):
+                os.remove(path)
+        print(size)
+    """.format(
+        RUN_CACHE_DIR, name, name.rsplit('/', 1)[1].split('-', 1)[0] + '-'
+    )
+    return textwrap.dedent(command)
+
+
+def run_command(name):
+    """Script that reads the cached copy name, closes it and runs it. The
+    script's globals are left as they would be for the source itself.
+    """
+    command = """
+        with open('{0}') as _f:
+            _src = _f.read()
+        del _f
+        exec(globals().pop('_src'))
+    """.format(
+        name
+    )
+    return textwrap.dedent(command)
+
+
+def run_cached(fs, filename):
+    """Run the local script filename on the board like Files.run(), sending the
+    source only if the board has no copy of it yet. Returns True if the cached
+    copy was run without sending the source.
+    """
+    with open(filename, 'rb') as f:
+        data = f.read()
+    name = cache_name(filename, data)
+    with fs.session():
+        try:
+            cached = int(fs.exec_command(check_command(name)).strip() or -1) == len(data)
+            if not cached:
+                fs.put(filename, name)
+        except RuntimeError:
+            cached = None
+    if cached is None:
+        # read only or full filesystem, send the source as before
+        fs.run(filename)
+        return False
+    with fs.session(soft_reset=True):
+        fs.run_command(run_command(name))
+    return cached
@@ -1,10 +1,13 @@
-from PyQt5.QtCore import (QSettings, QFile, QFileInfo, QCoreApplication, Qt)
+from PyQt5.QtCore import (QSettings, QFile, QFileInfo, QCoreApplication, Qt, pyqtSignal)
 from PyQt5.QtWidgets import (QWidget, QTabWidget, QVBoxLayout, QHBoxLayout, QPushButton, QLabel, QFrame, QComboBox,
                              QGridLayout)
 import sys
 import os
+import json
 
 class Settings(QWidget):
+    shellScrollbackChanged = pyqtSignal(int)
+
     def __init__(self):
         super().__init__()
 
@@ -77,6 +80,53 @@ class Settings(QWidget):
             indx = mcu_select.findText(target_mcu)
             mcu_select.setCurrentIndex(indx)
         layout.addWidget(mcu_select, 1, 0)
+        scrollback_label = QLabel()
+        scrollback_label.setAlignment(Qt.AlignCenter)
+        scrollback_label.setStyleSheet(mcu_label.styleSheet())
+        scrollback_label.setText('Shell Scrollback Lines')
+        scrollback_label.setFrameShape(QFrame.StyledPanel)
+        scrollback_label.setFixedWidth(200)
+        scrollback_label.setFixedHeight(32)
+        layout.addWidget(scrollback_label, 2, 0)
+        scrollback_select = QComboBox()
+        scrollback_select.setFixedWidth(200)
+        scrollback_select.setToolTip("Lines of target output kept in the shell")
+        scrollback_select.activated[str].connect(self.setShellScrollback)
+        scrollback_select.addItems(["1000", "5000", "20000", "100000"])
+        indx = scrollback_select.findText(str(self.getShellScrollback()))
+        if indx >= 0:
+            scrollback_select.setCurrentIndex(indx)
+        layout.addWidget(scrollback_select, 3, 0)
+        precompile_label = QLabel()
+        precompile_label.setAlignment(Qt.AlignCenter)
+        precompile_label.setStyleSheet(mcu_label.styleSheet())
+        precompile_label.setText('Precompile Modules')
+        precompile_label.setFrameShape(QFrame.StyledPanel)
+        precompile_label.setFixedWidth(200)
+        precompile_label.setFixedHeight(32)
+        layout.addWidget(precompile_label, 4, 0)
+        precompile_select = QComboBox()
+        precompile_select.setFixedWidth(200)
+        precompile_select.setToolTip("Deploy modules as .mpy files compiled by mpy-cross")
+        precompile_select.addItems(["Off", "On"])
+        precompile_select.setCurrentIndex(1 if self.getPrecompile() else 0)
+        precompile_select.activated[int].connect(lambda index: self.setPrecompile(index == 1))
+        layout.addWidget(precompile_select, 5, 0)
+        turbo_label = QLabel()
+        turbo_label.setAlignment(Qt.AlignCenter)
+        turbo_label.setStyleSheet(mcu_label.styleSheet())
+        turbo_label.setText('Turbo Transfers')
+        turbo_label.setFrameShape(QFrame.StyledPanel)
+        turbo_label.setFixedWidth(200)
+        turbo_label.setFixedHeight(32)
+        layout.addWidget(turbo_label, 6, 0)
+        turbo_select = QComboBox()
+        turbo_select.setFixedWidth(200)
+        turbo_select.setToolTip("Raise the target CPU clock and baud rate during downloads")
+        turbo_select.addItems(["Off", "On"])
+        turbo_select.setCurrentIndex(1 if self.getTurbo() else 0)
+        turbo_select.activated[int].connect(lambda index: self.setTurbo(index == 1))
+        layout.addWidget(turbo_select, 7, 0)
         layout.setAlignment(Qt.AlignTop)
         self.gen_tab.setLayout(layout)
         self.tabsList.addTab(self.gen_tab, 'General')
@@ -167,6 +217,50 @@ class Settings(QWidget):
     def setBaudRate(self, baud):
         return self.settings.setValue('BAUD_RATE', baud)        # baud is a string
 
+    # password for WebREPL targets, i.e. a SERIAL_PORT of the form 'ws://ip'
+    def getWebReplPassword(self):
+        return self.settings.value('WEBREPL_PASSWORD', 'python')
+
+    def setWebReplPassword(self, password):
+        self.settings.setValue('WEBREPL_PASSWORD', password)
+
+    def getShellScrollback(self):
+        return int(self.settings.value('SHELL_SCROLLBACK', '5000'))
+
+    def setShellScrollback(self, lines):
+        self.settings.setValue('SHELL_SCROLLBACK', lines)      # lines is a string
+        self.shellScrollbackChanged.emit(int(lines))
+
+    # compile modules with mpy-cross before they are downloaded to the target
+    def getPrecompile(self):
+        return self.settings.value('PRECOMPILE', 'False') == 'True'
+
+    def setPrecompile(self, _bool):
+        self.settings.setValue('PRECOMPILE', 'True' if _bool else 'False')
+
+    # raise the target CPU clock and baud rate during downloads and syncs
+    def getTurbo(self):
+        return self.settings.value('TURBO', 'False') == 'True'
+
+    def setTurbo(self, _bool):
+        self.settings.setValue('TURBO', 'True' if _bool else 'False')
+
+    # transfer parameters tuned per link, see linktune.py. The key names the port,
+    # USB VID:PID and board id.
+    def getLinkParams(self, key):
+        try:
+            return json.loads(self.settings.value('LINK_PARAMS', '{}')).get(key)
+        except ValueError:
+            return None
+
+    def setLinkParams(self, key, params):
+        try:
+            links = json.loads(self.settings.value('LINK_PARAMS', '{}'))
+        except ValueError:
+            links = {}
+        links[key] = params
+        self.settings.setValue('LINK_PARAMS', json.dumps(links))
+
     def getCurTargetScript(self):
         return self.settings.value('CUR_TARGET_SCRIPT', '')
 
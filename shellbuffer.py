@@ -0,0 +1,84 @@
+# shellbuffer.py - batched, bounded rendering of target output in the shell.
+#
+# Target output arrives in many small pieces. Inserting each piece into the
+# shell widget right away makes the GUI relayout the document for every
+# readyRead, so ShellBuffer collects the pieces and renders them at most
+# FRAME_RATE times a second in a single insert. The document keeps at most
+# max_blocks lines, and if output arrives faster than it can be rendered the
+# oldest pending text is dropped and counted, so memory stays flat during
+# long runs of a chatty device.
+#
+from PyQt5.QtCore import QObject, QTimer
+from PyQt5.QtGui import QTextCursor
+
+
+class ShellBuffer(QObject):
+    FRAME_RATE = 30                 # maximum renders per second
+    MAX_PENDING = 256 * 1024        # characters held between renders before dropping
+
+    def __init__(self, shelltext, max_blocks=5000, parent=None):
+        super().__init__(parent)
+        self.shelltext = shelltext
+        self.setMaximumBlockCount(max_blocks)
+        self._pending = []
+        self._pending_chars = 0
+        self._dropped_since_render = 0
+        # counters for the status of the pipeline
+        self.dropped_chars = 0
+        self.frames = 0
+
+        self._timer = QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.setInterval(1000 // self.FRAME_RATE)
+        self._timer.timeout.connect(self.flush)
+
+    def setMaximumBlockCount(self, max_blocks):
+        """Limit the scrollback to max_blocks lines, 0 means unlimited."""
+        self.shelltext.document().setMaximumBlockCount(int(max_blocks))
+
+    def write(self, text):
+        """Queue text for the next frame. A backspace deletes the previous character."""
+        self._pending.append(text)
+        self._pending_chars += len(text)
+        if self._pending_chars > self.MAX_PENDING:
+            self._drop()
+        if not self._timer.isActive():
+            self._timer.start()
+
+    def clear(self):
+        """Discard pending text, e.g. when the shell is cleared."""
+        self._timer.stop()
+        self._pending = []
+        self._pending_chars = 0
+        self._dropped_since_render = 0
+
+    # drop the oldest pending text until it fits, the newest output matters most
+    def _drop(self):
+        while self._pending_chars > self.MAX_PENDING // 2 and len(self._pending) > 1:
+            text = self._pending.pop(0)
+            self._pending_chars -= len(text)
+            self._dropped_since_render += len(text)
+            self.dropped_chars += len(text)
+
+    def flush(self):
+        """Render everything pending now."""
+        self._timer.stop()
+        if not self._pending:
+            return
+        text = ''.join(self._pending)
+        self._pending = []
+        self._pending_chars = 0
+        if self._dropped_since_render:
+            text = '\n<{0} characters of target output dropped>\n'.format(self._dropped_since_render) + text
+            self._dropped_since_render = 0
+
+        cursor = self.shelltext.textCursor()
+        cursor.movePosition(QTextCursor.End)
+        parts = text.split('\b')
+        cursor.insertText(parts[0])
+        for part in parts[1:]:
+            cursor.deletePreviousChar()
+            cursor.insertText(part)
+        self.shelltext.setTextCursor(cursor)
+        self.shelltext.ensureCursorVisible()
+        self.frames += 1
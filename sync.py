@@ -0,0 +1,493 @@
+# sync.py - incremental sync of a project folder to the target filesystem.
+#
+# ProjectSync hashes every file below a target folder with one raw REPL script,
+# compares the hashes with those of the local project files and uploads only
+# new or changed files, optionally removing target files that are not in the
+# project. The board uses sha256 if it has hashlib, otherwise crc32. Local
+# hashes are cached per device in a JSON file so unchanged project files are
+# not read again on the next sync.
+#
+# Large files that already exist on the board are updated rsync style: the
+# board sends a weak and a strong checksum per block of its copy, the host
+# rolls the weak checksum over the local file to find those blocks and sends
+# only copy instructions and the data in between. The board builds the new
+# file in a temporary file from its old copy and renames it in place.
+#
+import binascii
+import hashlib
+import json
+import os
+import textwrap
+import zlib
+import bundle
+import precompile
+
+# local folders and files that are never synced
+SKIP_NAMES = ('__pycache__',)
+# files at least this large that already exist on the board are updated by delta
+DELTA_MIN_SIZE = 8192
+
+# Board side hashing shared by the scripts below. digest(path) hashes a whole
+# file, block_digest(data) a block of a file for the delta transfer.
+HASH_PRELUDE = """
+        try:
+            import os
+        except ImportError:
+            import uos as os
+        import ubinascii
+        try:
+            import hashlib
+        except ImportError:
+            try:
+                import uhashlib as hashlib
+            except ImportError:
+                hashlib = None
+        if not hasattr(hashlib, 'sha256'):
+            hashlib = None
+        buf = bytearray(1024)
+        def digest(path):
+            with open(path, 'rb') as f:
+                if hashlib:
+                    h = hashlib.sha256()
+                    while True:
+                        n = f.readinto(buf)
+                        if not n:
+                            break
+                        h.update(memoryview(buf)[:n])
+                    return ubinascii.hexlify(h.digest()).decode()
+                crc = 0
+                while True:
+                    n = f.readinto(buf)
+                    if not n:
+                        break
+                    crc = ubinascii.crc32(memoryview(buf)[:n], crc)
+                return '%08x' % (crc & 0xffffffff)
+        def block_digest(data):
+            if hashlib:
+                return ubinascii.hexlify(hashlib.sha256(data).digest()[:8]).decode()
+            return '%08x' % (ubinascii.crc32(data) & 0xffffffff)
+"""
+
+
+def hash_command(directory):
+    """Script that prints 'I <unique id>' and 'A <hash algorithm>', then
+    'D <path>' for every folder and 'F <digest> <path>' for every file below
+    directory.
+    """
+    command = HASH_PRELUDE + """
+        try:
+            import machine
+            print('I', ubinascii.hexlify(machine.unique_id()).decode())
+        except Exception:
+            print('I', '-')
+        print('A', 'sha256' if hashlib else 'crc32')
+        def walk(directory):
+            for name in os.listdir(directory):
+                path = directory.rstrip('/') + '/' + name
+                if os.stat(path)[0] & 0x4000:
+                    print('D', path)
+                    walk(path)
+                else:
+                    print('F', digest(path), path)
+        walk('{0}')
+    """.format(
+        directory
+    )
+    return textwrap.dedent(command)
+
+
+def parse_hashes(out):
+    """Parse hash_command() output into (device id, algorithm, folders, {path: digest})."""
+    device_id = algo = None
+    folders = set()
+    digests = {}
+    for line in out.decode('utf-8').splitlines():
+        kind, _, rest = line.partition(' ')
+        if kind == 'I':
+            device_id = rest
+        elif kind == 'A':
+            algo = rest
+        elif kind == 'D':
+            folders.add(rest)
+        elif kind == 'F':
+            digest, _, path = rest.partition(' ')
+            digests[path] = digest
+    return device_id, algo, folders, digests
+
+
+def local_digest(path, algo):
+    """Hash a local file the same way hash_command() does on the board."""
+    with open(path, 'rb') as f:
+        if algo == 'sha256':
+            h = hashlib.sha256()
+            for block in iter(lambda: f.read(65536), b''):
+                h.update(block)
+            return h.hexdigest()
+        crc = 0
+        for block in iter(lambda: f.read(65536), b''):
+            crc = zlib.crc32(block, crc)
+        return '%08x' % (crc & 0xffffffff)
+
+
+def local_files(local_dir):
+    """Return {relative path with '/' separators: local path} of the files to sync."""
+    result = {}
+    for dirpath, dirnames, filenames in os.walk(local_dir):
+        dirnames[:] = sorted(d for d in dirnames if not d.startswith('.') and d not in SKIP_NAMES)
+        for name in filenames:
+            if name.startswith('.') or name in SKIP_NAMES:
+                continue
+            path = os.path.join(dirpath, name)
+            rel = os.path.relpath(path, local_dir).replace(os.sep, '/')
+            result[rel] = path
+    return result
+
+
+def remote_path(remote_dir, rel):
+    return remote_dir.rstrip('/') + '/' + rel
+
+
+def parent_path(path):
+    return path.rsplit('/', 1)[0] or '/'
+
+
+def is_skipped(remote_dir, target):
+    """True if the target path below remote_dir is never synced, local_files()
+    skips it. Dot folders hold tool files like runcache.RUN_CACHE_DIR.
+    """
+    rel = target[len(remote_dir.rstrip('/')) + 1:]
+    return any(name.startswith('.') or name in SKIP_NAMES for name in rel.split('/'))
+
+
+def delta_block_size(size):
+    """Block size of the delta transfer for a file of size bytes, about the
+    square root of the size so the checksum list and the delta stay small.
+    """
+    block_size = 256
+    while block_size < 4096 and block_size * block_size < size:
+        block_size *= 2
+    return block_size
+
+
+def block_sums_command(filename, block_size):
+    """Script that prints 'A <hash algorithm>' and then '<weak> <strong>' for
+    every full block of filename, or 'N' if there is no such file. The weak sum
+    is the byte sum of the block, the strong sum is block_digest() of it.
+    """
+    command = HASH_PRELUDE + """
+        print('A', 'sha256' if hashlib else 'crc32')
+        try:
+            f = open('{0}', 'rb')
+        except OSError:
+            print('N')
+        else:
+            block = bytearray({1})
+            while f.readinto(block) == {1}:
+                print(sum(block), block_digest(block))
+            f.close()
+    """.format(
+        filename, block_size
+    )
+    return textwrap.dedent(command)
+
+
+def parse_block_sums(out):
+    """Parse block_sums_command() output into (algorithm, {weak: {strong: block index}}),
+    the table is None if the file does not exist on the board.
+    """
+    algo = None
+    table = {}
+    index = 0
+    for line in out.decode('utf-8').splitlines():
+        kind, _, rest = line.partition(' ')
+        if kind == 'A':
+            algo = rest
+        elif kind == 'N':
+            table = None
+        elif rest:
+            table.setdefault(int(kind), {}).setdefault(rest, index)
+            index += 1
+    return algo, table
+
+
+def apply_delta_command(filename, block_size):
+    """Script that rebuilds filename from its current content and a delta read
+    from stdin, line by line like put_command(): 'C <index> <count>' copies
+    count blocks from the current file, 'L<base64>' adds literal data and an
+    empty line ends the delta. The new file is written to a temporary file that
+    replaces filename at the end, then the digest of the new file is printed.
+    The board sends UPLOAD_ACK when it is ready and after each line.
+    """
+    command = HASH_PRELUDE + """
+        import sys
+        try:
+            stdin = sys.stdin.buffer
+        except AttributeError:
+            stdin = sys.stdin
+        block = bytearray({1})
+        with open('{0}', 'rb') as old:
+            with open('{0}.tmp', 'wb') as new:
+                sys.stdout.write('\\x06')
+                while True:
+                    line = stdin.readline()
+                    kind = line[:1]
+                    if kind in ('C', b'C'):
+                        index, count = line.split()[1:]
+                        old.seek(int(index) * {1})
+                        for i in range(int(count)):
+                            old.readinto(block)
+                            new.write(block)
+                    elif kind in ('L', b'L'):
+                        new.write(ubinascii.a2b_base64(line[1:]))
+                    else:
+                        break
+                    sys.stdout.write('\\x06')
+        os.rename('{0}.tmp', '{0}')
+        print(digest('{0}'))
+    """.format(
+        filename, block_size
+    )
+    return textwrap.dedent(command)
+
+
+def delta_lines(infile, table, block_size, algo, literal_size=4096):
+    """Compare infile with the block sums of the board file and yield the lines
+    of the delta for apply_delta_command(). The weak sum is rolled over infile
+    one byte at a time and only a weak match is checked with the strong sum.
+    At most about two blocks and one literal of infile are held in memory.
+    """
+    if algo == 'sha256':
+        def strong(data):
+            return hashlib.sha256(data).hexdigest()[:16]
+    else:
+        def strong(data):
+            return '%08x' % (zlib.crc32(data) & 0xffffffff)
+
+    data = bytearray()
+    start = 0           # start of the pending literal in data
+    pos = 0             # start of the current window in data
+    weak = None
+    copy = None         # pending copy as [first index, count]
+    eof = False
+    while True:
+        if not eof and len(data) - pos < block_size + 1:
+            # drop what has been sent and read ahead
+            del data[:start]
+            pos -= start
+            start = 0
+            chunk = infile.read(max(block_size, literal_size))
+            eof = not chunk
+            data += chunk
+            continue
+        if len(data) - pos < block_size:
+            break
+        if weak is None:
+            weak = sum(data[pos:pos + block_size])
+        index = None
+        candidates = table.get(weak)
+        if candidates is not None:
+            index = candidates.get(strong(bytes(data[pos:pos + block_size])))
+        if index is not None:
+            if start < pos:
+                if copy is not None:
+                    yield 'C {0} {1}\n'.format(*copy).encode()
+                    copy = None
+                for line in _literal_lines(data[start:pos], literal_size):
+                    yield line
+            if copy is not None and copy[0] + copy[1] == index:
+                copy[1] += 1
+            else:
+                if copy is not None:
+                    yield 'C {0} {1}\n'.format(*copy).encode()
+                copy = [index, 1]
+            pos += block_size
+            start = pos
+            weak = None
+            continue
+        if pos - start >= literal_size:
+            if copy is not None:
+                yield 'C {0} {1}\n'.format(*copy).encode()
+                copy = None
+            for line in _literal_lines(data[start:pos], literal_size):
+                yield line
+            start = pos
+        if pos + block_size < len(data):
+            weak += data[pos + block_size] - data[pos]
+        pos += 1
+    if copy is not None:
+        yield 'C {0} {1}\n'.format(*copy).encode()
+    if start < len(data):
+        for line in _literal_lines(data[start:], literal_size):
+            yield line
+
+
+def _literal_lines(data, literal_size):
+    for i in range(0, len(data), literal_size):
+        yield b'L' + binascii.b2a_base64(data[i:i + literal_size])
+
+
+class ProjectSync:
+    """Syncs a local folder to a folder on the board through a files.Files instance.
+    cache_dir holds the local hash caches, no cache is kept if it is None.
+    """
+
+    def __init__(self, fs, cache_dir=None, precompiler=None, use_bundle=False):
+        self.fs = fs
+        self.cache_dir = cache_dir
+        # optional precompile.Precompiler, modules are then deployed as .mpy
+        self.precompiler = precompiler
+        # send new and small changed files in one bundle.put_bundle() archive
+        self.use_bundle = use_bundle
+
+    def sync(self, local_dir, remote_dir='/', delete=False):
+        """Upload new and changed files from local_dir to remote_dir, and remove
+        target files below remote_dir that are not in local_dir if delete is True,
+        along with the folders that leaves empty. Target files that would not be
+        synced from local_dir, like those in runcache.RUN_CACHE_DIR, are kept.
+        Returns a dict with the 'uploaded' and 'deleted' target paths, the
+        number of 'unchanged' files and the (size, digest) of the target 'files'.
+        """
+        local = local_files(local_dir)
+        uploaded = []
+        deleted = []
+        bundled = []
+        synced = {}
+        with self.fs.session():
+            device_id, algo, folders, digests = parse_hashes(self.fs.exec_command(hash_command(remote_dir)))
+            cache = self._load_cache(device_id, algo)
+            if self.precompiler is not None:
+                self.precompiler.check_target(int(self.fs.exec_command(precompile.mpy_version_command())))
+                local = self._compile(local, remote_dir, digests, deleted)
+            for rel, path in sorted(local.items()):
+                target = remote_path(remote_dir, rel)
+                digest = self._local_digest(cache, rel, path, algo)
+                synced[target] = (os.path.getsize(path), digest)
+                if digests.get(target) == digest:
+                    continue
+                uploaded.append(target)
+                if target in digests and os.path.getsize(path) >= DELTA_MIN_SIZE:
+                    self.put_delta(path, target)
+                elif self.use_bundle:
+                    bundled.append((path, target))
+                else:
+                    self._make_folders(target, folders)
+                    self.fs.put(path, target)
+            if bundled:
+                bundle.put_bundle(self.fs, bundled)
+            if delete:
+                wanted = set(remote_path(remote_dir, rel) for rel in local)
+                for target in sorted(set(digests) - wanted):
+                    if is_skipped(remote_dir, target):
+                        continue
+                    self.fs.rm(target)
+                    deleted.append(target)
+                self._remove_emptied(folders, (set(digests) | wanted) - set(deleted), deleted)
+            self._save_cache(device_id, algo, cache)
+        return {'uploaded': uploaded, 'deleted': deleted, 'unchanged': len(local) - len(uploaded),
+                'files': synced}
+
+    # Remove the folders that deleting files left empty, deepest first, and add
+    # them to deleted. remaining are the target files that are still there.
+    def _remove_emptied(self, folders, remaining, deleted):
+        emptied = set()
+        for target in deleted:
+            folder = parent_path(target)
+            while folder in folders:
+                emptied.add(folder)
+                folder = parent_path(folder)
+        used = set()
+        for path in remaining | (folders - emptied):
+            folder = parent_path(path)
+            while folder in folders and folder not in used:
+                used.add(folder)
+                folder = parent_path(folder)
+        for folder in sorted(emptied - used, key=lambda f: f.count('/'), reverse=True):
+            self.fs.rmdir(folder)
+            folders.discard(folder)
+            deleted.append(folder)
+
+    # Replace the modules in local by their compiled files and remove the sources
+    # of the compiled modules from the board, it would import those first.
+    def _compile(self, local, remote_dir, digests, deleted):
+        result = {}
+        for rel, path in local.items():
+            if not precompile.wants_compile(rel):
+                result[rel] = path
+                continue
+            result[precompile.compiled_name(rel)] = self.precompiler.compile(path, rel)
+            source = remote_path(remote_dir, rel)
+            if source in digests:
+                self.fs.rm(source)
+                del digests[source]
+                deleted.append(source)
+        return result
+
+    def put_delta(self, path, target):
+        """Update the board file target to the content of the local file path by
+        sending only the blocks that changed. Falls back to a full upload if
+        target does not exist or the result does not match. Returns True if the
+        delta was used.
+        """
+        size = os.path.getsize(path)
+        block_size = delta_block_size(size)
+        with self.fs.session():
+            algo, table = parse_block_sums(self.fs.exec_command(block_sums_command(target, block_size)))
+            if table is None:
+                self.fs.put(path, target)
+                return False
+            with open(path, 'rb') as infile:
+                lines = delta_lines(infile, table, block_size, algo, self.fs.upload_block_size)
+                out = self.fs.stream_command(apply_delta_command(target, block_size),
+                                             self._progress(lines, infile, size), target)
+            if out.strip() != local_digest(path, algo):
+                self.fs.put(path, target)
+                return False
+        return True
+
+    # report the progress of a delta by the position in the local file
+    def _progress(self, lines, infile, size):
+        for line in lines:
+            yield line
+            if self.fs.progress is not None:
+                self.fs.progress(infile.tell(), size)
+
+    # create the missing folders above target on the board
+    def _make_folders(self, target, folders):
+        parts = target.strip('/').split('/')[:-1]
+        for i in range(len(parts)):
+            folder = '/' + '/'.join(parts[:i + 1])
+            if folder not in folders:
+                self.fs.mkdir(folder, exists_okay=True)
+                folders.add(folder)
+
+    # hash a local file, reusing the cached hash if its size and mtime are unchanged
+    def _local_digest(self, cache, rel, path, algo):
+        st = os.stat(path)
+        entry = cache.get(rel)
+        if entry and entry[0] == st.st_mtime_ns and entry[1] == st.st_size:
+            return entry[2]
+        digest = local_digest(path, algo)
+        cache[rel] = [st.st_mtime_ns, st.st_size, digest]
+        return digest
+
+    def _cache_path(self, device_id):
+        return os.path.join(self.cache_dir, 'sync-{0}.json'.format(device_id or 'unknown'))
+
+    def _load_cache(self, device_id, algo):
+        if self.cache_dir is None:
+            return {}
+        try:
+            with open(self._cache_path(device_id)) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if data.get('algo') != algo:
+            return {}
+        return data.get('files', {})
+
+    def _save_cache(self, device_id, algo, cache):
+        if self.cache_dir is None:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(self._cache_path(device_id), 'w') as f:
+            json.dump({'algo': algo, 'files': cache}, f)
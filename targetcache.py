@@ -0,0 +1,159 @@
+# targetcache.py - persistent cache of the target file tree.
+#
+# Listing a target folder costs a raw REPL session, so the names, types, sizes
+# and hashes of the target files are kept per board, keyed by the board's
+# machine.unique_id(), in a JSON file. The GUI shows the cached tree right away
+# and updates it in place after its own downloads, removes and new folders.
+# Cached folders are marked stale when the board may have changed them behind
+# our back (on connect, reset or a script run) and are listed again only when
+# they are shown.
+#
+import json
+import os
+import textwrap
+
+DIR = 'd'
+FILE = 'f'
+
+
+def unique_id_command():
+    """Script that prints the hex unique id of the board, or '-' if it has none."""
+    command = """
+        import ubinascii
+        try:
+            import machine
+            print(ubinascii.hexlify(machine.unique_id()).decode())
+        except Exception:
+            print('-')
+    """
+    return textwrap.dedent(command)
+
+
+def parent_path(path):
+    return path.rstrip('/').rsplit('/', 1)[0] or '/'
+
+
+def join_path(directory, name):
+    return directory.rstrip('/') + '/' + name
+
+
+def entries_from_ilist(records):
+    """Turn the (path, is folder, size) records of Files.ilist() into a listing."""
+    entries = {}
+    for path, is_dir, size in records:
+        entries[path.rstrip('/').rsplit('/', 1)[-1]] = [DIR if is_dir else FILE, size, None]
+    return entries
+
+
+class TargetCache:
+    """Cached folder listings of one board. A listing is a dict of
+    {name: [DIR or FILE, size, digest or None]}.
+    """
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir
+        self.device_id = None
+        self._dirs = {}     # folder path -> {'stale': bool, 'entries': listing}
+
+    def load(self, device_id):
+        """Switch to the cache of device_id. Loaded folders are stale until listed again."""
+        self.device_id = device_id
+        self._dirs = {}
+        if self.cache_dir is None or device_id is None:
+            return
+        try:
+            with open(self._path(device_id)) as f:
+                self._dirs = json.load(f).get('dirs', {})
+        except (OSError, ValueError):
+            self._dirs = {}
+        self.invalidate()
+
+    def save(self):
+        if self.cache_dir is None or self.device_id is None:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(self._path(self.device_id), 'w') as f:
+            json.dump({'dirs': self._dirs}, f)
+
+    def last_device(self, port):
+        """Return the id of the board last seen on port, or None."""
+        return self._read_ports().get(port)
+
+    def set_last_device(self, port, device_id):
+        if self.cache_dir is None:
+            return
+        ports = self._read_ports()
+        ports[port] = device_id
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(os.path.join(self.cache_dir, 'targets.json'), 'w') as f:
+            json.dump(ports, f)
+
+    def listing(self, directory):
+        """Return the cached listing of directory, or None if it was never listed."""
+        folder = self._dirs.get(directory)
+        return None if folder is None else folder['entries']
+
+    def is_stale(self, directory):
+        folder = self._dirs.get(directory)
+        return folder is None or folder['stale']
+
+    def set_listing(self, directory, entries):
+        """Store a fresh listing of directory. Hashes of files whose size did not
+        change are kept, cached subfolders that are gone are dropped.
+        """
+        old = self.listing(directory) or {}
+        for name, entry in entries.items():
+            prev = old.get(name)
+            if prev and prev[0] == entry[0] == FILE and prev[1] == entry[1] and entry[2] is None:
+                entry[2] = prev[2]
+        for name, entry in old.items():
+            if entry[0] == DIR and entries.get(name, [None])[0] != DIR:
+                self._drop_tree(join_path(directory, name))
+        self._dirs[directory] = {'stale': False, 'entries': entries}
+
+    def update_file(self, path, size, digest=None):
+        """Record that the file path was written with size bytes."""
+        self._entries(parent_path(path))[path.rstrip('/').rsplit('/', 1)[1]] = [FILE, size, digest]
+
+    def add_folder(self, path):
+        self._entries(parent_path(path))[path.rstrip('/').rsplit('/', 1)[1]] = [DIR, 0, None]
+        self._dirs[path.rstrip('/')] = {'stale': False, 'entries': {}}
+
+    def remove(self, path):
+        """Forget the file or folder path."""
+        path = path.rstrip('/')
+        entries = self.listing(parent_path(path))
+        if entries is not None:
+            entries.pop(path.rsplit('/', 1)[1], None)
+        self._drop_tree(path)
+
+    def invalidate(self, directory=None):
+        """Mark directory, or every cached folder if None, to be listed again."""
+        for path, folder in self._dirs.items():
+            if directory is None or path == directory:
+                folder['stale'] = True
+
+    # listing of directory for an update in place. Missing folders are created
+    # stale, there may be more in them than we know of.
+    def _entries(self, directory):
+        if directory not in self._dirs:
+            if directory != '/':
+                self._entries(parent_path(directory))[directory.rsplit('/', 1)[1]] = [DIR, 0, None]
+            self._dirs[directory] = {'stale': True, 'entries': {}}
+        return self._dirs[directory]['entries']
+
+    def _drop_tree(self, path):
+        for folder in [p for p in self._dirs if p == path or p.startswith(path + '/')]:
+            del self._dirs[folder]
+
+    def _path(self, device_id):
+        return os.path.join(self.cache_dir, 'tree-{0}.json'.format(device_id))
+
+    def _read_ports(self):
+        if self.cache_dir is None:
+            return {}
+        try:
+            with open(os.path.join(self.cache_dir, 'targets.json')) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
@@ -0,0 +1,152 @@
+# turbo.py - faster bulk transfers on UART bridged boards.
+#
+# The REPL of an ESP8266 or ESP32 behind a USB serial bridge (CP210x, CH340)
+# runs at the BAUD_RATE setting, usually 115200, although the bridges handle
+# 921600 and more. turbo() raises the board's CPU clock and switches the REPL
+# UART and the serial port to the fastest of TURBO_BAUDS that passes a ping for
+# the time of a bulk operation, then restores both. The board goes back to the
+# old baud rate by itself if it does not hear from the host at the new one, so
+# a baud rate the bridge cannot do costs a second and no reset. The baud rate
+# that worked is remembered per open port.
+#
+import contextlib
+import textwrap
+
+# fastest CPU clock per TARGET_MCU setting
+TURBO_FREQ = {
+    'ESP8266': 160000000,
+    'ESP32': 240000000,
+    'ESP32S2': 240000000,
+    'ESP32S3': 240000000,
+    'ESP32C3': 160000000,
+}
+# MCUs whose REPL is on UART0 behind a USB serial bridge. The others are
+# usually connected by native USB, where the baud rate makes no difference.
+UART_BRIDGED = ('ESP8266', 'ESP32')
+# baud rates tried, fastest first
+TURBO_BAUDS = (921600, 460800, 230400)
+
+SWITCH_READY = b'\x06'      # sent by the board at the new baud rate
+SWITCH_HELLO = b'T'         # answer of the host at the new baud rate
+SWITCH_TIMEOUT = 1          # seconds each side waits for the other
+PING_COMMAND = "print('ping', 6 * 7)\n"
+PING_REPLY = b'ping 42'
+
+
+def freq_command(freq):
+    """Script that prints the CPU clock of the board and sets it to freq."""
+    command = """
+        import machine
+        old = machine.freq()
+        if old != {0}:
+            machine.freq({0})
+        print(old)
+    """.format(
+        freq
+    )
+    return textwrap.dedent(command)
+
+
+def switch_baud_command(baud, old_baud):
+    """Script that switches the REPL UART to baud and sends SWITCH_READY. It
+    goes back to old_baud unless the host answers with SWITCH_HELLO within
+    SWITCH_TIMEOUT, then prints 1 if it stayed at baud, otherwise 0.
+    """
+    command = """
+        import sys
+        import time
+        import machine
+        try:
+            import select
+        except ImportError:
+            import uselect as select
+        try:
+            stdin = sys.stdin.buffer
+        except AttributeError:
+            stdin = sys.stdin
+        time.sleep_ms(20)
+        machine.UART(0, {0})
+        sys.stdout.write('\\x06')
+        poll = select.poll()
+        poll.register(stdin, select.POLLIN)
+        ok = bool(poll.poll({2})) and stdin.read(1) in (b'T', 'T')
+        if not ok:
+            time.sleep_ms(20)
+            machine.UART(0, {1})
+        print(1 if ok else 0)
+    """.format(
+        baud, old_baud, SWITCH_TIMEOUT * 1000
+    )
+    return textwrap.dedent(command)
+
+
+def ping(board):
+    """True if the board runs a script and answers at the current baud rate."""
+    out, err = board.exec_raw(PING_COMMAND, timeout=SWITCH_TIMEOUT)
+    return not err and out.strip() == PING_REPLY
+
+
+def switch_baud(board, baud):
+    """Switch the board and the serial port to baud. Returns True if they talk
+    at baud, False if both are back at the old baud rate. Raises RuntimeError if
+    the board cannot be reached at either.
+    """
+    old_baud = board.serialport.baudRate()
+    board.exec_raw_no_follow(switch_baud_command(baud, old_baud))
+    board.serialport.setBaudRate(baud)
+    if board.read_until(1, SWITCH_READY, SWITCH_TIMEOUT).endswith(SWITCH_READY):
+        board.serialWrite(SWITCH_HELLO)
+        out, err = board.follow(SWITCH_TIMEOUT)
+        if out.strip() == b'1' and ping(board):
+            return True
+    # the board goes back by itself when it does not hear the hello
+    board.serialport.setBaudRate(old_baud)
+    board.follow(SWITCH_TIMEOUT * 2)
+    if not ping(board):
+        # a reset starts the board at its default baud rate again
+        ignore = board.ignoreSerial
+        board.hardReset()
+        board.ignoreSerial = ignore
+        board.enter_raw_repl(soft_reset=False)
+        raise RuntimeError('Lost the target at {0} baud, it was reset'.format(baud))
+    return False
+
+
+@contextlib.contextmanager
+def turbo(board, fs, mcu):
+    """Context manager that runs a bulk operation with the fastest CPU clock of
+    mcu (a TARGET_MCU setting) and, on serial ports to UART bridged boards, the
+    fastest baud rate that works. Yields the baud rate in use, None on network
+    links.
+    """
+    with fs.session():
+        freq = TURBO_FREQ.get(mcu)
+        old_freq = None
+        if freq:
+            try:
+                old_freq = int(fs.exec_command(freq_command(freq)).strip())
+            except (RuntimeError, ValueError):
+                freq = None     # the board has no machine.freq() or refuses it
+        try:
+            baud = old_baud = None
+            # network transports have a socket notifier, serial ports do not
+            if board.notifier is None:
+                old_baud = board.serialport.baudRate()
+                if mcu in UART_BRIDGED:
+                    if board.turbo_baud is None:
+                        board.turbo_baud = 0
+                        for baud in [b for b in TURBO_BAUDS if b > old_baud]:
+                            if switch_baud(board, baud):
+                                board.turbo_baud = baud
+                                break
+                    elif board.turbo_baud > old_baud and not switch_baud(board, board.turbo_baud):
+                        board.turbo_baud = None     # try them all again next time
+                baud = board.serialport.baudRate()
+            try:
+                yield baud
+            finally:
+                if baud != old_baud and not switch_baud(board, old_baud):
+                    raise RuntimeError('Could not restore the target baud rate of {0}'.format(old_baud))
+        finally:
+            if freq and old_freq != freq:
+                fs.exec_command(freq_command(old_freq))